@@ -0,0 +1,215 @@
+"""
+Offline replay of the ``HotWaterTank.activate_permission`` decision rule over historical 5-minute data.
+
+All the slots of the history are evaluated in a single vectorized pass, so a year of data is replayed in a
+few milliseconds and thousands of parameter sets can be compared. Usage::
+
+    python -m backtest history.npz --buy-price 0.15 --sell-price 0.05 --exclusion-time 20-23
+"""
+import datetime
+import logging
+import time
+
+import numpy as np
+
+import tariff
+import timeseries
+
+
+SLOT_HOURS = timeseries.SLOT_MINUTES / 60
+
+
+def exclusion_mask(exclusion_time) -> np.ndarray:
+    """
+    Converts exclusion windows in the ``HotWaterTank.exclusion_time`` format to a mask of the slots of a day.
+    Weekdays of the rules are ignored, use ``schedule_arrays`` for weekday dependent windows
+    :param exclusion_time: rule or list of rules in the ``tariff`` format
+    :return: bool array of shape ``(288,)``, True for excluded slots
+    """
+    slot_minutes = np.arange(timeseries.SLOTS_PER_DAY) * timeseries.SLOT_MINUTES
+    mask = np.zeros(timeseries.SLOTS_PER_DAY, dtype=bool)
+    for rule in tariff.parse_rules(exclusion_time):
+        if rule['end'] > rule['start']:
+            mask |= (rule['start'] <= slot_minutes) & (slot_minutes < rule['end'])
+        else:
+            mask |= (rule['start'] <= slot_minutes) | (slot_minutes < rule['end'])
+    return mask
+
+
+def schedule_arrays(schedule: tariff.WeeklySchedule, days: list) -> tuple:
+    """
+    Looks up the exclusion windows and the prices of a schedule for every slot of a list of days
+    :return: ``(excluded, buy, sell)`` arrays of shape ``(days, 288)``
+    """
+    excluded, buy, sell = schedule.tables()
+    weekdays = np.array([schedule.weekday(day) for day in days])
+    minutes = weekdays[:, None] * tariff.MINUTES_PER_DAY + \
+        np.arange(timeseries.SLOTS_PER_DAY) * timeseries.SLOT_MINUTES
+    return (np.frombuffer(excluded, dtype=np.uint8)[minutes].astype(bool),
+            np.frombuffer(buy, dtype=np.float64)[minutes],
+            np.frombuffer(sell, dtype=np.float64)[minutes])
+
+
+def _ratio(on_grid: np.ndarray, buy: np.ndarray) -> np.ndarray:
+    # Same as the controller: the ratio is 0 when nothing has been bought
+    return np.divide(on_grid, buy, out=np.zeros_like(on_grid), where=buy > 0)
+
+
+class Backtest:
+    """
+    Replays the decision rule of the controller over a history of days.
+
+    Sold and bought energy are estimated per slot from the ``productPower`` and ``usePower`` series, and each
+    decision only uses the daily and monthly totals accumulated before its slot, as the controller would.
+    The replay is open loop: the tank load is added on top of the recorded consumption for the balance
+    figures, but it does not feed back into the ratios of later slots.
+    """
+
+    def __init__(self, days: list, product_power: np.ndarray, use_power: np.ndarray):
+        """
+        :param days: list of ``datetime.date``, one per row of the series
+        :param product_power: array of shape ``(days, 288)`` with the produced power in kW, NaN for gaps
+        :param use_power: array of shape ``(days, 288)`` with the used power in kW, NaN for gaps
+        """
+        self.days = list(days)
+        self._logger = logging.getLogger(__name__)
+        net = np.nan_to_num(np.asarray(product_power, dtype=np.float64)) - \
+            np.nan_to_num(np.asarray(use_power, dtype=np.float64))
+        self.on_grid = np.clip(net, 0, None) * SLOT_HOURS
+        self.buy = np.clip(-net, 0, None) * SLOT_HOURS
+
+        # Totals accumulated before each slot, for the day and for the month
+        on_grid_day = np.cumsum(self.on_grid, axis=1) - self.on_grid
+        buy_day = np.cumsum(self.buy, axis=1) - self.buy
+        on_grid_month = on_grid_day + self._month_offsets(self.on_grid.sum(axis=1))[:, None]
+        buy_month = buy_day + self._month_offsets(self.buy.sum(axis=1))[:, None]
+        self.ratio_daily = _ratio(on_grid_day, buy_day)
+        self.ratio_monthly = _ratio(on_grid_month, buy_month)
+
+    def _month_offsets(self, day_totals: np.ndarray) -> np.ndarray:
+        """
+        Returns, for every day, the sum of the totals of the previous days of the same month
+        """
+        month_ids = np.array([day.year * 12 + day.month for day in self.days])
+        cumulative = np.concatenate(([0.0], np.cumsum(day_totals)))
+        new_month = np.concatenate(([True], month_ids[1:] != month_ids[:-1]))
+        month_start = np.maximum.accumulate(np.where(new_month, np.arange(len(self.days)), 0))
+        return cumulative[:-1] - cumulative[month_start]
+
+    @classmethod
+    def from_store(cls, store: timeseries.SeriesStore, plant_id: str,
+                   start: datetime.date, end: datetime.date) -> 'Backtest':
+        """
+        Loads the history of a plant from a series store
+        """
+        days = [start + datetime.timedelta(days=i) for i in range((end - start).days + 1)]
+        return cls(days, store.read_range(plant_id, start, end, 'productPower'),
+                   store.read_range(plant_id, start, end, 'usePower'))
+
+    @classmethod
+    def from_file(cls, path: str) -> 'Backtest':
+        """
+        Loads a history saved with ``save``
+        """
+        with np.load(path) as history:
+            days = [datetime.date.fromisoformat(day) for day in history['days']]
+            return cls(days, history['productPower'], history['usePower'])
+
+    @staticmethod
+    def save(path: str, days: list, product_power: np.ndarray, use_power: np.ndarray) -> None:
+        """
+        Saves a history to a ``.npz`` file that can be loaded with ``from_file``
+        """
+        np.savez_compressed(path, days=np.array([day.isoformat() for day in days]),
+                            productPower=product_power, usePower=use_power)
+
+    def run(self, energy_price_buy=1.0, energy_price_sell=1.0, daily_factor: float = 1.1,
+            exclusion_time=(), tank_power: float = 2.0, daily_demand: float = None) -> dict:
+        """
+        Evaluates the decision rule for every slot of the history
+        :param energy_price_buy: price of bought energy. A float, or an array broadcastable to ``(days, 288)``
+        :param energy_price_sell: price of sold energy. A float, or an array broadcastable to ``(days, 288)``
+        :param daily_factor: factor applied to the ratio threshold for the daily ratio
+        :param exclusion_time: exclusion intervals in the ``HotWaterTank.exclusion_time`` format, or a bool
+            array broadcastable to ``(days, 288)``
+        :param tank_power: power drawn by the tank when switched on, in kW
+        :param daily_demand: [optional] kWh after which the thermostat of the tank stops drawing power each day
+        :return: dict with on-time [h], tank energy, self-consumed tank energy and balance figures [kWh, money]
+        """
+        ratio_threshold = np.divide(energy_price_buy, energy_price_sell)
+        excluded = exclusion_time if isinstance(exclusion_time, np.ndarray) else exclusion_mask(exclusion_time)
+        permission = ((self.ratio_daily > daily_factor * ratio_threshold) |
+                      (self.ratio_monthly > ratio_threshold)) & ~excluded
+
+        draw = permission * (tank_power * SLOT_HOURS)
+        if daily_demand is not None:
+            draw = np.diff(np.minimum(np.cumsum(draw, axis=1), daily_demand), axis=1, prepend=0.0)
+        self_consumed = np.minimum(draw, self.on_grid)
+        tank_bought = draw - self_consumed
+
+        balance_without_tank = energy_price_sell * self.on_grid - energy_price_buy * self.buy
+        balance = balance_without_tank - energy_price_sell * self_consumed - energy_price_buy * tank_bought
+        tank_energy = float(draw.sum())
+        # Slots where the thermostat already stopped the tank are not on-time
+        return {'on_time': float((draw > 0).sum()) * SLOT_HOURS,
+                'tank_energy': tank_energy,
+                'self_consumed': float(self_consumed.sum()),
+                'self_consumption_ratio': float(self_consumed.sum()) / tank_energy if tank_energy else 0.0,
+                'bought': float((self.buy + tank_bought).sum()),
+                'sold': float((self.on_grid - self_consumed).sum()),
+                'balance': float(np.sum(balance)),
+                'balance_without_tank': float(np.sum(balance_without_tank))}
+
+    def run_schedule(self, schedule: tariff.WeeklySchedule, **kwargs) -> dict:
+        """
+        Evaluates the decision rule with the exclusion windows and time-of-use prices of a schedule
+        :param kwargs: other keyword arguments for ``run``
+        """
+        excluded, buy, sell = schedule_arrays(schedule, self.days)
+        return self.run(energy_price_buy=buy, energy_price_sell=sell, exclusion_time=excluded, **kwargs)
+
+    def sweep(self, configurations: list) -> list:
+        """
+        Runs the backtest for a list of parameter sets
+        :param configurations: list of dicts with keyword arguments for ``run``
+        :return: list of ``(configuration, result)`` tuples
+        """
+        start = time.perf_counter()
+        results = [(configuration, self.run(**configuration)) for configuration in configurations]
+        self._logger.info(f'Swept {len(configurations)} configurations over {len(self.days)} days '
+                          f'in {time.perf_counter() - start:.3f} s')
+        return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Replays the controller decisions over historical data')
+    parser.add_argument('history', help='.npz file saved with Backtest.save, or a series store directory')
+    parser.add_argument('--plant-id', help='plant id when reading a series store')
+    parser.add_argument('--start', type=datetime.date.fromisoformat, help='first day when reading a series store')
+    parser.add_argument('--end', type=datetime.date.fromisoformat, help='last day when reading a series store')
+    parser.add_argument('--buy-price', type=float, default=1.0)
+    parser.add_argument('--sell-price', type=float, default=1.0)
+    parser.add_argument('--daily-factor', type=float, default=1.1)
+    parser.add_argument('--exclusion-time', help='exclusion rules separated by `;`, e.g. "mon-fri 20-23; 0-6"')
+    parser.add_argument('--buy-tariff', help='time-of-use buy price rules separated by `;`')
+    parser.add_argument('--sell-tariff', help='time-of-use sell price rules separated by `;`')
+    parser.add_argument('--tank-power', type=float, default=2.0)
+    parser.add_argument('--daily-demand', type=float)
+    args = parser.parse_args()
+
+    if args.history.endswith('.npz'):
+        backtest = Backtest.from_file(args.history)
+    else:
+        backtest = Backtest.from_store(timeseries.SeriesStore(args.history), args.plant_id, args.start, args.end)
+
+    t_start = time.perf_counter()
+    schedule = tariff.WeeklySchedule(args.buy_price, args.sell_price, args.exclusion_time, args.buy_tariff,
+                                     args.sell_tariff)
+    result = backtest.run_schedule(schedule, daily_factor=args.daily_factor, tank_power=args.tank_power,
+                                   daily_demand=args.daily_demand)
+    elapsed = time.perf_counter() - t_start
+    print(f'Replayed {len(backtest.days)} days in {elapsed * 1000:.1f} ms')
+    for key, value in result.items():
+        print(f'{key}: {value:.3f}')
@@ -0,0 +1,184 @@
+"""
+Parsed FusionSolar energy balance.
+
+``EnergyBalance`` holds the ``energy-balance`` payload of a plant for a day, month, year or lifetime as floats,
+parsed once when the payload is received: the totals in slots of the record and the series in ``array('d')``
+buffers, with NaN for the '``--``' gaps. A day takes a few KiB instead of the hundreds of strings of the payload,
+and the series can be wrapped without copies with ``numpy.frombuffer``.
+"""
+import array
+import datetime
+import math
+
+
+NAN = float('nan')
+GAP = '--'
+# Totals kept as attributes, by payload field
+TOTALS = {'totalOnGridPower': 'on_grid', 'totalBuyPower': 'buy', 'totalProductPower': 'product',
+          'totalUsePower': 'use'}
+# Series kept as float arrays, by payload field
+SERIES = {'productPower': 'product_power', 'usePower': 'use_power'}
+SLOT_MINUTES = 5
+
+
+def parse_value(value) -> float:
+    """
+    Converts a payload value to float, NaN for '``--``', missing or invalid values
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return NAN
+
+
+def parse_values(values) -> array.array:
+    """
+    Converts a payload series to an ``array('d')``, NaN for '``--``' gaps
+    """
+    return array.array('d', [NAN if value == GAP else parse_value(value) for value in values or ()])
+
+
+def format_value(value: float) -> str:
+    """
+    Converts a value back to a payload string, without losing digits. Whole numbers have no decimals
+    """
+    if math.isnan(value):
+        return GAP
+    text = repr(value)
+    return text[:-2] if text.endswith('.0') else text
+
+
+class EnergyBalance:
+    """
+    Energy balance of a plant, or of several plants, for a period.
+
+    ``on_grid``, ``buy``, ``product`` and ``use`` are the totals of the period in kWh, NaN when not reported.
+    ``product_power`` and ``use_power`` are the 5-minute series of a day in kW (the daily, or monthly, values for
+    longer periods), NaN for gaps, and ``valid`` flags the slots where ``product_power`` is reported.
+    ``stale`` marks data served from an expired cache entry. Records are not modified once created, ``replace``
+    returns a modified copy.
+    """
+    __slots__ = ('stat_type', 'period', 'on_grid', 'buy', 'product', 'use', 'product_power', 'use_power',
+                 'valid', 'stale', 'other')
+
+    def __init__(self, stat_type: str = 'day', period: datetime.datetime = None, on_grid: float = NAN,
+                 buy: float = NAN, product: float = NAN, use: float = NAN, product_power: array.array = None,
+                 use_power: array.array = None, valid: bytes = None, stale: bool = False, other: dict = None):
+        """
+        :param stat_type: '``day``', '``month``', '``year``' or '``lifetime``'
+        :param period: start of the period
+        :param on_grid: energy sold [kWh]
+        :param buy: energy bought [kWh]
+        :param product: energy produced [kWh]
+        :param use: energy used [kWh]
+        :param product_power: produced power series [kW]
+        :param use_power: used power series [kW]
+        :param valid: [optional] flags of the slots with produced power, computed if not provided
+        :param stale: data of an expired cache entry
+        :param other: other fields of the payload, unparsed
+        """
+        self.stat_type = stat_type
+        self.period = period
+        self.on_grid = on_grid
+        self.buy = buy
+        self.product = product
+        self.use = use
+        self.product_power = product_power if product_power is not None else array.array('d')
+        self.use_power = use_power if use_power is not None else array.array('d')
+        self.valid = valid if valid is not None else bytes(value == value for value in self.product_power)
+        self.stale = stale
+        self.other = other or {}
+
+    @classmethod
+    def from_payload(cls, data: dict, stat_type: str = 'day', period: datetime.datetime = None,
+                     stale: bool = False) -> 'EnergyBalance':
+        """
+        Parses the ``data`` of an ``energy-balance`` response, as returned by ``get_plant_stats``
+        """
+        values = {attribute: parse_value(data.get(field)) for field, attribute in TOTALS.items()}
+        values.update({attribute: parse_values(data.get(field)) for field, attribute in SERIES.items()})
+        # The labels of the 5-minute slots are generated again by to_dict
+        skipped = set(TOTALS) | set(SERIES) | ({'xAxis', 'stale'} if stat_type == 'day' else {'stale'})
+        other = {key: value for key, value in data.items() if key not in skipped}
+        return cls(stat_type, period, stale=stale or bool(data.get('stale')), other=other, **values)
+
+    def to_dict(self) -> dict:
+        """
+        Returns the balance in the format of the ``energy-balance`` payload
+        """
+        data = dict(self.other)
+        for field, attribute in TOTALS.items():
+            data[field] = format_value(getattr(self, attribute))
+        for field, attribute in SERIES.items():
+            if getattr(self, attribute):
+                data[field] = [format_value(value) for value in getattr(self, attribute)]
+        if self.stat_type == 'day' and self.period is not None and self.product_power:
+            data['xAxis'] = [self.slot_label(idx) for idx in range(len(self.product_power))]
+        if self.stale:
+            data['stale'] = True
+        return data
+
+    def replace(self, **changes) -> 'EnergyBalance':
+        """
+        Returns a copy with some attributes changed
+        """
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(changes)
+        if 'product_power' in changes and 'valid' not in changes:
+            values['valid'] = None
+        return EnergyBalance(**values)
+
+    @classmethod
+    def aggregate(cls, balances: list) -> 'EnergyBalance':
+        """
+        Sums the balances of several plants for the same period.
+        A total not reported by a plant counts as 0, unless no plant reports it. A slot of a series is NaN if it is
+        NaN for any plant. The result is stale if any balance is stale
+        """
+        first = balances[0]
+        if len(balances) == 1:
+            return first
+        totals = {}
+        for attribute in TOTALS.values():
+            values = [value for value in (getattr(balance, attribute) for balance in balances) if not math.isnan(value)]
+            totals[attribute] = math.fsum(values) if values else NAN
+        series = {attribute: array.array('d', map(sum, zip(*(getattr(balance, attribute) for balance in balances))))
+                  for attribute in SERIES.values()}
+        return cls(first.stat_type, first.period, stale=any(balance.stale for balance in balances),
+                   other=first.other, **totals, **series)
+
+    def slot_label(self, idx: int) -> str:
+        """
+        Returns the ``YYYY-MM-DD HH:MM`` label of a 5-minute slot of a day
+        """
+        minutes = idx * SLOT_MINUTES
+        return f'{self.period:%Y-%m-%d} {minutes // 60:02d}:{minutes % 60:02d}'
+
+    def slot(self, idx: int) -> tuple:
+        """
+        Returns the ``(product_power, use_power)`` of a slot, NaN for gaps
+        """
+        use_power = self.use_power[idx] if idx < len(self.use_power) else NAN
+        return self.product_power[idx], use_power
+
+    def last_valid(self, before: int = None):
+        """
+        Returns the index of the last slot with produced power before ``before`` (included), or None
+        """
+        end = len(self.valid) if before is None else min(before + 1, len(self.valid))
+        idx = self.valid.rfind(b'\x01', 0, end)
+        return idx if idx >= 0 else None
+
+    def ratio(self) -> float:
+        """
+        Returns the sold to bought energy ratio, 0 when it cannot be calculated, as the controller did with the
+        payload strings
+        """
+        if math.isnan(self.on_grid) or math.isnan(self.buy) or self.buy == 0.0:
+            return 0.0
+        return self.on_grid / self.buy
+
+    def __repr__(self):
+        return (f'EnergyBalance({self.stat_type}, {self.period}, on_grid={self.on_grid}, buy={self.buy}, '
+                f'product={self.product}, use={self.use}, slots={len(self.product_power)}'
+                f'{", stale" if self.stale else ""})')
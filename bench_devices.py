@@ -0,0 +1,62 @@
+"""
+Micro-benchmark of the MQTT message callbacks of the devices module.
+
+Synthetic ``MQTTMessage`` objects are pushed straight through ``_on_message``, without any broker,
+and the throughput is reported in messages per second. Usage::
+
+    python -m bench_devices [--messages 200000] [--plugs 50]
+"""
+import argparse
+import random
+import time
+
+import paho.mqtt.client as mqtt
+
+import devices
+
+
+def make_messages(device_ids: list, count: int) -> list:
+    """
+    Builds a list of messages with the topic mix of Shelly Plug S devices reporting power every second
+    """
+    messages = []
+    for i in range(count):
+        device_id = random.choice(device_ids)
+        subtopic, payload = random.choices([('relay/0/power', f'{random.uniform(0, 2000):.2f}'),
+                                            ('temperature', f'{random.uniform(20, 60):.1f}'),
+                                            ('relay/0', random.choice(['on', 'off']))],
+                                           weights=[8, 1, 1])[0]
+        message = mqtt.MQTTMessage(topic=f'shellies/{device_id}/{subtopic}'.encode())
+        message.payload = payload.encode()
+        messages.append(message)
+    return messages
+
+
+def run(on_message, messages: list) -> float:
+    """
+    Pushes the messages through the callback
+    :return: messages per second
+    """
+    start = time.perf_counter()
+    for message in messages:
+        on_message(None, None, message)
+    return len(messages) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the MQTT message callbacks')
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--plugs', type=int, default=50)
+    args = parser.parse_args()
+
+    plug = devices.PlugDevice('user', 'password', 'localhost', 'shellyplug-s-000000')
+    plug.build_handlers()
+    plug_rate = run(plug._on_message, make_messages([plug.mqtt_device_id], args.messages))
+    print(f'PlugDevice: {plug_rate:,.0f} messages/s')
+
+    fleet = devices.PlugFleet('user', 'password', 'localhost')
+    device_ids = [f'shellyplug-s-{i:06d}' for i in range(args.plugs)]
+    for device_id in device_ids:
+        fleet.add_plug(device_id)
+    fleet_rate = run(fleet._on_message, make_messages(device_ids + ['shellyplug-s-unknown'], args.messages))
+    print(f'PlugFleet ({args.plugs} plugs): {fleet_rate:,.0f} messages/s')
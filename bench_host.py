@@ -0,0 +1,91 @@
+"""
+Benchmark of the multi-site host against the local FusionSolar stand-in.
+
+A ``ControllerHost`` is built with ``--sites`` sites spread over ``--accounts`` FusionSolar accounts, and the
+memory allocated per site is compared with a standalone controller per site. Then every site takes ``--rounds``
+decisions and the CPU time per decision and the HTTP requests per decision are reported. The MQTT plugs are
+created but never connected. Usage::
+
+    python -m bench_host --sites 300 --accounts 10 --rounds 3 --ttl 60
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import bench_tick
+import fusion_solar_stub
+import host
+import solar
+
+
+def build_host(stub: fusion_solar_stub.FusionSolarStub, sites: int, accounts: int, ttl: float) -> host.ControllerHost:
+    """
+    Creates a host whose FusionSolar clients talk to the stand-in. Stored sessions are used so the clients start
+    without logging in
+    """
+    session_dir = tempfile.mkdtemp()
+    for idx in range(accounts):
+        user = f'bench{idx}'
+        solar.SessionStore(host.session_path(session_dir, user)).save(user, 'uni001eu5', cookies={'bench': '1'},
+                                                                       company_id='NE=1', plant_ids=stub.plant_ids)
+    bench_host = host.ControllerHost(cache_ttl=ttl, session_dir=session_dir)
+    for idx in range(sites):
+        bench_host.add_site(f'site{idx}', {'huawei_user': f'bench{idx % accounts}', 'huawei_password': 'bench',
+                                           'mqtt_user': 'bench', 'mqtt_password': 'bench',
+                                           'mqtt_broker': '127.0.0.1', 'mqtt_device_id': f'shellyplug-s-{idx:06X}',
+                                           'buy_price': '0.2', 'sell_price': '0.05', 'exclusion_time': '20-23'})
+    for account in bench_host.accounts.values():
+        fusion_solar_stub.redirect_client(account.client, stub.url)
+    return bench_host
+
+
+def allocated_kib(func, *args):
+    """
+    Calls ``func`` and returns its result and the memory it allocated and kept, in KiB
+    """
+    tracemalloc.start()
+    result = func(*args)
+    kept, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, kept / 1024
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Multi-site host benchmark against the FusionSolar stand-in')
+    parser.add_argument('--sites', type=int, default=300)
+    parser.add_argument('--accounts', type=int, default=10)
+    parser.add_argument('--rounds', type=int, default=3, help='decisions taken by every site')
+    parser.add_argument('--ttl', type=float, default=60.0, help='TTL of the stats caches [s]')
+    parser.add_argument('--latency', type=float, default=0.0, help='stand-in latency per request [s]')
+    parser.add_argument('--standalone', type=int, default=10, help='standalone controllers built for comparison')
+    args = parser.parse_args()
+
+    bench_stub = fusion_solar_stub.FusionSolarStub(latency=args.latency).start()
+    threads_before = threading.active_count()
+    controller_host, host_kib = allocated_kib(build_host, bench_stub, args.sites, args.accounts, args.ttl)
+    threads = threading.active_count() - threads_before
+    _, standalone_kib = allocated_kib(lambda: [bench_tick.build_controller(bench_stub, args.ttl)
+                                               for _ in range(args.standalone)])
+
+    requests_before = bench_stub.request_count()
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    for _ in range(args.rounds):
+        for controller in controller_host.sites.values():
+            controller.activate_permission()
+    decisions = args.rounds * args.sites
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+    requests = bench_stub.request_count() - requests_before
+    bench_stub.stop()
+
+    print(f'Sites: {args.sites}, accounts: {args.accounts}, MQTT connections: {len(controller_host.fleets)}, '
+          f'threads started: {threads}')
+    print(f'Memory per site: {host_kib / args.sites:.1f} KiB (standalone controller: '
+          f'{standalone_kib / args.standalone:.1f} KiB)')
+    print(f'CPU per decision: {cpu / decisions * 1000:.2f} ms, wall: {wall / decisions * 1000:.2f} ms, '
+          f'requests per decision: {requests / decisions:.3f}')
+    print(f'Decisions per CPU second: {decisions / cpu:.0f}, sites per core at a 300 s period: '
+          f'{300 * decisions / cpu:.0f}')
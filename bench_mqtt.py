@@ -0,0 +1,160 @@
+"""
+MQTT load test of the devices module against the local broker stand-in and a swarm of simulated Shelly plugs.
+
+For every swarm size of ``--plugs``, the plugs are controlled through a single ``PlugFleet`` connection
+(``--mode fleet``) or one ``PlugDevice`` connection each (``--mode devices``) for ``--duration`` seconds, while
+relay commands are sent at ``--command-rate`` per second. Then the broker drops all the connections and the time
+until the clients are connected and receiving again is measured. Reported per size: messages received per second,
+CPU time of the MQTT network threads per message, command-to-state latency percentiles and failed commands, and the
+reconnection times. Usage::
+
+    python -m bench_mqtt --plugs 10,100,1000 --power-interval 1 --duration 10 --command-rate 20
+"""
+import argparse
+import logging
+import random
+import time
+
+import bench_tick
+import devices
+import mqtt_stub
+
+
+def thread_cpu(connection: devices.MqttConnection) -> float:
+    """
+    Returns the CPU time of the network thread of a connection, where the message callbacks run [s]
+    """
+    thread = connection.mqtt_client._thread
+    if thread is None or thread.ident is None:
+        return 0.0
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(thread.ident))
+    except (AttributeError, OSError):
+        # Not available on this platform, or the thread ended
+        return 0.0
+
+
+def wait_for(condition, timeout: float) -> float:
+    """
+    Waits until ``condition()`` is true
+    :return: seconds waited, or None on timeout
+    """
+    t_start = time.monotonic()
+    while not condition():
+        if time.monotonic() - t_start > timeout:
+            return None
+        time.sleep(0.001)
+    return time.monotonic() - t_start
+
+
+def connect_clients(broker: mqtt_stub.MqttBrokerStub, device_ids: list, mode: str) -> tuple:
+    """
+    Creates and connects the clients of the plugs
+    :return: list of connections, dict mapping the device ids to their plug objects
+    """
+    host, port = broker.address
+    if mode == 'fleet':
+        fleet = devices.PlugFleet('bench', 'bench', host, port, mqtt_client_id=f'bench_fleet_{len(device_ids)}')
+        plugs = {device_id: fleet.add_plug(device_id) for device_id in device_ids}
+        fleet.subscribe_once()
+        connections = [fleet]
+    else:
+        plugs = {device_id: devices.PlugDevice('bench', 'bench', host, device_id, mqtt_port=port,
+                                               mqtt_client_id=f'bench_{device_id}') for device_id in device_ids}
+        for plug in plugs.values():
+            plug.subscribe_to_device()
+        connections = list(plugs.values())
+    wait_for(lambda: all(connection.is_connected() for connection in connections), 10.0)
+    return connections, plugs
+
+
+def received(connections: list) -> float:
+    return sum(connection._messages_metric.get() for connection in connections)
+
+
+def run_size(size: int, args) -> dict:
+    """
+    Runs the load test with ``size`` simulated plugs
+    """
+    broker = mqtt_stub.MqttBrokerStub().start()
+    swarm = mqtt_stub.ShellySwarm(broker, power_interval=args.power_interval,
+                                  temperature_interval=args.power_interval * 10,
+                                  state_interval=args.power_interval * 10, response_delay=args.response_delay)
+    device_ids = [plug.mqtt_device_id for plug in swarm.add_plugs(size)]
+    connections, plugs = connect_clients(broker, device_ids, args.mode)
+    swarm.start()
+    # Every plug reports at least once before measuring
+    time.sleep(args.power_interval)
+
+    rng = random.Random(0)
+    futures = []
+    received_before, published_before = received(connections), swarm.published
+    cpu_before = sum(thread_cpu(connection) for connection in connections)
+    t_start = time.monotonic()
+    next_command = t_start
+    while time.monotonic() - t_start < args.duration:
+        if args.command_rate > 0 and time.monotonic() >= next_command:
+            plug = plugs[rng.choice(device_ids)]
+            futures.append(plug.device_off() if plug.state == 'on' else plug.device_on())
+            next_command += 1 / args.command_rate
+        time.sleep(0.001)
+    wall = time.monotonic() - t_start
+    messages = received(connections) - received_before
+    cpu = sum(thread_cpu(connection) for connection in connections) - cpu_before
+    published = swarm.published - published_before
+
+    latencies, failed = [], 0
+    for future in futures:
+        try:
+            latencies.append(future.result(timeout=30))
+        except devices.CommandTimeout:
+            failed += 1
+        except Exception:
+            # Superseded by the opposite command
+            continue
+
+    # Reconnection after the broker drops all the connections
+    connects = devices.MQTT_CONNECTS
+    connects_before = sum(connects.labels(client=connection.mqtt_client_id).get() for connection in connections)
+    broker.drop_connections()
+    reconnect = wait_for(lambda: sum(connects.labels(client=connection.mqtt_client_id).get()
+                                     for connection in connections) >= connects_before + len(connections), 60.0)
+    messages_before = received(connections)
+    resumed = wait_for(lambda: received(connections) > messages_before, 60.0)
+
+    swarm.stop()
+    for connection in connections:
+        connection.disconnect()
+        connection.mqtt_client.loop_stop()
+    broker.stop()
+    result = {'plugs': size, 'connections': len(connections), 'published/s': published / wall,
+              'received/s': messages / wall, 'cpu us/msg': cpu / messages * 1e6 if messages else float('nan'),
+              'commands': len(futures), 'failed': failed, 'reconnect s': reconnect,
+              'resumed s': resumed + reconnect if resumed is not None and reconnect is not None else None}
+    if len(latencies) >= 2:
+        result.update({key: value * 1000 for key, value in bench_tick.percentiles(latencies).items()})
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='MQTT load test against the broker stand-in and simulated plugs')
+    parser.add_argument('--plugs', default='10,100,1000', help='comma separated swarm sizes')
+    parser.add_argument('--mode', choices=('fleet', 'devices'), default='fleet',
+                        help='one PlugFleet connection, or one PlugDevice connection per plug')
+    parser.add_argument('--power-interval', type=float, default=1.0, help='seconds between power reports of a plug')
+    parser.add_argument('--response-delay', type=float, default=0.05, help='command to state delay of a plug [s]')
+    parser.add_argument('--duration', type=float, default=10.0, help='measured seconds per size')
+    parser.add_argument('--command-rate', type=float, default=20.0, help='relay commands per second')
+    args = parser.parse_args()
+    # The disconnections caused by the test are logged as warnings
+    logging.basicConfig(level=logging.ERROR)
+
+    print(f'{"plugs":>7}{"conns":>7}{"pub/s":>9}{"recv/s":>9}{"us/msg":>8}{"cmds":>6}{"failed":>7}'
+          f'{"p50 [ms]":>10}{"p95 [ms]":>10}{"p99 [ms]":>10}{"reconn [s]":>12}{"resumed [s]":>12}')
+    for swarm_size in (int(size) for size in args.plugs.split(',')):
+        figures = run_size(swarm_size, args)
+        print(f'{figures["plugs"]:>7}{figures["connections"]:>7}{figures["published/s"]:>9.0f}'
+              f'{figures["received/s"]:>9.0f}{figures["cpu us/msg"]:>8.1f}{figures["commands"]:>6}'
+              f'{figures["failed"]:>7}{figures.get("p50", float("nan")):>10.1f}'
+              f'{figures.get("p95", float("nan")):>10.1f}{figures.get("p99", float("nan")):>10.1f}'
+              f'{figures["reconnect s"] or float("nan"):>12.2f}{figures["resumed s"] or float("nan"):>12.2f}')
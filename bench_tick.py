@@ -0,0 +1,97 @@
+"""
+End-to-end benchmark of the controller decision against the local FusionSolar stand-in.
+
+``PowerDevice.get_overview`` and ``HotWaterTank.activate_permission`` are run repeatedly and the tick
+latency percentiles, the HTTP requests per decision and the memory allocated per tick are reported.
+The MQTT plug is created but never connected. Usage::
+
+    python -m bench_tick --ticks 200 --latency 0.05 --error-rate 0.01 --ttl 0 --plants 1 --retries 2
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import fusion_solar_stub
+import hot_water_tank
+import solar
+
+
+def percentiles(samples: list) -> dict:
+    cuts = statistics.quantiles(samples, n=100, method='inclusive')
+    return {'p50': cuts[49], 'p95': cuts[94], 'p99': cuts[98]}
+
+
+def measure(name: str, stub: fusion_solar_stub.FusionSolarStub, func, ticks: int) -> dict:
+    """
+    Runs ``func`` ``ticks`` times and reports latency, requests and allocations per tick
+    """
+    latencies = []
+    allocated = []
+    errors = 0
+    requests_before = stub.request_count()
+    tracemalloc.start()
+    for _ in range(ticks):
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        t_start = time.perf_counter()
+        try:
+            func()
+        except Exception:
+            errors += 1
+        latencies.append(time.perf_counter() - t_start)
+        allocated.append(tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+    result = {name: {key: value * 1000 for key, value in percentiles(latencies).items()}}
+    result[name]['requests/tick'] = (stub.request_count() - requests_before) / ticks
+    result[name]['peak KiB/tick'] = statistics.mean(allocated) / 1024
+    result[name]['errors'] = errors
+    return result
+
+
+def build_controller(stub: fusion_solar_stub.FusionSolarStub, ttl: float,
+                     http_policy: solar.HttpPolicy = None) -> hot_water_tank.HotWaterTank:
+    """
+    Creates a controller whose FusionSolar client talks to the stand-in. A stored session is used so the
+    client starts without logging in
+    """
+    session_store = solar.SessionStore(os.path.join(tempfile.mkdtemp(), 'session'))
+    session_store.save('bench', 'uni001eu5', cookies={'bench': '1'}, company_id='NE=1',
+                       plant_ids=stub.plant_ids)
+    controller = hot_water_tank.HotWaterTank('bench', 'bench', stats_cache=solar.StatsCache(ttl=ttl),
+                                             session_store=session_store, http_policy=http_policy,
+                                             mqtt_user='bench', mqtt_password='bench',
+                                             mqtt_broker='127.0.0.1', mqtt_device_id='bench')
+    fusion_solar_stub.redirect_client(controller.energy_device.client, stub.url)
+    return controller
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Controller tick benchmark against the FusionSolar stand-in')
+    parser.add_argument('--ticks', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.0, help='stand-in latency per request [s]')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--gap-rate', type=float, default=0.0)
+    parser.add_argument('--ttl', type=float, default=0.0, help='TTL of the stats cache, 0 to disable it [s]')
+    parser.add_argument('--plants', type=int, default=1, help='number of plants aggregated by the controller')
+    parser.add_argument('--read-timeout', type=float, default=20.0, help='read timeout of the requests [s]')
+    parser.add_argument('--retries', type=int, default=2, help='attempts after a failed request')
+    args = parser.parse_args()
+
+    plant_ids = [fusion_solar_stub.PLANT_ID] + [f'NE={idx}' for idx in range(1, args.plants)]
+    bench_stub = fusion_solar_stub.FusionSolarStub(latency=args.latency, error_rate=args.error_rate,
+                                                   gap_rate=args.gap_rate, plant_ids=plant_ids).start()
+    bench_policy = solar.HttpPolicy(read_timeout=args.read_timeout, retries=args.retries)
+    bench_controller = build_controller(bench_stub, args.ttl, bench_policy)
+    results = {}
+    results.update(measure('get_overview', bench_stub, bench_controller.energy_device.get_overview, args.ticks))
+    results.update(measure('activate_permission', bench_stub, bench_controller.activate_permission, args.ticks))
+    bench_stub.stop()
+
+    print(f'{"":<22}{"p50 [ms]":>10}{"p95 [ms]":>10}{"p99 [ms]":>10}{"req/tick":>10}{"KiB/tick":>10}{"errors":>8}')
+    for bench_name, figures in results.items():
+        print(f'{bench_name:<22}{figures["p50"]:>10.2f}{figures["p95"]:>10.2f}{figures["p99"]:>10.2f}'
+              f'{figures["requests/tick"]:>10.2f}{figures["peak KiB/tick"]:>10.1f}{figures["errors"]:>8}')
+    print(f'Requests by endpoint: {dict(bench_stub.requests)}')
@@ -0,0 +1,281 @@
+"""
+Live reload of the configuration file.
+
+``ConfigWatcher`` checks the modification time of *heater_config.ini* as a job of the controller scheduler, and
+applies the changed options to the running controllers without restarting them:
+
+- prices, tariffs, exclusion windows and holidays of ``[ENERGY]``: the new schedule is validated, then replaces the
+  previous one at once, so a decision never sees a partial change
+- the ``[TIMER]`` periods, and ``logging_level`` of ``[DEFAULT]``
+- credentials and plants of ``[HUAWEI]``: a new ``PowerDevice`` replaces the previous one, logging in again only if
+  the account changed. The MQTT connection is kept
+- broker, port and credentials of ``[MQTT]``: the plug connects again and its subscriptions are restored. The
+  FusionSolar session is kept
+
+In host mode the prices and timers of each ``[site:<name>]`` are applied the same way. Other changes are logged as
+applied on restart. A file that cannot be parsed, or an invalid value, is logged and the running configuration of
+the affected subsystem is kept.
+"""
+import configparser
+import logging
+import os
+import time
+
+import host
+import metrics
+import solar
+
+
+CONFIG_RELOADS = metrics.counter('config_reloads_total', 'Configuration file reloads by result', ['result'])
+
+LOGGING_LEVELS = {'DEBUG': logging.DEBUG, 'INFO': logging.INFO, 'WARNING': logging.WARNING, 'ERROR': logging.ERROR}
+ENERGY_OPTIONS = ('buy_price', 'sell_price', 'exclusion_time', 'buy_tariff', 'sell_tariff', 'holidays')
+TIMER_OPTIONS = ('adaptive', 'min_period', 'max_period')
+HUAWEI_OPTIONS = ('huawei_user', 'huawei_password', 'plants')
+MQTT_OPTIONS = ('mqtt_user', 'mqtt_password', 'mqtt_broker', 'mqtt_port')
+# Options applied live to a single-site controller, which owns its FusionSolar device and MQTT connection
+SINGLE_OPTIONS = ENERGY_OPTIONS + TIMER_OPTIONS + HUAWEI_OPTIONS + MQTT_OPTIONS
+
+
+def read_config(path: str) -> configparser.ConfigParser:
+    """
+    Parses a configuration file
+    :raise OSError if the file cannot be read, configparser.Error if it is not valid
+    """
+    config = configparser.ConfigParser()
+    with open(path) as config_file:
+        config.read_file(config_file)
+    return config
+
+
+def changed_options(old: dict, new: dict) -> dict:
+    """
+    Returns the options whose value changed, with their new value (None if removed)
+    """
+    return {option: new.get(option) for option in old.keys() | new.keys() if old.get(option) != new.get(option)}
+
+
+def section_options(config: configparser.ConfigParser, section: str) -> dict:
+    if section == configparser.DEFAULTSECT:
+        return dict(config.defaults())
+    return dict(config[section]) if config.has_section(section) else {}
+
+
+class ConfigWatcher:
+    """
+    Applies the changes of the configuration file to a running ``HotWaterTank`` (or ``FleetController``), or to the
+    sites of a ``ControllerHost``
+    """
+
+    def __init__(self, path: str, controller=None, controller_host: host.ControllerHost = None,
+                 interval: float = 5.0, sites_path: str = None):
+        """
+        :param path: configuration file
+        :param controller: controller the changes are applied to, in single-site mode
+        :param controller_host: host whose sites the changes are applied to, in host mode
+        :param interval: seconds between two checks of the file
+        :param sites_path: [optional] directory or file of the host sites, see ``host.load_sites``
+        """
+        self.path = path
+        self.controller = controller
+        self.controller_host = controller_host
+        self.interval = interval
+        self.sites_path = sites_path
+        self.reloads = 0
+        self.last_duration = None   # Time to apply the last reload [s]
+        self._stamp = self._file_stamp()
+        self._config = read_config(path)
+        # Options applied to the running sites by site name, None in single-site mode
+        if controller_host is not None:
+            self._sites = host.load_sites(self._config, sites_path)
+        else:
+            self._sites = {None: host.site_options(self._config)}
+        self._job = None
+        self._logger = logging.getLogger(__name__)
+
+    def start(self, controller_scheduler) -> 'ConfigWatcher':
+        """
+        Checks the file every ``interval`` seconds as a job of ``controller_scheduler``
+        """
+        self._job = controller_scheduler.add_job('config_watch', self.check, self.interval, delay=self.interval)
+        return self
+
+    def _file_stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def check(self) -> bool:
+        """
+        Reloads the file if it changed since the last check
+        :return: True if the changes were applied
+        """
+        stamp = self._file_stamp()
+        if stamp is None or stamp == self._stamp:
+            return False
+        self._stamp = stamp
+        try:
+            config = read_config(self.path)
+        except (OSError, configparser.Error) as e:
+            self._logger.error(f'Configuration not reloaded, the file is not valid: {e}')
+            CONFIG_RELOADS.labels(result='invalid').inc()
+            return False
+        return self.apply(config)
+
+    def apply(self, config: configparser.ConfigParser) -> bool:
+        """
+        Applies the differences between ``config`` and the running configuration. Each subsystem is updated on its
+        own: if a value is not valid the error is logged and the subsystem keeps its configuration
+        :return: True if all the changes were applied
+        """
+        t_start = time.perf_counter()
+        old, self._config = self._config, config
+        applied = self._apply_logging(changed_options(old.defaults(), config.defaults()))
+        if self.controller_host is not None:
+            applied &= self._apply_sites(config)
+        else:
+            options = host.site_options(config)
+            site_applied, not_applied = self._apply_site(self.controller, changed_options(self._sites[None], options),
+                                                         options, single=True)
+            self._sites[None] = self._running_options(self._sites[None], options, not_applied)
+            applied &= site_applied
+        for section in sorted(set(old.sections()) | set(config.sections())):
+            if section.startswith(host.SITE_PREFIX) and self.controller_host is not None:
+                continue
+            changes = changed_options(section_options(old, section), section_options(config, section))
+            # Options of the sections of the single-site configuration are also the defaults of the host sites, they
+            # are reported with the changes of the sites
+            restart = sorted(option for option in changes
+                             if option not in config.defaults() and option not in old.defaults()
+                             and host.SITE_OPTIONS.get(option) != section)
+            if restart:
+                self._logger.warning(f'Changes of [{section}] {restart} are applied on restart')
+
+        self.reloads += 1
+        self.last_duration = time.perf_counter() - t_start
+        CONFIG_RELOADS.labels(result='applied' if applied else 'failed').inc()
+        self._logger.info(f'Configuration reloaded in {self.last_duration * 1000:.1f} ms')
+        return applied
+
+    def _apply_logging(self, changes: dict) -> bool:
+        other = sorted(option for option in changes if option != 'logging_level')
+        if other:
+            self._logger.warning(f'Changes of [DEFAULT] {other} are applied on restart')
+        if 'logging_level' not in changes:
+            return True
+        level = changes['logging_level']
+        if level not in LOGGING_LEVELS:
+            self._logger.error(f'Unknown logging level `{level}`, the level is not changed')
+            return False
+        logging.getLogger().setLevel(LOGGING_LEVELS[level])
+        self._logger.info(f'Logging level set to {level}')
+        return True
+
+    def _apply_sites(self, config: configparser.ConfigParser) -> bool:
+        try:
+            sites = host.load_sites(config, self.sites_path)
+        except ValueError as e:
+            self._logger.error(f'Sites not reloaded: {e}')
+            return False
+        added = sorted(set(sites) - set(self._sites))
+        removed = sorted(set(self._sites) - set(sites))
+        if added or removed:
+            self._logger.warning(f'Sites added {added} or removed {removed} are applied on restart')
+        applied = True
+        for name, options in sites.items():
+            if name in self._sites and name in self.controller_host.sites:
+                site_applied, not_applied = self._apply_site(self.controller_host.sites[name],
+                                                             changed_options(self._sites[name], options), options,
+                                                             site=name)
+                self._sites[name] = self._running_options(self._sites[name], options, not_applied)
+                applied &= site_applied
+        return applied
+
+    @staticmethod
+    def _running_options(running: dict, options: dict, not_applied: set) -> dict:
+        """
+        Returns the options the site runs with: the new ones, except those not applied that keep their running
+        value, so they are compared and reported again on the next reload
+        """
+        result = {option: value for option, value in options.items() if option not in not_applied}
+        result.update({option: running[option] for option in not_applied if option in running})
+        return result
+
+    def _apply_site(self, controller, changes: dict, options: dict, single: bool = False, site: str = None) -> tuple:
+        """
+        Applies the changed options of a site to its controller
+        :param controller: controller of the site
+        :param changes: changed options, see ``changed_options``
+        :param options: all the options of the site, as returned by ``host.site_options``
+        :param single: the controller owns its FusionSolar device and MQTT connection
+        :param site: [optional] site name for the log
+        :return: ``(applied, not_applied)``: False if a change could not be applied, and the set of the changed
+            options not applied, either invalid or applied on restart
+        """
+        suffix = f' of site `{site}`' if site else ''
+        live_options = SINGLE_OPTIONS if single else ENERGY_OPTIONS + TIMER_OPTIONS
+        not_applied = {option for option in changes if option not in live_options}
+        if not_applied:
+            self._logger.warning(f'Changes of {sorted(not_applied)}{suffix} are applied on restart')
+        applied = True
+        for group, apply in ((ENERGY_OPTIONS, self._apply_energy), (TIMER_OPTIONS, self._apply_timer),
+                             (HUAWEI_OPTIONS, self._apply_huawei), (MQTT_OPTIONS, self._apply_mqtt)):
+            group_changes = sorted(option for option in changes if option in group and option in live_options)
+            if not group_changes:
+                continue
+            try:
+                apply(controller, options)
+            except Exception as e:
+                # The subsystem keeps running with its previous configuration
+                applied = False
+                not_applied.update(group_changes)
+                self._logger.error(f'Could not apply the changes of {group_changes}{suffix}: {e!r}')
+            else:
+                self._logger.info(f'Applied the changes of {group_changes}{suffix}')
+        return applied, not_applied
+
+    @staticmethod
+    def _apply_energy(controller, options: dict) -> None:
+        energy = {'buy_price': float(options['buy_price']), 'sell_price': float(options['sell_price']),
+                  'exclusion_time': options.get('exclusion_time', ''), 'buy_tariff': options.get('buy_tariff'),
+                  'sell_tariff': options.get('sell_tariff'), 'holidays': options.get('holidays')}
+        if energy['sell_price'] == 0.0:
+            raise ZeroDivisionError('Sell energy price cannot be 0.0')
+        # An invalid rule leaves the running schedule unchanged, the update replaces the tables at once
+        controller.schedule.update(**energy)
+
+    @staticmethod
+    def _apply_timer(controller, options: dict) -> None:
+        min_period = float(options.get('min_period', controller.min_period))
+        max_period = float(options.get('max_period', controller.max_period))
+        if not 0 < min_period <= max_period:
+            raise ValueError(f'Invalid timer periods: min_period {min_period}, max_period {max_period}')
+        controller.adaptive = configparser.ConfigParser.BOOLEAN_STATES.get(options.get('adaptive', 'true').lower(),
+                                                                            False)
+        controller.min_period = min_period
+        controller.max_period = max_period
+
+    @staticmethod
+    def _apply_huawei(controller, options: dict) -> None:
+        plants = [plant_id.strip() for plant_id in options.get('plants', '').split(',') if plant_id.strip()]
+        current = controller.energy_device
+        client = current.client
+        same_account = options['huawei_user'] == client._user and options['huawei_password'] == client._password
+        # A new account logs in, using the stored session if it is the one of the user. The previous device is used
+        # by the decisions until it is replaced
+        energy_device = solar.PowerDevice(options['huawei_user'], options['huawei_password'],
+                                          stats_cache=client.stats_cache, series_store=current.series_store,
+                                          session_store=client.session_store, plants=plants,
+                                          plant_timeout=current.plant_timeout, http_policy=client.http_policy,
+                                          client=client if same_account else None)
+        controller.energy_device = energy_device
+        if controller.planner is not None:
+            controller.planner.forecaster.set_plants(energy_device.plant_ids)
+        current.close()
+
+    @staticmethod
+    def _apply_mqtt(controller, options: dict) -> None:
+        controller.plug.reconnect(mqtt_user=options['mqtt_user'], mqtt_password=options['mqtt_password'],
+                                  mqtt_broker=options['mqtt_broker'], mqtt_port=int(options.get('mqtt_port', 1883)))
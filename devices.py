@@ -1,44 +1,58 @@
+import abc
+import collections
+import concurrent.futures
+import datetime
 import socket
+import threading
 
 import paho.mqtt.client as mqtt
 import logging
 import time
 
+import metering
+import metrics
 
-class PlugDevice:
+
+MQTT_MESSAGES = metrics.counter('mqtt_messages_total', 'MQTT messages received', ['client'])
+MQTT_CONNECTS = metrics.counter('mqtt_connects_total', 'Connections to the MQTT broker, including reconnects',
+                                ['client'])
+MQTT_DISCONNECTS = metrics.counter('mqtt_disconnects_total', 'Unexpected disconnections from the MQTT broker',
+                                   ['client'])
+PLUG_COMMANDS = metrics.counter('plug_commands_total', 'Relay commands by result', ['device', 'result'])
+PLUG_COMMAND_SECONDS = metrics.histogram('plug_command_latency_seconds',
+                                         'Time from the first publish of a relay command to its confirmation',
+                                         ['device'])
+
+
+class MqttConnection:
+    """
+    MQTT client connection shared by the plug devices
+    """
     def __init__(self, mqtt_user: str,
                  mqtt_password: str,
                  mqtt_broker: str,
-                 mqtt_device_id: str,
+                 mqtt_client_id: str,
                  mqtt_port: int = 1883,
                  mqtt_keepalive: int = 60,
                  mqtt_retain: bool = False,
                  mqtt_qos: int = 0):
-        """
-        Creates a plug device with an MQTT client to control a Shelly 1 Plug
-        :param mqtt_user:
-        :param mqtt_password:
-        :param mqtt_broker: broker IP address
-        :param mqtt_device_id: Shelly 1 Plug Id
-        :param mqtt_port: default 1883
-        """
         self.mqtt_user = mqtt_user
         self.mqtt_pwd = mqtt_password
         self.mqtt_broker_url = mqtt_broker
         self.mqtt_port = mqtt_port
-        self.mqtt_device_id = mqtt_device_id
+        self.mqtt_client_id = mqtt_client_id
         self.mqtt_keepalive = mqtt_keepalive
         self.mqtt_retain = mqtt_retain
         self._mqtt_qos = mqtt_qos
-        self.temperature = None
-        self.state = None
-        self.power = None
-        self._log_interval = 300
-        self._subscription_tstamps = {}
+        self._topic_list = []
+        self._handlers = {}
+        self._extra_handlers = {}
         self._last_connect_rc = None
-        self.mqtt_client = mqtt.Client('plug_controller')
+        self.mqtt_client = mqtt.Client(mqtt_client_id)
         self.mqtt_client.on_connect = self._on_connect
+        self.mqtt_client.on_disconnect = self._on_disconnect
         self.mqtt_client.on_message = self._on_message
+        self._messages_metric = MQTT_MESSAGES.labels(client=mqtt_client_id)
         self._logger = logging.getLogger(__name__)
 
     def connect(self) -> int:
@@ -71,45 +85,57 @@ class PlugDevice:
     def is_connected(self):
         return self.mqtt_client.is_connected()
 
-    def device_on(self):
-        if not self.is_connected():
-            self._logger.debug('Device On: Requesting connection')
-            self.connect()
-        if self.state == 'off' or self.state is None:
-            self._logger.info('Sending Device ON')
-            self.mqtt_client.publish(f'shellies/{self.mqtt_device_id}/relay/0/command', 'on')
-
-    def device_off(self):
-        if not self.is_connected():
-            self._logger.debug('Device Off: Requesting connection')
-            self.connect()
-        if self.state == 'on' or self.state is None:
-            self._logger.info('Sending Device OFF')
-            self.mqtt_client.publish(f'shellies/{self.mqtt_device_id}/relay/0/command', 'off')
+    def reconnect(self, mqtt_user: str = None, mqtt_password: str = None, mqtt_broker: str = None,
+                  mqtt_port: int = None) -> int:
+        """
+        Connects again with new credentials or to another broker. The subscriptions are restored on connection,
+        commands published meanwhile are retried by their acknowledgement timers
+        :return: MQTT error code of ``connect``
+        """
+        if mqtt_user is not None:
+            self.mqtt_user = mqtt_user
+        if mqtt_password is not None:
+            self.mqtt_pwd = mqtt_password
+        if mqtt_broker is not None:
+            self.mqtt_broker_url = mqtt_broker
+        if mqtt_port is not None:
+            self.mqtt_port = mqtt_port
+        if self.is_connected():
+            self.disconnect()
+        self.mqtt_client.loop_stop()
+        return self.connect()
 
-    def device_toggle(self):
-        if not self.is_connected():
-            self._logger.debug('Device Toggle: Requesting connection')
-            self.connect()
-        self._logger.info('Sending Device TOGGLE')
-        self.mqtt_client.publish(f'shellies/{self.mqtt_device_id}/relay/0/command', 'toggle')
+    def publish_status(self, topic: str, payload) -> None:
+        """
+        Publishes a status payload as a retained message
+        """
+        self.mqtt_client.publish(topic, payload, self._mqtt_qos, retain=True)
 
-    def subscribe_to_device(self):
+    def _subscribe(self, topic_list: list) -> bool:
         if not self.is_connected():
             self._logger.debug('Subscribe: Requesting connection')
             self.connect()
-        topic_list = [(f'shellies/{self.mqtt_device_id}/temperature', self._mqtt_qos),
-                      (f'shellies/{self.mqtt_device_id}/relay/0/power', self._mqtt_qos),
-                      (f'shellies/{self.mqtt_device_id}/relay/0', self._mqtt_qos),
-                      (f'plug/data', self._mqtt_qos),
-                      (f'plug/data/info', self._mqtt_qos)]
+        topic_list = topic_list + [(topic, self._mqtt_qos) for topic in self._extra_handlers]
+        self._topic_list = topic_list
         (result, mid) = self.mqtt_client.subscribe(topic_list)
         if result == mqtt.MQTT_ERR_SUCCESS:
-            for topic in topic_list:
-                self._subscription_tstamps[topic[0]] = time.time()
             self._logger.info(f'Subscribed to topics successful')
-        else:
-            self._logger.error(f'Subscription failed: MQTT client not connected')
+            return True
+        self._logger.error(f'Subscription failed: MQTT client not connected')
+        return False
+
+    def subscribe_topic(self, topic: str, handler) -> None:
+        """
+        Subscribes to an additional topic, e.g. the power reports of an external meter
+        :param topic: exact topic, without wildcards
+        :param handler: callable receiving the decoded payload, run in the MQTT network thread
+        """
+        self._extra_handlers[topic] = handler
+        self._handlers[topic] = handler
+        if topic not in (subscribed for subscribed, _ in self._topic_list):
+            self._topic_list = self._topic_list + [(topic, self._mqtt_qos)]
+            if self.is_connected():
+                self.mqtt_client.subscribe(topic, self._mqtt_qos)
 
     def _on_connect(self, client, userdata, flags, rc):
         if rc == 5:
@@ -119,25 +145,474 @@ class PlugDevice:
         else:
             self._logger.info(f'Connection result: {mqtt.connack_string(rc)}')
         self._last_connect_rc = rc
+        if rc == mqtt.CONNACK_ACCEPTED:
+            MQTT_CONNECTS.labels(client=self.mqtt_client_id).inc()
+        if rc == mqtt.CONNACK_ACCEPTED and self._topic_list:
+            # Subscriptions are lost when the broker drops the session
+            self.mqtt_client.subscribe(self._topic_list)
+
+    def _on_disconnect(self, client, userdata, rc):
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            MQTT_DISCONNECTS.labels(client=self.mqtt_client_id).inc()
+            self._logger.warning(f'Unexpected disconnection from broker: {mqtt.error_string(rc)}')
 
     def _on_message(self, client, userdata, message: mqtt.MQTTMessage):
-        if 'temperature' == message.topic.lstrip(f'shellies/{self.mqtt_device_id}/'):
-            self.temperature = message.payload.decode()
-        if 'relay/0' == message.topic.lstrip(f'shellies/{self.mqtt_device_id}/'):
-            self.state = message.payload.decode()
-        if'relay/0/power' == message.topic.lstrip(f'shellies/{self.mqtt_device_id}/'):
-            self.power = message.payload.decode()
-        if'plug/data' == message.topic:
-            self.mqtt_client.publish('plug/data/info', self.__str__(), self._mqtt_qos, retain=True)
-
-        if time.time() - self._subscription_tstamps[message.topic] > self._log_interval:
-            self._logger.debug(f'Received message on topic: {message.topic} and data: {message.payload.decode()}')
-            self._subscription_tstamps[message.topic] = time.time()
+        # Messages of topics without a handler are ignored
+        self._messages_metric.inc()
+        handler = self._handlers.get(message.topic)
+        if handler is not None:
+            handler(message.payload.decode())
+
+
+def parse_float(payload: str):
+    """
+    Parses a numeric MQTT payload
+    :return: float value, or None if the payload is not a number
+    """
+    try:
+        return float(payload)
+    except ValueError:
+        return None
+
+
+class CommandTimeout(TimeoutError):
+    """
+    The device did not confirm a relay command after all the retries
+    """
+
+
+class PendingCommand:
+    """
+    Relay command waiting for the ``relay/0`` state echo of the device
+    """
+    def __init__(self, command: str):
+        self.command = command
+        self.future = concurrent.futures.Future()
+        self.attempts = 0
+        self.sent_at = None     # Monotonic time of the first publish
+        self.timer = None
+
+
+class PlugState(abc.ABC):
+    """
+    State of a Shelly Plug S, updated from the messages of its ``shellies/<device_id>/...`` topics.
+    The power reports are integrated by ``meter`` into the energy drawn through the plug.
+
+    Relay commands are tracked until the device echoes the new state on ``relay/0``. A command that is not
+    confirmed within ``ack_timeout`` seconds is published again, up to ``max_retries`` times, the timeout
+    growing by ``backoff`` after every attempt. A command is not published when the relay already reports the
+    requested state or when the same command is still waiting for its confirmation.
+
+    ``on_event``, if set, is called with the plug and the reason (``'state'`` or ``'power'``) when the relay is
+    switched by someone else or the power changes by ``power_event_threshold`` W or more. It runs in the MQTT
+    network thread, so it must not block. ``status``, if set, is a ``status.StatusSnapshot`` updated with the
+    state, power and temperature reports.
+    """
+    # Subtopics of shellies/<device_id>/ and the name of the method handling their payload
+    SUBTOPICS = {'temperature': '_on_temperature',
+                 'relay/0': '_on_state',
+                 'relay/0/power': '_on_power'}
+
+    ack_timeout = 2.0       # Seconds to wait for the state echo of the first attempt [s]
+    max_retries = 3
+    backoff = 2.0           # Factor applied to the timeout after every attempt
+    power_event_threshold = 200.0   # Power change reported as an event [W]
+
+    def __init__(self, mqtt_device_id: str, meter: metering.PowerMeter = None):
+        """
+        :param mqtt_device_id: Shelly Plug Id
+        :param meter: [optional] meter of the power reports. A ``PowerMeter`` with the default capacity if not
+            provided
+        """
+        self.mqtt_device_id = mqtt_device_id
+        self.temperature = None
+        self.state = None
+        self.power = None
+        self.desired_state = None
+        self.last_latency = None
+        self.latencies = collections.deque(maxlen=100)
+        self.commands_sent = 0
+        self.commands_suppressed = 0
+        self.commands_failed = 0
+        self.on_event = None
+        self.status = None
+        self.meter = meter if meter is not None else metering.PowerMeter()
+        self._event_power = None
+        self._pending = None
+        self._command_lock = threading.Lock()
+        self._command_metrics = {result: PLUG_COMMANDS.labels(device=mqtt_device_id, result=result)
+                                 for result in ('sent', 'suppressed', 'confirmed', 'failed')}
+        self._latency_metric = PLUG_COMMAND_SECONDS.labels(device=mqtt_device_id)
+        self._logger = logging.getLogger(__name__)
+
+    def state_handlers(self) -> dict:
+        """
+        Returns a dict mapping the full topics of the device to their payload handlers
+        """
+        return {f'shellies/{self.mqtt_device_id}/{subtopic}': getattr(self, handler)
+                for subtopic, handler in self.SUBTOPICS.items()}
+
+    def request_state(self, command: str) -> concurrent.futures.Future:
+        """
+        Requests the relay to be switched to a state. Returns without waiting for the device
+        :param command: ``'on'`` or ``'off'``
+        :return: future set to the command-to-confirmation latency in seconds (0.0 if the relay was already in
+            the requested state), or to ``CommandTimeout`` if the device never confirms
+        """
+        with self._command_lock:
+            self.desired_state = command
+            pending = self._pending
+            if pending is not None:
+                if pending.command == command:
+                    self.commands_suppressed += 1
+                    self._command_metrics['suppressed'].inc()
+                    return pending.future
+                # Superseded by the opposite command
+                pending.timer.cancel()
+                pending.future.cancel()
+                self._pending = None
+            if self.state == command:
+                self.commands_suppressed += 1
+                self._command_metrics['suppressed'].inc()
+                future = concurrent.futures.Future()
+                future.set_result(0.0)
+                return future
+            pending = self._pending = PendingCommand(command)
+            self._schedule_attempt(pending)
+        self._publish_command(command)
+        return pending.future
+
+    def pending_command(self):
+        """
+        Returns the command waiting for confirmation, or None
+        """
+        pending = self._pending
+        return pending.command if pending is not None else None
+
+    def _schedule_attempt(self, pending: PendingCommand):
+        # Called with the command lock held
+        timeout = self.ack_timeout * self.backoff ** pending.attempts
+        pending.attempts += 1
+        if pending.sent_at is None:
+            pending.sent_at = time.monotonic()
+        pending.timer = threading.Timer(timeout, self._on_ack_timeout, (pending,))
+        pending.timer.daemon = True
+        pending.timer.start()
+        self.commands_sent += 1
+        self._command_metrics['sent'].inc()
+
+    def _on_ack_timeout(self, pending: PendingCommand):
+        with self._command_lock:
+            if self._pending is not pending:
+                return
+            failed = pending.attempts > self.max_retries
+            if failed:
+                self._pending = None
+                self.commands_failed += 1
+                self._command_metrics['failed'].inc()
+            else:
+                self._schedule_attempt(pending)
+        if failed:
+            self._logger.error(f'Device {self.mqtt_device_id} did not confirm command `{pending.command}` '
+                               f'after {pending.attempts} attempts')
+            pending.future.set_exception(CommandTimeout(f'{self.mqtt_device_id}: {pending.command}'))
+        else:
+            self._logger.warning(f'Device {self.mqtt_device_id} did not confirm command `{pending.command}`, '
+                                 f'retry {pending.attempts - 1} of {self.max_retries}')
+            self._publish_command(pending.command)
+
+    @abc.abstractmethod
+    def _publish_command(self, command: str):
+        """
+        Publishes a relay command on the ``relay/0/command`` topic of the device
+        """
+
+    def _notify(self, reason: str):
+        callback = self.on_event
+        if callback is not None:
+            callback(self, reason)
+
+    def _on_temperature(self, payload: str):
+        self.temperature = parse_float(payload)
+        if self.status is not None:
+            self.status.update_plug(self.mqtt_device_id, temperature=self.temperature)
+
+    def _on_state(self, payload: str):
+        previous = self.state
+        self.state = payload
+        if self.status is not None:
+            self.status.update_plug(self.mqtt_device_id, state=payload)
+        pending = self._pending
+        if pending is None or payload != pending.command:
+            if previous is not None and payload != previous:
+                # Switched by someone else, e.g. the button of the plug
+                self._notify('state')
+            return
+        with self._command_lock:
+            if self._pending is not pending:
+                return
+            self._pending = None
+            pending.timer.cancel()
+            self.last_latency = time.monotonic() - pending.sent_at
+            self.latencies.append(self.last_latency)
+        self._command_metrics['confirmed'].inc()
+        self._latency_metric.observe(self.last_latency)
+        pending.future.set_result(self.last_latency)
+
+    def slot_energy(self, day: datetime.date = None) -> list:
+        """
+        Returns the energy drawn through the plug in each 5-minute slot of a day, today by default, in kWh
+        """
+        return self.meter.slot_energy(day)
+
+    def _on_power(self, payload: str):
+        self.power = parse_float(payload)
+        if self.power is None:
+            return
+        self.meter.add(self.power)
+        if self.status is not None:
+            self.status.update_plug(self.mqtt_device_id, power=self.power)
+        if self._event_power is None:
+            self._event_power = self.power
+        elif abs(self.power - self._event_power) >= self.power_event_threshold:
+            # e.g. the thermostat of the tank switched the heater off
+            self._event_power = self.power
+            self._notify('power')
+
+
+class PlugDevice(MqttConnection, PlugState):
+    def __init__(self, mqtt_user: str,
+                 mqtt_password: str,
+                 mqtt_broker: str,
+                 mqtt_device_id: str,
+                 mqtt_port: int = 1883,
+                 mqtt_keepalive: int = 60,
+                 mqtt_retain: bool = False,
+                 mqtt_qos: int = 0,
+                 mqtt_client_id: str = None):
+        """
+        Creates a plug device with an MQTT client to control a Shelly 1 Plug
+        :param mqtt_user:
+        :param mqtt_password:
+        :param mqtt_broker: broker IP address
+        :param mqtt_device_id: Shelly 1 Plug Id
+        :param mqtt_port: default 1883
+        :param mqtt_client_id: default ``plug_controller_<mqtt_device_id>``
+        """
+        MqttConnection.__init__(self, mqtt_user, mqtt_password, mqtt_broker,
+                                mqtt_client_id or f'plug_controller_{mqtt_device_id}',
+                                mqtt_port, mqtt_keepalive, mqtt_retain, mqtt_qos)
+        PlugState.__init__(self, mqtt_device_id)
+        self._log_interval = 300
+        self._subscription_tstamps = {}
+
+    def device_on(self) -> concurrent.futures.Future:
+        return self.request_state('on')
+
+    def device_off(self) -> concurrent.futures.Future:
+        return self.request_state('off')
+
+    def device_toggle(self):
+        if self.state in ('on', 'off'):
+            return self.request_state('off' if self.state == 'on' else 'on')
+        if not self.is_connected():
+            self._logger.debug('Device Toggle: Requesting connection')
+            self.connect()
+        self._logger.info('Sending Device TOGGLE')
+        self.mqtt_client.publish(f'shellies/{self.mqtt_device_id}/relay/0/command', 'toggle')
+
+    def _publish_command(self, command: str):
+        if not self.is_connected():
+            self._logger.debug(f'Device {command.capitalize()}: Requesting connection')
+            self.connect()
+        self._logger.info(f'Sending Device {command.upper()}')
+        self.mqtt_client.publish(f'shellies/{self.mqtt_device_id}/relay/0/command', command)
+
+    def subscribe_to_device(self):
+        topic_list = [(f'shellies/{self.mqtt_device_id}/temperature', self._mqtt_qos),
+                      (f'shellies/{self.mqtt_device_id}/relay/0/power', self._mqtt_qos),
+                      (f'shellies/{self.mqtt_device_id}/relay/0', self._mqtt_qos)]
+        self.build_handlers()
+        self._subscribe(topic_list)
+
+    def build_handlers(self):
+        """
+        Builds the topic to handler map used to dispatch incoming messages
+        """
+        self._handlers = self.state_handlers()
+        self._handlers.update(self._extra_handlers)
+        self._subscription_tstamps = {topic: time.monotonic() for topic in self._handlers}
+
+    def _on_message(self, client, userdata, message: mqtt.MQTTMessage):
+        super()._on_message(client, userdata, message)
+        if self._logger.isEnabledFor(logging.DEBUG):
+            topic = message.topic
+            now = time.monotonic()
+            if now - self._subscription_tstamps.get(topic, 0.0) > self._log_interval:
+                self._logger.debug(f'Received message on topic: {topic} and data: {message.payload.decode()}')
+                self._subscription_tstamps[topic] = now
 
     def __str__(self):
         return f'time: {time.asctime()}, state: {self.state}, power: {self.power}, temperature: {self.temperature}'
 
 
+class FleetPlug(PlugState):
+    """
+    Shelly Plug S controlled through the shared MQTT client of a ``PlugFleet``
+    """
+    def __init__(self, fleet: 'PlugFleet', mqtt_device_id: str, priority: int = 0, rated_power: float = 2000.0,
+                 meter: metering.PowerMeter = None):
+        """
+        :param fleet: fleet owning the MQTT client
+        :param mqtt_device_id: Shelly Plug Id
+        :param priority: plugs with higher priority are switched on first
+        :param rated_power: power of the load in W, used to share the available surplus
+        :param meter: [optional] meter of the power reports
+        """
+        super().__init__(mqtt_device_id, meter)
+        self.fleet = fleet
+        self.priority = priority
+        self.rated_power = rated_power
+
+    def is_connected(self):
+        return self.fleet.is_connected()
+
+    def device_on(self) -> concurrent.futures.Future:
+        return self.request_state('on')
+
+    def device_off(self) -> concurrent.futures.Future:
+        return self.request_state('off')
+
+    def device_toggle(self):
+        if self.state in ('on', 'off'):
+            return self.request_state('off' if self.state == 'on' else 'on')
+        self._logger.info(f'Sending Device TOGGLE to {self.mqtt_device_id}')
+        self.fleet.send_command(self.mqtt_device_id, 'toggle')
+
+    def _publish_command(self, command: str):
+        self._logger.info(f'Sending Device {command.upper()} to {self.mqtt_device_id}')
+        self.fleet.send_command(self.mqtt_device_id, command)
+
+    def subscribe_to_device(self):
+        """
+        Subscribes the fleet to the topics of its devices, unless it is already subscribed. A ``HotWaterTank``
+        can then control a single plug of a shared fleet
+        """
+        self.fleet.subscribe_once()
+
+    def subscribe_topic(self, topic: str, handler) -> None:
+        """
+        Subscribes the fleet to an additional topic, see ``MqttConnection.subscribe_topic``
+        """
+        self.fleet.subscribe_topic(topic, handler)
+
+    def publish_status(self, topic: str, payload) -> None:
+        self.fleet.publish_status(topic, payload)
+
+    def _notify(self, reason: str):
+        callback = self.on_event or self.fleet.on_event
+        if callback is not None:
+            callback(self, reason)
+
+    def __str__(self):
+        return f'device: {self.mqtt_device_id}, state: {self.state}, power: {self.power}, ' \
+               f'temperature: {self.temperature}'
+
+
+class PlugFleet(MqttConnection):
+    """
+    Group of Shelly Plug S devices controlled through a single MQTT connection.
+
+    The fleet subscribes to the ``shellies/+/...`` wildcard topics once and dispatches every message to the
+    ``FleetPlug`` of its device. Messages of devices not added to the fleet are ignored.
+    """
+    def __init__(self, mqtt_user: str,
+                 mqtt_password: str,
+                 mqtt_broker: str,
+                 mqtt_port: int = 1883,
+                 mqtt_keepalive: int = 60,
+                 mqtt_retain: bool = False,
+                 mqtt_qos: int = 0,
+                 mqtt_client_id: str = 'plug_fleet'):
+        """
+        Creates a plug fleet with an MQTT client
+        :param mqtt_user:
+        :param mqtt_password:
+        :param mqtt_broker: broker IP address
+        :param mqtt_port: default 1883
+        :param mqtt_client_id: default ``plug_fleet``
+        """
+        super().__init__(mqtt_user, mqtt_password, mqtt_broker, mqtt_client_id,
+                         mqtt_port, mqtt_keepalive, mqtt_retain, mqtt_qos)
+        self.mqtt_device_id = mqtt_client_id
+        self.plugs = {}
+        self.on_event = None
+        self._subscribed = False
+        self._subscribe_lock = threading.Lock()
+
+    def add_plug(self, mqtt_device_id: str, priority: int = 0, rated_power: float = 2000.0,
+                 meter: metering.PowerMeter = None) -> FleetPlug:
+        """
+        Adds a plug to the fleet
+        :param meter: [optional] meter of the power reports of the plug
+        :return: the plug object that receives the state of the device
+        """
+        if mqtt_device_id in self.plugs:
+            raise ValueError(f'Device `{mqtt_device_id}` is already in the fleet')
+        plug = FleetPlug(self, mqtt_device_id, priority, rated_power, meter)
+        self.plugs[mqtt_device_id] = plug
+        self._handlers.update(plug.state_handlers())
+        return plug
+
+    def by_priority(self) -> list:
+        """
+        Returns the plugs sorted by descending priority
+        """
+        return sorted(self.plugs.values(), key=lambda plug: (-plug.priority, plug.mqtt_device_id))
+
+    def send_command(self, mqtt_device_id: str, command: str):
+        if not self.is_connected():
+            self._logger.debug('Device command: Requesting connection')
+            self.connect()
+        self.mqtt_client.publish(f'shellies/{mqtt_device_id}/relay/0/command', command)
+
+    def device_on(self):
+        for plug in self.by_priority():
+            plug.device_on()
+
+    def device_off(self):
+        for plug in reversed(self.by_priority()):
+            plug.device_off()
+
+    def subscribe_to_device(self):
+        """
+        Subscribes to the topics of all the Shelly devices
+        """
+        self._subscribe([('shellies/+/temperature', self._mqtt_qos),
+                         ('shellies/+/relay/0/power', self._mqtt_qos),
+                         ('shellies/+/relay/0', self._mqtt_qos)])
+
+    def subscribe_once(self):
+        """
+        Same as ``subscribe_to_device``, only the first time it is called
+        """
+        with self._subscribe_lock:
+            if self._subscribed:
+                return
+            self._subscribed = True
+        self.subscribe_to_device()
+
+    def slot_energy(self, day: datetime.date = None) -> list:
+        """
+        Returns the energy drawn through all the plugs of the fleet in each 5-minute slot of a day, in kWh
+        """
+        return [sum(slots) for slots in zip(*(plug.slot_energy(day) for plug in self.plugs.values()))] \
+            or [0.0] * metering.SLOTS_PER_DAY
+
+    def __str__(self):
+        return '; '.join(str(plug) for plug in self.by_priority())
+
+
 if __name__ == '__main__':
     import configparser
     config = configparser.ConfigParser()
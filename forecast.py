@@ -0,0 +1,368 @@
+"""
+Day-ahead forecast of the solar production and consumption, and heating plan following the forecast surplus.
+
+``Forecaster`` builds a production and a consumption profile for every 5-minute slot of a day from the history of
+a ``SeriesStore``: the weighted median of the same slot over the recent days and the days of the same season of
+previous years. ``HeatingPlanner`` schedules the slots where the tank draws the daily energy it needs at the
+lowest cost, and plans again on every decision with the data of the day as it arrives. Usage::
+
+    python -m forecast series_store_dir --plant-id NE=12345678 --day 2024-05-01 --daily-demand 6
+"""
+import datetime
+import logging
+import math
+import time
+
+import numpy as np
+
+import backtest
+import balance
+import tariff
+import timeseries
+
+
+SLOT_HOURS = timeseries.SLOT_MINUTES / 60
+SLOT_SECONDS = timeseries.SLOT_MINUTES * 60
+
+
+def weighted_median(values: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """
+    Weighted median of every column of ``values``, ignoring NaN
+    :param values: array of shape ``(days, slots)``
+    :param weights: array of shape ``(days,)``
+    :return: array of shape ``(slots,)``, NaN for the columns without values
+    """
+    order = np.argsort(values, axis=0)  # NaN are sorted last
+    sorted_values = np.take_along_axis(values, order, axis=0)
+    sorted_weights = np.take_along_axis(np.where(np.isnan(values), 0.0, weights[:, None]), order, axis=0)
+    cumulative = np.cumsum(sorted_weights, axis=0)
+    total = cumulative[-1]
+    idx = np.argmax(cumulative >= 0.5 * total, axis=0)
+    median = sorted_values[idx, np.arange(values.shape[1])].astype(np.float64)
+    median[total <= 0.0] = np.nan
+    return median
+
+
+def day_weights(ordinals: np.ndarray, day_of_year: np.ndarray, target: datetime.date, half_life: float = 7.0,
+                window: int = 21, season_weight: float = 0.5) -> np.ndarray:
+    """
+    Weights of the history days for the forecast of ``target``.
+    The last ``window`` days weigh ``0.5 ** (age / half_life)``. Older days within ``window`` days of the day of
+    the year of ``target`` weigh ``season_weight * 0.5 ** (distance / half_life)``. Other days weigh 0
+    :param ordinals: proleptic Gregorian ordinals of the history days
+    :param day_of_year: day of the year of the history days
+    """
+    age = target.toordinal() - ordinals
+    distance = np.abs(day_of_year - target.timetuple().tm_yday)
+    distance = np.minimum(distance, 365 - distance)
+    recent = (age > 0) & (age <= window)
+    seasonal = (age > window) & (distance <= window)
+    return np.where(recent, 0.5 ** (age / half_life), 0.0) + \
+        np.where(seasonal, season_weight * 0.5 ** (distance / half_life), 0.0)
+
+
+def _day_series(values) -> np.ndarray:
+    # Float series of an EnergyBalance as a float64 array of a whole day, NaN padded
+    series = np.full(timeseries.SLOTS_PER_DAY, np.nan)
+    values = np.frombuffer(values, dtype=np.float64)[:timeseries.SLOTS_PER_DAY]
+    series[:len(values)] = values
+    return series
+
+
+class Forecaster:
+    """
+    Production and consumption profiles of a day from the stored history of one or several plants.
+
+    The history is read from the store once and kept in memory, then only the days closed since the last forecast,
+    and the last ``refresh_days`` in case they were stored partial, are read, so a forecast over a year of history is
+    a few milliseconds of array operations. The series of several plants are summed, and the energy metered by the
+    tank is removed from the consumption, which includes it.
+    """
+
+    def __init__(self, store: timeseries.SeriesStore, plant_ids: list, history_days: int = 365,
+                 half_life: float = 7.0, window: int = 21, season_weight: float = 0.5, meters: list = None,
+                 refresh_days: int = 2):
+        """
+        :param store: series store with the history of the plants
+        :param plant_ids: plants whose series are summed
+        :param history_days: days of history kept
+        :param half_life: days for the weight of a day to halve
+        :param window: recent days used, and days around the same day of the year in previous years
+        :param season_weight: weight of the days of previous years relative to the recent ones
+        :param meters: [optional] meters of the tank whose energy, stored with ``SeriesStore.write_energy``, is
+            removed from the consumption
+        :param refresh_days: last days of the history read again on every update
+        """
+        self.store = store
+        self.plant_ids = list(plant_ids)
+        self.meters = list(meters or ())
+        self.refresh_days = refresh_days
+        self.history_days = history_days
+        self.half_life = half_life
+        self.window = window
+        self.season_weight = season_weight
+        self._profiles = {}
+        self._clear_history()
+        self._logger = logging.getLogger(__name__)
+
+    def set_plants(self, plant_ids: list) -> None:
+        """
+        Changes the plants whose series are summed. The history is read again from the store on the next update
+        """
+        if list(plant_ids) != self.plant_ids:
+            self.plant_ids = list(plant_ids)
+            self._clear_history()
+
+    def _clear_history(self) -> None:
+        self.days = []
+        self._ordinals = np.zeros(0, dtype=np.int64)
+        self._day_of_year = np.zeros(0, dtype=np.int64)
+        self._product = np.zeros((0, timeseries.SLOTS_PER_DAY), dtype=np.float32)
+        self._use = np.zeros((0, timeseries.SLOTS_PER_DAY), dtype=np.float32)
+        self._profiles.clear()
+
+    def _truncate(self, n_days: int) -> None:
+        # Drops the days of the history after the first n_days
+        if n_days < len(self.days):
+            self.days = self.days[:n_days]
+            self._ordinals = self._ordinals[:n_days]
+            self._day_of_year = self._day_of_year[:n_days]
+            self._product = self._product[:n_days]
+            self._use = self._use[:n_days]
+            self._profiles.clear()
+
+    def _tank_power(self, days: list) -> np.ndarray:
+        # Mean power drawn by the tank in every slot of the days [kW], 0 where it was not metered
+        power = np.zeros((len(days), timeseries.SLOTS_PER_DAY), dtype=np.float32)
+        for idx, day in enumerate(days):
+            for meter in self.meters:
+                energy = self.store.read_energy(meter, day)
+                if energy is not None:
+                    power[idx] += energy / SLOT_HOURS
+        return power
+
+    def add_days(self, days: list, product_power: np.ndarray, use_power: np.ndarray) -> None:
+        """
+        Appends days to the history, oldest first, dropping the days older than ``history_days``
+        :param days: list of ``datetime.date`` after the last day of the history
+        :param product_power: array of shape ``(days, 288)`` in kW, NaN for gaps
+        :param use_power: array of shape ``(days, 288)`` in kW, NaN for gaps
+        """
+        self.days = (self.days + list(days))[-self.history_days:]
+        self._ordinals = np.array([day.toordinal() for day in self.days], dtype=np.int64)
+        self._day_of_year = np.array([day.timetuple().tm_yday for day in self.days], dtype=np.int64)
+        self._product = np.concatenate((self._product, product_power))[-self.history_days:]
+        self._use = np.concatenate((self._use, use_power))[-self.history_days:]
+        self._profiles.clear()
+
+    def update(self, until: datetime.date) -> None:
+        """
+        Reads from the store the closed days before ``until`` missing in the history, and the last ``refresh_days``
+        of the history again
+        """
+        last = until - datetime.timedelta(days=1)
+        first = until - datetime.timedelta(days=self.history_days)
+        if self.days:
+            first = max(first, self.days[-1] + datetime.timedelta(days=1 - self.refresh_days))
+            self._truncate(sum(day < first for day in self.days))
+        if first > last:
+            return
+        start = time.perf_counter()
+        product = sum(self.store.read_range(plant_id, first, last, 'productPower') for plant_id in self.plant_ids)
+        use = sum(self.store.read_range(plant_id, first, last, 'usePower') for plant_id in self.plant_ids)
+        days = [first + datetime.timedelta(days=idx) for idx in range((last - first).days + 1)]
+        if self.meters:
+            use = np.maximum(use - self._tank_power(days), 0.0)
+        self.add_days(days, product, use)
+        self._logger.debug(f'{len(days)} days of history read in {time.perf_counter() - start:.3f} s')
+
+    def forecast(self, day: datetime.date = None) -> tuple:
+        """
+        Returns the production and consumption profiles of a day, today by default. Profiles are cached per day
+        :return: ``(product_power, use_power)`` arrays of shape ``(288,)`` in kW, NaN for the slots without history
+        """
+        day = day or datetime.date.today()
+        if day not in self._profiles:
+            self.update(day)
+            weights = day_weights(self._ordinals, self._day_of_year, day, self.half_life, self.window,
+                                  self.season_weight)
+            used = weights > 0.0
+            if not used.any():
+                profiles = (np.full(timeseries.SLOTS_PER_DAY, np.nan), np.full(timeseries.SLOTS_PER_DAY, np.nan))
+            else:
+                profiles = (weighted_median(self._product[used], weights[used]),
+                            weighted_median(self._use[used], weights[used]))
+            # Today and tomorrow at most
+            self._profiles = {key: value for key, value in self._profiles.items() if key >= day}
+            self._profiles[day] = profiles
+        return self._profiles[day]
+
+
+class HeatingPlanner:
+    """
+    Heating plan of a day: the slots where the tank is allowed to draw power.
+
+    The tank needs ``daily_demand`` kWh a day. The cost of drawing ``tank_power`` in a slot is the forecast surplus
+    it uses, valued at the sell price, plus the energy it buys, at the buy price. The plan takes the cheapest
+    remaining slots outside the exclusion windows until the demand not yet drawn is covered.
+
+    When planning the current day, the past slots use the actual data and the forecast production of the next
+    slots is scaled by the ratio between the actual and the forecast production of the last
+    ``calibration_slots``, fading back to the forecast over ``decay_slots``.
+    """
+
+    def __init__(self, forecaster: Forecaster, tank_power: float = 2.0, daily_demand: float = 6.0,
+                 schedule: tariff.WeeklySchedule = None, max_price: float = None, calibration_slots: int = 12,
+                 decay_slots: int = 24):
+        """
+        :param forecaster: forecast of the production and consumption
+        :param tank_power: power drawn by the tank when switched on [kW]
+        :param daily_demand: energy drawn by the tank every day [kWh]
+        :param schedule: [optional] exclusion windows and prices. Flat prices of 1.0 without exclusions if not
+            provided
+        :param max_price: [optional] slots whose cost per kWh is above it are never planned, even if the demand
+            is not covered
+        :param calibration_slots: past slots compared with the forecast to correct the next ones
+        :param decay_slots: slots for the correction to fade out
+        """
+        self.forecaster = forecaster
+        self.tank_power = tank_power
+        self.daily_demand = daily_demand
+        self.schedule = schedule if schedule is not None else tariff.WeeklySchedule()
+        self.max_price = max_price
+        self.calibration_slots = calibration_slots
+        self.decay_slots = decay_slots
+        self.last_plan = None           # (day, bool array of shape (288,))
+        self.last_surplus = None        # surplus of the last plan [kW]
+        self._logger = logging.getLogger(__name__)
+
+    def plan(self, day: datetime.date = None, now: datetime.datetime = None,
+             daily_data: balance.EnergyBalance = None, drawn: float = 0.0):
+        """
+        Plans the heating of a day
+        :param day: day to plan, today by default
+        :param now: [optional] current time when planning the current day. Only the next slots are planned
+        :param daily_data: [optional] day balance with the actual ``product_power`` and ``use_power`` series
+        :param drawn: energy already drawn by the tank in the day [kWh]
+        :return: bool array of shape ``(288,)``, True for the slots where the tank is switched on, or None if there
+            is no forecast for the day
+        """
+        day = day or datetime.date.today()
+        product, use = self.forecaster.forecast(day)
+        if np.isnan(product).all():
+            return None
+        product, use = np.nan_to_num(product), np.nan_to_num(use)
+        first_slot = 0
+        if now is not None and now.date() == day:
+            first_slot = timeseries.slot_index(now)
+            product, use = self._calibrated(product, use, first_slot, daily_data)
+        surplus = product - use
+
+        excluded, buy, sell = backtest.schedule_arrays(self.schedule, [day])
+        tank_energy = self.tank_power * SLOT_HOURS
+        self_consumed = np.clip(surplus * SLOT_HOURS, 0.0, tank_energy)
+        cost = sell[0] * self_consumed + buy[0] * (tank_energy - self_consumed)
+        cost[excluded[0]] = np.inf
+        cost[:first_slot] = np.inf
+        if self.max_price is not None:
+            cost[cost > self.max_price * tank_energy] = np.inf
+
+        plan = np.zeros(timeseries.SLOTS_PER_DAY, dtype=bool)
+        remaining = max(self.daily_demand - drawn, 0.0)
+        n_slots = min(math.ceil(remaining / tank_energy - 1e-9), int(np.isfinite(cost).sum())) if tank_energy else 0
+        if n_slots > 0:
+            # Stable sort: among slots of the same cost the earliest are taken
+            plan[np.argsort(cost, kind='stable')[:n_slots]] = True
+        self.last_plan = (day, plan)
+        self.last_surplus = surplus
+        return plan
+
+    def _calibrated(self, product: np.ndarray, use: np.ndarray, first_slot: int,
+                    daily_data: balance.EnergyBalance) -> tuple:
+        if daily_data is None or not daily_data.product_power:
+            return product, use
+        actual_product = _day_series(daily_data.product_power)
+        actual_use = _day_series(daily_data.use_power)
+        past = slice(max(first_slot - self.calibration_slots, 0), first_slot)
+        observed = ~np.isnan(actual_product[past])
+        forecast_sum = product[past][observed].sum()
+        scale = 1.0
+        if observed.any() and forecast_sum > 0.0:
+            scale = float(np.clip(actual_product[past][observed].sum() / forecast_sum, 0.0, 2.0))
+        fade = np.exp(-np.arange(timeseries.SLOTS_PER_DAY - first_slot) / self.decay_slots)
+        product = product.copy()
+        product[first_slot:] *= 1.0 + (scale - 1.0) * fade
+        # Actual data where available
+        product[:first_slot] = np.where(np.isnan(actual_product[:first_slot]), product[:first_slot],
+                                        actual_product[:first_slot])
+        use = np.where(np.isnan(actual_use), use, actual_use)
+        return product, use
+
+    def permission(self, now: datetime.datetime = None, daily_data: balance.EnergyBalance = None,
+                   drawn: float = 0.0):
+        """
+        Plans the current day again with the data received so far and returns the plan of the current slot
+        :param now: current time, now by default
+        :param daily_data: day balance with the actual ``product_power`` and ``use_power`` series
+        :param drawn: energy drawn by the tank in the day [kWh]
+        :return: True or False, or None if there is no forecast
+        """
+        now = now or datetime.datetime.now()
+        plan = self.plan(now.date(), now, daily_data, drawn)
+        if plan is None:
+            return None
+        return bool(plan[timeseries.slot_index(now)])
+
+    def next_change(self, now: datetime.datetime = None):
+        """
+        Returns the seconds until the last plan switches the tank on or off, or None if it does not change again
+        """
+        now = now or datetime.datetime.now()
+        if self.last_plan is None or self.last_plan[0] != now.date():
+            return None
+        plan = self.last_plan[1]
+        slot = timeseries.slot_index(now)
+        changes = np.flatnonzero(plan[slot + 1:] != plan[slot])
+        if not len(changes):
+            return None
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        return ((slot + 1 + changes[0]) * SLOT_SECONDS) - (now - midnight).total_seconds()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Day-ahead production forecast and heating plan')
+    parser.add_argument('store', help='series store directory')
+    parser.add_argument('--plant-id', action='append', required=True, help='plant id, repeat to sum plants')
+    parser.add_argument('--day', type=datetime.date.fromisoformat, default=datetime.date.today() +
+                        datetime.timedelta(days=1))
+    parser.add_argument('--history-days', type=int, default=365)
+    parser.add_argument('--meter', action='append', help='device id of the tank plug, repeat for several plugs')
+    parser.add_argument('--tank-power', type=float, default=2.0)
+    parser.add_argument('--daily-demand', type=float, default=6.0)
+    parser.add_argument('--buy-price', type=float, default=1.0)
+    parser.add_argument('--sell-price', type=float, default=1.0)
+    parser.add_argument('--exclusion-time', help='exclusion rules separated by `;`')
+    parser.add_argument('--buy-tariff', help='time-of-use buy price rules separated by `;`')
+    parser.add_argument('--sell-tariff', help='time-of-use sell price rules separated by `;`')
+    args = parser.parse_args()
+
+    forecaster = Forecaster(timeseries.SeriesStore(args.store), args.plant_id, history_days=args.history_days,
+                            meters=args.meter)
+    forecaster.update(args.day)
+    planner = HeatingPlanner(forecaster, args.tank_power, args.daily_demand,
+                             tariff.WeeklySchedule(args.buy_price, args.sell_price, args.exclusion_time,
+                                                   args.buy_tariff, args.sell_tariff))
+    t_start = time.perf_counter()
+    day_plan = planner.plan(args.day)
+    elapsed = time.perf_counter() - t_start
+    if day_plan is None:
+        print(f'No history for {args.day}')
+    else:
+        print(f'Planned {args.day} from {len(forecaster.days)} days of history in {elapsed * 1000:.1f} ms')
+        product_forecast, use_forecast = forecaster.forecast(args.day)
+        print(f'Forecast production: {np.nansum(product_forecast) * SLOT_HOURS:.2f} kWh, '
+              f'consumption: {np.nansum(use_forecast) * SLOT_HOURS:.2f} kWh')
+        on_slots = np.flatnonzero(day_plan)
+        print('Tank on: ' + ', '.join(timeseries.slot_label(args.day, idx)[11:] for idx in on_slots))
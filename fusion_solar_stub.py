@@ -0,0 +1,229 @@
+"""
+Local stand-in for the FusionSolar web API, for tests and benchmarks that must not hit the real portal.
+
+It serves the login, session, station list and ``energy-balance`` endpoints used by ``solar`` with synthetic
+but deterministic plant data, and can add latency, server errors and '``--``' gaps. Usage::
+
+    python -m fusion_solar_stub --port 8080 --latency 0.2 --error-rate 0.05 --gap-rate 0.01
+"""
+import collections
+import datetime
+import http.server
+import json
+import logging
+import math
+import random
+import threading
+import time
+import urllib.parse
+
+import solar
+
+
+PLANT_ID = 'NE=12345678'
+SLOTS_PER_DAY = 288
+
+
+class RedirectAdapter(solar.PortalAdapter):
+    """
+    Transport adapter sending the requests for ``*.fusionsolar.huawei.com`` to a local stand-in, with the same
+    timeouts as the adapter it replaces
+    """
+    def __init__(self, base_url: str, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = base_url.rstrip('/')
+
+    def send(self, request, **kwargs):
+        parts = urllib.parse.urlsplit(request.url)
+        if parts.hostname and parts.hostname.endswith('fusionsolar.huawei.com'):
+            request.url = f'{self.base_url}{parts.path}' + (f'?{parts.query}' if parts.query else '')
+        return super().send(request, **kwargs)
+
+
+def redirect_client(client, base_url: str) -> None:
+    """
+    Redirects all the requests of a ``FusionSolarClientExtended`` to a stand-in at ``base_url``
+    """
+    policy = client.http_policy
+    client.mount('https://', RedirectAdapter(base_url, timeout=policy.timeout, pool_maxsize=policy.pool_maxsize))
+
+
+class FusionSolarStub:
+    """
+    FusionSolar stand-in server running in a background thread
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0,
+                 error_rate: float = 0.0, gap_rate: float = 0.0, seed: int = 0, plant_ids: list = None):
+        """
+        :param host: listening address
+        :param port: listening port, 0 for any free port
+        :param latency: seconds added to every response
+        :param error_rate: fraction of the requests answered with HTTP 500
+        :param gap_rate: fraction of the past 5-minute slots reported as '``--``'
+        :param seed: seed of the synthetic plant data
+        :param plant_ids: [optional] plants of the account, ``[PLANT_ID]`` by default
+        """
+        self.plant_ids = list(plant_ids or [PLANT_ID])
+        self.latency = latency
+        self.error_rate = error_rate
+        self.gap_rate = gap_rate
+        self.seed = seed
+        self.requests = collections.Counter()
+        self._days = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = http.server.ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'FusionSolarStub':
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fusion_solar_stub', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def request_count(self) -> int:
+        with self._lock:
+            return sum(self.requests.values())
+
+    def day_series(self, day: datetime.date, plant_id: str = PLANT_ID) -> dict:
+        """
+        Returns the synthetic 5-minute series of a plant for a day, in kW, without gaps
+        """
+        if (plant_id, day) not in self._days:
+            day_random = random.Random(f'{self.seed}{plant_id}{day.isoformat()}')
+            peak = 4.0 * (0.8 + 0.2 * math.cos((day.timetuple().tm_yday - 172) / 365 * 2 * math.pi))
+            product, use = [], []
+            for idx in range(SLOTS_PER_DAY):
+                sun = max(0.0, math.sin((idx - 84) / 144 * math.pi)) if 84 <= idx < 228 else 0.0
+                product.append(round(peak * sun * day_random.uniform(0.6, 1.0), 3))
+                use.append(round(0.3 + day_random.uniform(0.0, 0.6) + (1.5 if 228 <= idx < 252 else 0.0), 3))
+            self._days[(plant_id, day)] = {'productPower': product, 'usePower': use}
+        return self._days[(plant_id, day)]
+
+    def energy_balance(self, time_dim: int, query_time: int, plant_id: str = PLANT_ID) -> dict:
+        date = datetime.datetime.fromtimestamp(query_time / 1000)
+        now = datetime.datetime.now()
+        if time_dim == 4:
+            days = [date.date().replace(day=day) for day in range(1, 32)
+                    if _valid_day(date.year, date.month, day)]
+        else:
+            days = [date.date()]
+        on_grid = buy = produced = used = 0.0
+        last_slot = SLOTS_PER_DAY
+        for day in days:
+            if day > now.date():
+                break
+            series = self.day_series(day, plant_id)
+            last_slot = SLOTS_PER_DAY if day < now.date() else (now.hour * 60 + now.minute) // 5
+            for idx in range(last_slot):
+                net = series['productPower'][idx] - series['usePower'][idx]
+                on_grid += max(net, 0.0) / 12
+                buy += max(-net, 0.0) / 12
+                produced += series['productPower'][idx] / 12
+                used += series['usePower'][idx] / 12
+
+        data = {'totalOnGridPower': f'{on_grid:.2f}', 'totalBuyPower': f'{buy:.2f}',
+                'totalProductPower': f'{produced:.2f}', 'totalUsePower': f'{used:.2f}'}
+        if time_dim != 4:
+            series = self.day_series(date.date(), plant_id)
+            data['xAxis'] = [f'{date:%Y-%m-%d} {idx // 12:02d}:{idx % 12 * 5:02d}' for idx in range(SLOTS_PER_DAY)]
+            for field in ('productPower', 'usePower'):
+                data[field] = [str(value) if idx < last_slot and self._random.random() >= self.gap_rate else '--'
+                               for idx, value in enumerate(series[field])]
+        return data
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self._respond()
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                self._respond()
+
+            def _respond(self):
+                url = urllib.parse.urlsplit(self.path)
+                with stub._lock:
+                    stub.requests[url.path] += 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+                if stub.error_rate and stub._random.random() < stub.error_rate:
+                    self._send(500, {'success': False, 'exceptionId': 'stub error'})
+                    return
+                params = dict(urllib.parse.parse_qsl(url.query))
+                self._send(200, stub._route(url.path, params))
+
+            def _send(self, status: int, body: dict):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                try:
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client gave up waiting
+                    stub._logger.debug(f'Client disconnected before the response to {self.path}')
+
+            def log_message(self, format, *args):
+                stub._logger.debug(format % args)
+
+        return Handler
+
+    def _route(self, path: str, params: dict) -> dict:
+        if path == '/unisso/pubkey':
+            return {'enableEncrypt': False}
+        if path.endswith('validateUser.action'):
+            return {'errorCode': None, 'errorMsg': None}
+        if path in ('/rest/dpcloud/auth/v1/is-session-alive', '/rest/dpcloud/auth/v1/keep-alive'):
+            return {'code': 0, 'payload': 'stub'}
+        if path == '/rest/neteco/web/organization/v2/company/current':
+            return {'data': {'moDn': 'NE=1'}}
+        if path == '/rest/pvms/web/station/v1/station/station-list':
+            return {'success': True, 'data': {'list': [{'dn': plant_id} for plant_id in self.plant_ids]}}
+        if path == '/rest/pvms/web/station/v1/overview/energy-balance':
+            return {'success': True, 'data': self.energy_balance(int(params.get('timeDim', 2)),
+                                                                 int(params.get('queryTime', time.time() * 1000)),
+                                                                 params.get('stationDn', PLANT_ID))}
+        return {'success': False}
+
+
+def _valid_day(year: int, month: int, day: int) -> bool:
+    try:
+        datetime.date(year, month, day)
+    except ValueError:
+        return False
+    return True
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Local FusionSolar stand-in')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--gap-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    stub = FusionSolarStub(args.host, args.port, args.latency, args.error_rate, args.gap_rate).start()
+    print(f'FusionSolar stand-in listening on {stub.url}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stub.stop()
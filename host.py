@@ -0,0 +1,245 @@
+"""
+Multi-site controller host.
+
+``ControllerHost`` runs the ``HotWaterTank`` controllers of many sites (households) in a single process:
+
+- the decision ticks of all the sites are jobs of a single ``ControllerScheduler``, with a bounded pool of tick
+  threads, and their first ticks are staggered over the decision period to spread the load evenly
+- the sites of the same FusionSolar account share one client (session, ``StatsCache`` and ``HttpPolicy`` with its
+  circuit breaker) and a bounded pool of workers for the concurrent plant requests. Sites with the same plants share
+  the same ``PowerDevice``
+- the plugs on the same MQTT broker are controlled through a single connection, a ``PlugFleet``
+
+Memory per site is bounded: a site is a controller, a plug state and the ring buffer of its power meter, of
+``meter_capacity`` samples. Sites are read from the ``[site:<name>]`` sections of the configuration file, and from
+the files of a directory of single-site configuration files. **main** runs a host instead of a single controller
+when any site is configured.
+"""
+import concurrent.futures
+import configparser
+import glob
+import logging
+import os
+import re
+
+import devices
+import hot_water_tank
+import metering
+import scheduler
+import solar
+
+
+SITE_PREFIX = 'site:'
+# Options of a site, and the section of the single-site configuration they are taken from when not in the site
+SITE_OPTIONS = {'huawei_user': 'HUAWEI', 'huawei_password': 'HUAWEI', 'plants': 'HUAWEI',
+                'mqtt_user': 'MQTT', 'mqtt_password': 'MQTT', 'mqtt_broker': 'MQTT', 'mqtt_port': 'MQTT',
+                'mqtt_device_id': 'MQTT', 'mqtt_keepalive': 'MQTT', 'mqtt_retain': 'MQTT', 'mqtt_qos': 'MQTT',
+                'buy_price': 'ENERGY', 'sell_price': 'ENERGY', 'exclusion_time': 'ENERGY', 'buy_tariff': 'ENERGY',
+                'sell_tariff': 'ENERGY', 'holidays': 'ENERGY',
+                'adaptive': 'TIMER', 'min_period': 'TIMER', 'max_period': 'TIMER'}
+REQUIRED_OPTIONS = ('huawei_user', 'huawei_password', 'mqtt_user', 'mqtt_password', 'mqtt_broker',
+                    'mqtt_device_id', 'buy_price', 'sell_price')
+
+
+def site_options(config: configparser.ConfigParser, section: str = None) -> dict:
+    """
+    Returns the options of a site. Options missing in ``section`` are taken from the sections of the single-site
+    configuration, e.g. ``mqtt_broker`` from ``[MQTT]``, so the options shared by all the sites are only set once
+    :param config: parsed configuration
+    :param section: ``[site:<name>]`` section, None for a single-site configuration
+    :return: dict of option strings, without the empty ones
+    """
+    options = {}
+    for option, fallback in SITE_OPTIONS.items():
+        value = config[section].get(option) if section is not None else None
+        if not value and config.has_section(fallback):
+            value = config[fallback].get(option)
+        if value:
+            options[option] = value.strip()
+    return options
+
+
+def load_sites(config: configparser.ConfigParser, sites_path: str = None) -> dict:
+    """
+    Returns the sites of the ``[site:<name>]`` sections of ``config``, and of the ``*.ini`` files of ``sites_path``.
+    A file without ``[site:<name>]`` sections is a single site, in the format of *heater_config.ini*, named after
+    the file
+    :param config: parsed configuration
+    :param sites_path: [optional] directory of site files, or a single file
+    :return: dict mapping the site names to their options
+    :raise ValueError if a site is defined twice or a required option is missing
+    """
+    sites = {}
+
+    def add(name: str, options: dict):
+        if name in sites:
+            raise ValueError(f'Site `{name}` is defined twice')
+        missing = [option for option in REQUIRED_OPTIONS if option not in options]
+        if missing:
+            raise ValueError(f'Site `{name}`: missing options {missing}')
+        sites[name] = options
+
+    for section in config.sections():
+        if section.startswith(SITE_PREFIX):
+            add(section[len(SITE_PREFIX):].strip(), site_options(config, section))
+    if sites_path:
+        paths = sorted(glob.glob(os.path.join(sites_path, '*.ini'))) if os.path.isdir(sites_path) else [sites_path]
+        for path in paths:
+            site_config = configparser.ConfigParser()
+            site_config.read(path)
+            file_sites = [section for section in site_config.sections() if section.startswith(SITE_PREFIX)]
+            if not file_sites:
+                add(os.path.splitext(os.path.basename(path))[0], site_options(site_config))
+            for section in file_sites:
+                add(section[len(SITE_PREFIX):].strip(), site_options(site_config, section))
+    return sites
+
+
+def session_path(session_dir: str, user: str) -> str:
+    """
+    Returns the file of the stored FusionSolar session of an account
+    """
+    return os.path.join(session_dir, '.fusion_solar_session_' + re.sub(r'[^\w.-]', '_', user))
+
+
+class Account:
+    """
+    FusionSolar client of an account and the pool of workers of its plant requests, shared by all its sites
+    """
+
+    def __init__(self, client: solar.FusionSolarClientExtended, workers: int):
+        self.client = client
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers,
+                                                              thread_name_prefix='account_stats')
+        self.devices = {}   # plant ids -> PowerDevice
+
+
+class ControllerHost:
+    """
+    Runs the controllers of many sites on a shared scheduler, sharing FusionSolar clients per account and MQTT
+    connections per broker
+    """
+
+    def __init__(self, workers: int = 4, account_workers: int = 4, period: float = 300.0,
+                 meter_capacity: int = 720, cache_ttl=None, cache_entries: int = 256, cache_path: str = None,
+                 session_dir: str = None, http_options: dict = None):
+        """
+        :param workers: threads running decision ticks concurrently, for all the sites
+        :param account_workers: concurrent plant requests per FusionSolar account
+        :param period: decision period over which the first ticks of the sites are spread [s]
+        :param meter_capacity: power samples kept per plug, 6 hours of Shelly reports every 30 s by default
+        :param cache_ttl: TTL of the stats cache of each account, see ``StatsCache``
+        :param cache_entries: entries of the stats cache of each account
+        :param cache_path: [optional] prefix of the on-disk stores of the stats caches, one per account
+        :param session_dir: [optional] directory of the stored FusionSolar sessions, one file per account
+        :param http_options: [optional] arguments of the ``HttpPolicy`` of each account
+        """
+        self.scheduler = scheduler.ControllerScheduler(max_workers=workers)
+        self.account_workers = account_workers
+        self.period = period
+        self.meter_capacity = meter_capacity
+        self.cache_ttl = cache_ttl
+        self.cache_entries = cache_entries
+        self.cache_path = cache_path
+        self.session_dir = session_dir
+        self.http_options = http_options or {}
+        self.sites = {}         # site name -> HotWaterTank
+        self.accounts = {}      # FusionSolar user -> Account
+        self.fleets = {}        # (broker, port, MQTT user) -> PlugFleet
+        self._logger = logging.getLogger(__name__)
+
+    def account(self, user: str, password: str) -> Account:
+        """
+        Returns the shared client of a FusionSolar account, logging in the first time
+        """
+        if user not in self.accounts:
+            suffix = re.sub(r'[^\w.-]', '_', user)
+            stats_cache = solar.StatsCache(ttl=self.cache_ttl, max_entries=self.cache_entries,
+                                           path=f'{self.cache_path}_{suffix}' if self.cache_path else None)
+            session_store = solar.SessionStore(session_path(self.session_dir, user)) if self.session_dir else None
+            client = solar.FusionSolarClientExtended(user, password, huawei_subdomain='uni001eu5',
+                                                     stats_cache=stats_cache, session_store=session_store,
+                                                     http_policy=solar.HttpPolicy(**self.http_options))
+            self.accounts[user] = Account(client, self.account_workers)
+        return self.accounts[user]
+
+    def energy_device(self, user: str, password: str, plants: list = None) -> solar.PowerDevice:
+        """
+        Returns the device of a set of plants of an account, shared by the sites with the same plants
+        """
+        account = self.account(user, password)
+        key = tuple(sorted(plants)) if plants else ()
+        if key not in account.devices:
+            account.devices[key] = solar.PowerDevice(user, password, plants=plants, client=account.client,
+                                                     executor=account.executor)
+        return account.devices[key]
+
+    def fleet(self, mqtt_user: str, mqtt_password: str, mqtt_broker: str, mqtt_port: int = 1883,
+              mqtt_keepalive: int = 60, mqtt_retain: bool = False, mqtt_qos: int = 0) -> devices.PlugFleet:
+        """
+        Returns the MQTT connection shared by the plugs of a broker
+        """
+        key = (mqtt_broker, mqtt_port, mqtt_user)
+        if key not in self.fleets:
+            self.fleets[key] = devices.PlugFleet(mqtt_user, mqtt_password, mqtt_broker, mqtt_port, mqtt_keepalive,
+                                                 mqtt_retain, mqtt_qos,
+                                                 mqtt_client_id=f'plug_host_{os.getpid()}_{len(self.fleets)}')
+        return self.fleets[key]
+
+    def add_site(self, name: str, options: dict) -> hot_water_tank.HotWaterTank:
+        """
+        Creates the controller of a site
+        :param name: unique name of the site
+        :param options: options of the site, as returned by ``load_sites``
+        :return: the controller, started with the host
+        """
+        if name in self.sites:
+            raise ValueError(f'Site `{name}` already exists')
+        plants = [plant_id.strip() for plant_id in options.get('plants', '').split(',') if plant_id.strip()]
+        energy_device = self.energy_device(options['huawei_user'], options['huawei_password'], plants)
+        fleet = self.fleet(options['mqtt_user'], options['mqtt_password'], options['mqtt_broker'],
+                           int(options.get('mqtt_port', 1883)), int(options.get('mqtt_keepalive', 60)),
+                           _boolean(options.get('mqtt_retain', 'false')), int(options.get('mqtt_qos', 0)))
+        plug = fleet.add_plug(options['mqtt_device_id'], meter=metering.PowerMeter(capacity=self.meter_capacity))
+        controller = hot_water_tank.HotWaterTank(options['huawei_user'], options['huawei_password'],
+                                                 controller_scheduler=self.scheduler, plug=plug,
+                                                 energy_device=energy_device)
+        controller.energy_price_buy = float(options['buy_price'])
+        controller.energy_price_sell = float(options['sell_price'])
+        controller.exclusion_time = options.get('exclusion_time', '')
+        controller.schedule.update(buy_tariff=options.get('buy_tariff'), sell_tariff=options.get('sell_tariff'),
+                                   holidays=options.get('holidays'))
+        controller.adaptive = _boolean(options.get('adaptive', 'true'))
+        controller.min_period = float(options.get('min_period', controller.min_period))
+        controller.max_period = float(options.get('max_period', controller.max_period))
+        # The sites of a broker publish their status on topics of their own
+        controller.status_topic = f'plug/{name}/data/info'
+        controller.status_request_topic = f'plug/{name}/data'
+        self.sites[name] = controller
+        return controller
+
+    def start(self) -> None:
+        """
+        Connects the MQTT fleets and starts the controllers, their first decisions spread over ``period``
+        """
+        for fleet in self.fleets.values():
+            fleet.subscribe_once()
+        step = self.period / len(self.sites) if self.sites else 0.0
+        for idx, controller in enumerate(self.sites.values()):
+            controller.start(delay=idx * step)
+        self._logger.info(f'{len(self.sites)} sites started, {len(self.accounts)} FusionSolar accounts, '
+                          f'{len(self.fleets)} MQTT connections')
+
+    def stop(self) -> None:
+        # The scheduler cancels the jobs of all the sites at once
+        self.scheduler.stop()
+        for controller in self.sites.values():
+            controller.stop()
+        for fleet in self.fleets.values():
+            fleet.disconnect()
+        for account in self.accounts.values():
+            account.executor.shutdown(wait=False)
+
+
+def _boolean(value: str) -> bool:
+    return configparser.ConfigParser.BOOLEAN_STATES.get(value.strip().lower(), False)
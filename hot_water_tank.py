@@ -1,10 +1,31 @@
-import threading
+import datetime
 import logging
-import time
+import math
+import threading
 import requests.exceptions
 
+import balance
 import solar
 import devices
+import logs
+import metering
+import metrics
+import scheduler
+import status
+import tariff
+
+
+SLOT_HOURS = metering.SLOT_SECONDS / 3600
+
+TICK_SECONDS = metrics.histogram('controller_tick_seconds', 'Duration of the controller decision ticks',
+                                 ['controller'])
+TICK_ERRORS = metrics.counter('controller_tick_errors_total', 'Controller ticks that raised an exception',
+                              ['controller'])
+RATIO = metrics.gauge('controller_ratio', 'Sold over bought energy ratio of the last decision',
+                      ['controller', 'period'])
+PERIOD = metrics.gauge('controller_period_seconds', 'Current period of the decision ticks', ['controller'])
+PERMISSION = metrics.gauge('controller_permission', '1 if the last decision allowed switching on, else 0',
+                           ['controller'])
 
 
 class HotWaterTank:
@@ -19,79 +40,256 @@ class HotWaterTank:
     Energy data is retrieved through Huawei's FusionSolar API and the power
     source is controlled via a Shelly 1 Plug
     """
-    def __init__(self, user: str, pwd: str, **kwargs):
+    def __init__(self, user: str, pwd: str, stats_cache: solar.StatsCache = None,
+                 series_store: 'timeseries.SeriesStore' = None,
+                 session_store: solar.SessionStore = None,
+                 controller_scheduler: scheduler.ControllerScheduler = None,
+                 plug: devices.MqttConnection = None, plants: list = None,
+                 http_policy: solar.HttpPolicy = None, energy_device: solar.PowerDevice = None, **kwargs):
         """
         Creates a HotWaterTank object
         :param user: FusionSolar user
         :param pwd: FuseionSolar password
+        :param stats_cache: [optional] cache for FusionSolar plant stats
+        :param series_store: [optional] local store for the 5-minute power series
+        :param session_store: [optional] store of the FusionSolar session, reused on restart
+        :param controller_scheduler: [optional] scheduler shared with other controllers. A dedicated one is
+            created on ``start`` if not provided
+        :param plug: [optional] device switching the power source. A ``PlugDevice`` is created with
+            the MQTT arguments if not provided
+        :param plants: [optional] ids of the FusionSolar plants whose balance is aggregated. All the plants of the
+            account if not provided
+        :param http_policy: [optional] timeouts, retries and circuit breaker of the FusionSolar requests
+        :param energy_device: [optional] FusionSolar device shared with other controllers. The FusionSolar arguments
+            are not used if provided
         :param kwargs: arguments for the MQTT connection
         """
-        self._energy_price_buy = 1
-        self._energy_price_sell = 1
-        self.energy_device = solar.PowerDevice(user, pwd)
-        self.timer = None
+        self.schedule = tariff.WeeklySchedule()     # Exclusion windows and time-of-use prices
+        self.daily_factor = 1.1      # Factor applied to ratio_threshold for the daily ratio
+        self.energy_device = energy_device or solar.PowerDevice(user, pwd, stats_cache=stats_cache,
+                                                                series_store=series_store,
+                                                                session_store=session_store, plants=plants,
+                                                                http_policy=http_policy)
+        self.scheduler = controller_scheduler
+        self._own_scheduler = controller_scheduler is None
         self._timer_period = 300     # Timer event period in seconds [s]
+        self._tick_timeout = 120     # Time to wait for a decision before reporting it as overrun [s]
+        self.adaptive = True         # Adapt the timer period to the production and the ratios
+        self.min_period = 120        # Period near a decision boundary or with fast changing production [s]
+        self.max_period = 1800       # Period without production [s]
+        self.boundary_margin = 0.1   # Relative distance of a ratio to its threshold considered near the boundary
+        self.change_threshold = 0.2  # Relative change of the production between two slots considered fast
+        self.trigger_interval = 60   # Minimum time between two decisions triggered by events [s]
+        self._daily_data = None      # balance.EnergyBalance of the day in the last decision
+        self.tank_accounting = True  # Remove the energy drawn by the tank from the balance used for decisions
+        self.planner = None          # forecast.HeatingPlanner followed instead of the ratios when it has a forecast
+        self._planned = None         # Plan of the current slot in the last decision
+        self._tank_days = {}         # date -> (self-consumed, bought) tank energy [kWh]
+        self._tank_final = set()     # Past days of _tank_days split from settled series
+        self._job = None
         self._run = False
-        self.plug = devices.PlugDevice(**kwargs)
-        self._exclusion_time = []
+        self.plug = plug if plug is not None else devices.PlugDevice(**kwargs)
+        self.status = status.StatusSnapshot(self.plug.mqtt_device_id)   # Plugs and last decision
+        self.plug.status = self.status
+        self.status_topic = 'plug/data/info'     # Retained topic of the status, None to not publish it
+        self.status_request_topic = 'plug/data'  # Topic of the requests to publish the status
+        self.status_min_interval = 10   # Minimum time between two status publications [s]
+        self.status_max_interval = 600  # Time after which the status is published without changes [s]
+        self.status_publisher = None
         self._ratio_monthly = None
         self._ratio_daily = None
         self._logger = logging.getLogger('water_tank')
+        self._decision_logger = logging.getLogger(logs.DECISION_LOGGER)
         self._logger.info('Creating device')
+        name = self.plug.mqtt_device_id
+        self._tick_metric = TICK_SECONDS.labels(controller=name)
+        self._tick_errors_metric = TICK_ERRORS.labels(controller=name)
+        self._permission_metric = PERMISSION.labels(controller=name)
+        self._period_metric = PERIOD.labels(controller=name)
+        RATIO.labels(controller=name, period='daily').set_function(lambda: self.ratio_daily)
+        RATIO.labels(controller=name, period='monthly').set_function(lambda: self.ratio_monthly)
 
     def activate_permission(self) -> bool:
         """
-        Checks if it is allowed to activate the water tank power source
+        Checks if it is allowed to activate the water tank power source. If a ``planner`` is set and has a
+        forecast for the day, its plan for the current slot is followed instead of the ratios
         :return:
         """
-        daily_data = self.energy_device.get_overview()
-        monthly_data = self.energy_device.get_overview(stat_type='month')
-
-        if not daily_data:
-            daily_data['totalOnGridPower'] = '--'
-            daily_data['totalBuyPower'] = '--'
-
-        if not monthly_data:
-            monthly_data['totalOnGridPower'] = '--'
-            monthly_data['totalBuyPower'] = '--'
-
-        if daily_data['totalOnGridPower'] == '--':
-            self._logger.warning(f'Not possible to calculate ratio. '
-                                 f'Daily onGridPower: {daily_data["totalOnGridPower"]}')
-        if daily_data['totalBuyPower'] == '--':
-            self._logger.warning(f'Not possible to calculate ratio. '
-                                 f'Daily BuyPower: {daily_data["totalBuyPower"]}')
-        if monthly_data['totalOnGridPower'] == '--':
-            self._logger.warning(f'Not possible to calculate ratio. '
-                                 f'Monthly onGridPower: {monthly_data["totalOnGridPower"]}')
-        if monthly_data['totalBuyPower'] == '--':
-            self._logger.warning(f'Not possible to calculate ratio. '
-                                 f'Monthly totalBuyPower: {monthly_data["totalBuyPower"]}')
-
-        try:
-            self.ratio_monthly = float(monthly_data['totalOnGridPower']) / float(monthly_data['totalBuyPower'])
-        except (ZeroDivisionError, ValueError):
-            self.ratio_monthly = 0
-
-        try:
-            self.ratio_daily = float(daily_data['totalOnGridPower']) / float(daily_data['totalBuyPower'])
-        except (ZeroDivisionError, ValueError):
-            self.ratio_daily = 0
+        daily_data = self.energy_device.get_balance()
+        month_totals = self.energy_device.get_month_totals(daily_data)
+        monthly_data = balance.EnergyBalance('month', on_grid=month_totals.get('totalOnGridPower', balance.NAN),
+                                             buy=month_totals.get('totalBuyPower', balance.NAN))
+        self._daily_data = daily_data
+        if daily_data is None:
+            daily_data = balance.EnergyBalance()
+        elif self.tank_accounting and month_totals:
+            daily_data, monthly_data = self.without_tank(daily_data, monthly_data)
+
+        for period, data in (('Daily', daily_data), ('Monthly', monthly_data)):
+            if math.isnan(data.on_grid):
+                self._logger.warning(f'Not possible to calculate ratio. {period} onGridPower: --')
+            if math.isnan(data.buy):
+                self._logger.warning(f'Not possible to calculate ratio. {period} BuyPower: --')
+
+        self.ratio_monthly = monthly_data.ratio()
+        self.ratio_daily = daily_data.ratio()
 
         # Check exclusion times
-        for i in range(len(self.exclusion_time)):
-            if self.exclusion_time[i]['start'] <= time.localtime().tm_hour < self.exclusion_time[i]['end']:
-                return False
-        return (self.ratio_daily > 1.1 * self.ratio_threshold) or (self.ratio_monthly > self.ratio_threshold)
+        now = datetime.datetime.now()
+        self._planned = None
+        if self.schedule.is_excluded(now):
+            return False
+        if self.planner is not None:
+            self._planned = self.planner.permission(now, self._daily_data, drawn=sum(self.plug.slot_energy()))
+            if self._planned is not None:
+                return self._planned
+        ratio_threshold = self.schedule.ratio_threshold(now)
+        return (self.ratio_daily > self.daily_factor * ratio_threshold) or \
+            (self.ratio_monthly > ratio_threshold)
+
+    def tank_balance(self, daily_data: balance.EnergyBalance, day: datetime.date = None) -> tuple:
+        """
+        Splits the energy drawn by the tank in a day into self-consumed and bought energy, slot by slot, from
+        the metered plug power and the production and consumption series of the day
+        :param daily_data: day balance with the ``product_power`` and ``use_power`` 5-minute series [kW]
+        :param day: day of the overview, today by default
+        :return: ``(self_consumed, bought)`` in kWh
+        """
+        return self._split_tank(self.plug.slot_energy(day), daily_data.product_power, daily_data.use_power)
+
+    @staticmethod
+    def _split_tank(tank_slots, product_power, use_power) -> tuple:
+        self_consumed = 0.0
+        for tank, product, use in zip(tank_slots, product_power, use_power):
+            if not tank:
+                continue
+            if math.isnan(product) or math.isnan(use):
+                continue
+            # Surplus before the tank load, use_power includes the tank
+            surplus = (product - use) * SLOT_HOURS + tank
+            self_consumed += min(tank, max(surplus, 0.0))
+        self_consumed = float(self_consumed)
+        return self_consumed, float(sum(tank_slots)) - self_consumed
+
+    def without_tank(self, daily_data: balance.EnergyBalance, monthly_data: balance.EnergyBalance) -> tuple:
+        """
+        Returns copies of the day and month balances as they would be without the energy drawn by the tank: its
+        self-consumed energy is added to ``on_grid`` and its bought energy removed from ``buy``.
+        Otherwise the tank's own load would push the ratios down and switch it off.
+        With a series store, the metered slots are stored too, and the past days of the month are split again from
+        the stored slots and series until they are final, so a restart does not lose them
+        :return: ``(daily_data, monthly_data)``
+        """
+        today = datetime.date.today()
+        self._tank_days[today] = self.tank_balance(daily_data, today)
+        for day in [day for day in self._tank_days if (day.year, day.month) != (today.year, today.month)]:
+            del self._tank_days[day]
+            self._tank_final.discard(day)
+        store = self.energy_device.series_store
+        if store is not None:
+            # The stored slots include those metered before a restart
+            store.write_energy(self.plug.mqtt_device_id, today, self.plug.slot_energy(today))
+            self._tank_days[today] = self._split_tank(store.read_energy(self.plug.mqtt_device_id, today),
+                                                      daily_data.product_power, daily_data.use_power)
+            day = today.replace(day=1)
+            while day < today:
+                self._past_tank_balance(store, day)
+                day += datetime.timedelta(days=1)
+        month_balance = [sum(values) for values in zip(*self._tank_days.values())]
+        return (self._adjusted_totals(daily_data, *self._tank_days[today]),
+                self._adjusted_totals(monthly_data, *month_balance))
+
+    def _past_tank_balance(self, store: 'timeseries.SeriesStore', day: datetime.date) -> None:
+        if day in self._tank_final:
+            return
+        settled = datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time()) + \
+            datetime.timedelta(seconds=store.settle_time) <= datetime.datetime.now()
+        # The meter keeps the slots of the previous day, stored before they are split
+        slots = self.plug.slot_energy(day)
+        if any(slots):
+            store.write_energy(self.plug.mqtt_device_id, day, slots)
+        tank_slots = store.read_energy(self.plug.mqtt_device_id, day)
+        if tank_slots is not None:
+            self._tank_days[day] = self._split_tank(tank_slots, *store.read_day(self.energy_device.plant_ids, day))
+        if settled:
+            # Split once more from the final series, or never metered
+            self._tank_final.add(day)
+
+    @staticmethod
+    def _adjusted_totals(data: balance.EnergyBalance, self_consumed: float,
+                         bought: float) -> balance.EnergyBalance:
+        if math.isnan(data.on_grid) or math.isnan(data.buy):
+            return data
+        return data.replace(on_grid=data.on_grid + self_consumed, buy=max(data.buy - bought, 0.0))
+
+    def next_period(self) -> float:
+        """
+        Returns the period until the next decision, based on the last one:
+        ``max_period`` without production, ``min_period`` when a ratio is near its threshold or the production
+        changes fast, twice ``_timer_period`` when the production is stable, and ``_timer_period`` otherwise.
+        The period ends at the next change of the exclusion windows or the prices at the latest, and of the plan
+        when following a heating plan
+        :return: period in seconds
+        """
+        period = self._ratio_period()
+        for change in (self.schedule.next_change(horizon=math.ceil(period / 60)),
+                       self.planner.next_change() if self.planner is not None else None):
+            if change is not None:
+                period = min(period, max(change, 1.0))
+        return period
+
+    def _ratio_period(self) -> float:
+        production = [value for value in self._daily_data.product_power if not math.isnan(value)] \
+            if self._daily_data is not None else []
+        if not production or production[-1] == 0.0:
+            return self.max_period
+        thresholds = ((self.ratio_daily, self.daily_factor * self.ratio_threshold),
+                      (self.ratio_monthly, self.ratio_threshold))
+        if any(ratio is not None and abs(ratio - threshold) <= self.boundary_margin * threshold
+               for ratio, threshold in thresholds):
+            return self.min_period
+        if len(production) > 1:
+            change = abs(production[-1] - production[-2]) / max(production[-1], production[-2])
+            if change >= self.change_threshold:
+                return self.min_period
+            if change < self.change_threshold / 4:
+                return min(2 * self._timer_period, self.max_period)
+        return self._timer_period
+
+    def trigger(self) -> None:
+        """
+        Takes a decision now instead of waiting for the timer, unless the last one is more recent than
+        ``trigger_interval``. It can be called from any thread
+        """
+        if self._job is not None:
+            self.scheduler.trigger(self._job.name)
 
-    def start(self):
+    def add_event_topic(self, topic: str) -> None:
+        """
+        Takes a decision when a message is received on ``topic``, e.g. the power reports of an external meter
         """
-        Starts the controller
+        self.plug.subscribe_topic(topic, lambda payload: self.trigger())
+
+    def start(self, delay: float = 0.0):
+        """
+        Starts the controller. Decisions are taken every ``_timer_period`` seconds by the scheduler, adapted
+        by ``next_period`` if ``adaptive``, and on the events of the plug
+        :param delay: seconds before the first decision, to spread the decisions of controllers sharing a scheduler
         :return:
         """
         self._run = True
+        self.plug.on_event = self._on_plug_event
+        if self.status_topic:
+            self.status_publisher = status.StatusPublisher(
+                self.status, lambda payload: self.plug.publish_status(self.status_topic, payload),
+                min_interval=self.status_min_interval, max_interval=self.status_max_interval)
+            self.plug.subscribe_topic(self.status_request_topic, lambda payload: self.status_publisher.request())
         self.plug.subscribe_to_device()
-        self._loop()
+        if self.scheduler is None:
+            self.scheduler = scheduler.ControllerScheduler()
+        self._job = self.scheduler.add_job(f'water_tank_{self.plug.mqtt_device_id}', self._timed_tick,
+                                           self._timer_period, timeout=self._tick_timeout, delay=delay,
+                                           min_interval=self.trigger_interval)
 
     def stop(self):
         """
@@ -99,20 +297,81 @@ class HotWaterTank:
         :return:
         """
         self._run = False
-
-    def _loop(self):
+        if self._job is not None:
+            self.scheduler.remove_job(self._job.name)
+            self._job = None
+        if self.status_publisher is not None:
+            self.status_publisher.stop()
+            self.status_publisher = None
+        if self._own_scheduler and self.scheduler is not None:
+            self.scheduler.stop()
+            self.scheduler = None
+
+    def _on_plug_event(self, plug, reason: str):
+        self._logger.debug(f'Plug {plug.mqtt_device_id} event: {reason}')
+        self.trigger()
+
+    def _timed_tick(self):
+        try:
+            with self._tick_metric.time():
+                self._tick()
+        except Exception:
+            self._tick_errors_metric.inc()
+            raise
+        finally:
+            if self.adaptive and self._job is not None:
+                period = self.next_period()
+                self.scheduler.set_period(self._job.name, period)
+                self._period_metric.set(period)
+
+    def _tick(self):
         if self._run:
-            if self.activate_permission():
+            permission = self.activate_permission()
+            self._permission_metric.set(int(permission))
+            if permission:
                 self._logger.info(f'Switch on approved.')
                 self.plug.device_on()
             else:
                 self._logger.info(f'Switch on disapproved.')
                 self.plug.device_off()
-            self.timer = threading.Timer(self._timer_period, self._loop).start()
+            self.record_decision(permission, [self.plug.mqtt_device_id] if permission else [])
+
+    def record_decision(self, permission: bool, switched_on: list) -> None:
+        """
+        Updates the status with the result of a decision, and logs it
+        :param permission: result of ``activate_permission``
+        :param switched_on: ids of the plugs requested to be on
+        """
+        self.status.update(permission=permission, on=switched_on, ratio_daily=self.ratio_daily,
+                           ratio_monthly=self.ratio_monthly, ratio_threshold=self.ratio_threshold,
+                           planned=self._planned, stale=self._daily_data is None or self._daily_data.stale,
+                           decision_time=datetime.datetime.now().isoformat(timespec='seconds'))
+        self.log_decision(permission, switched_on)
+
+    def log_decision(self, permission: bool, switched_on: list) -> None:
+        """
+        Writes the inputs and the result of a decision to the ``decisions`` logger, as one JSON line
+        :param permission: result of ``activate_permission``
+        :param switched_on: ids of the plugs requested to be on
+        """
+        if not self._decision_logger.isEnabledFor(logging.INFO):
+            return
+        self._decision_logger.info('decision', extra={'decision': {
+            'controller': self.plug.mqtt_device_id,
+            'permission': permission,
+            'ratio_daily': self.ratio_daily,
+            'ratio_monthly': self.ratio_monthly,
+            'ratio_threshold': self.ratio_threshold,
+            'daily_factor': self.daily_factor,
+            'tank_energy': self._tank_days.get(datetime.date.today()),
+            'stale': self._daily_data is not None and self._daily_data.stale,
+            'planned': self._planned,
+            'on': switched_on}})
 
     @property
     def ratio_threshold(self):
-        return self.energy_price_buy / self.energy_price_sell
+        # Buy to sell price ratio of the current time-of-use prices
+        return self.schedule.ratio_threshold()
 
     @ratio_threshold.setter
     def ratio_threshold(self, value: float):
@@ -142,40 +401,131 @@ class HotWaterTank:
 
     @property
     def energy_price_buy(self):
-        return self._energy_price_buy
+        return self.schedule.buy_price
 
     @energy_price_buy.setter
     def energy_price_buy(self, value: float):
         if value != 0.0:
-            self._energy_price_buy = value
+            self.schedule.update(buy_price=value)
             self._logger.info(f'Updated energy buy price to: {value}. New ratio_threshold: {self.ratio_threshold}')
 
     @property
     def energy_price_sell(self):
-        return self._energy_price_sell
+        return self.schedule.sell_price
 
     @energy_price_sell.setter
     def energy_price_sell(self, value: float):
         if value != 0.0:
-            self._energy_price_sell = value
+            self.schedule.update(sell_price=value)
             self._logger.info(f'Updated energy sell price to: {value}. New ratio: {self.ratio_threshold}')
         else:
             raise ZeroDivisionError('Sell energy price cannot be 0.0')
 
     @property
     def exclusion_time(self):
-        return self._exclusion_time
+        return self.schedule.exclusion_time
 
     @exclusion_time.setter
-    def exclusion_time(self, time_intervals: list) -> None:
-        if type(time_intervals) is not list:
-            time_intervals = [time_intervals]
-        for i in range(len(time_intervals)):
-            interval = {
-                'start': int(time_intervals[i].split('-')[0]),
-                'end': int(time_intervals[i].split('-')[1])
-                        }
-            self._exclusion_time.append(interval)
+    def exclusion_time(self, time_intervals) -> None:
+        """
+        Replaces the exclusion windows
+        :param time_intervals: rule or list of rules in the ``tariff`` format, e.g. ``'20-23'`` or
+            ``'mon-fri 06:30-08:00; sat,sun 22-6'``
+        """
+        self.schedule.update(exclusion_time=time_intervals)
+        self._logger.info(f'Updated exclusion time to: {time_intervals}')
+
+
+class FleetController(HotWaterTank):
+    """
+    Controller switching several plugs of a ``PlugFleet`` based on the available surplus.
+
+    Switching on is allowed by the same ratio rule as ``HotWaterTank``. When allowed, plugs are switched on
+    by descending priority while their rated power fits in the current surplus (produced minus used power,
+    plus the power of the fleet plugs that are already on). The plug with the highest priority is
+    always switched on, as a single tank would be. New plugs are switched on ``stagger_delay`` seconds
+    apart so their loads do not hit the grid at once.
+    """
+    def __init__(self, user: str, pwd: str, fleet: devices.PlugFleet, stagger_delay: float = 5.0, **kwargs):
+        """
+        Creates a FleetController object
+        :param user: FusionSolar user
+        :param pwd: FusionSolar password
+        :param fleet: fleet of plugs to control
+        :param stagger_delay: seconds between switching on two plugs
+        :param kwargs: arguments for ``HotWaterTank``
+        """
+        super().__init__(user, pwd, plug=fleet, **kwargs)
+        self.fleet = fleet
+        for plug in fleet.plugs.values():
+            plug.status = self.status
+        self.stagger_delay = stagger_delay
+        self._stagger_timers = []   # Pending switch-ons of the last decision, not blocking the scheduler
+        self._stagger_lock = threading.Lock()
+        self._logger = logging.getLogger('fleet_controller')
+
+    def stop(self):
+        self._cancel_staggered()
+        super().stop()
+
+    def allocate(self) -> list:
+        """
+        Returns the plugs that fit in the current surplus, by descending priority
+        :return:
+        """
+        plugs = self.fleet.by_priority()
+        inst_pwr = self.energy_device.get_latest_pwr()
+        fleet_power = sum(plug.power or 0.0 for plug in plugs if plug.state == 'on') / 1000
+        surplus = inst_pwr.get('productPower', 0.0) - inst_pwr.get('usePower', 0.0) + fleet_power
+        selected = []
+        for plug in plugs:
+            if plug.rated_power / 1000 <= surplus or not selected:
+                selected.append(plug)
+                surplus -= plug.rated_power / 1000
+        self._logger.debug(f'Surplus allocation: {[plug.mqtt_device_id for plug in selected]}')
+        return selected
+
+    def _tick(self):
+        if not self._run:
+            return
+        permission = self.activate_permission()
+        self._permission_metric.set(int(permission))
+        selected = self.allocate() if permission else []
+        self._logger.info(f'Switch on approved for {len(selected)} of {len(self.fleet.plugs)} plugs.')
+        # The switch-ons still pending from the previous decision are replaced by this one
+        self._cancel_staggered()
+        for plug in reversed(self.fleet.by_priority()):
+            if plug not in selected:
+                plug.device_off()
+        delay = 0.0
+        for plug in selected:
+            if plug.state != 'on':
+                if delay == 0.0:
+                    plug.device_on()
+                else:
+                    self._switch_on_later(plug, delay)
+                delay += self.stagger_delay
+        self.record_decision(permission, [plug.mqtt_device_id for plug in selected])
+
+    def _switch_on_later(self, plug: devices.FleetPlug, delay: float) -> None:
+        timer = threading.Timer(delay, self._staggered_on, (plug,))
+        timer.daemon = True
+        with self._stagger_lock:
+            self._stagger_timers.append(timer)
+        timer.start()
+
+    def _staggered_on(self, plug: devices.FleetPlug) -> None:
+        with self._stagger_lock:
+            self._stagger_timers = [timer for timer in self._stagger_timers if timer.is_alive()
+                                    and timer is not threading.current_thread()]
+        if self._run:
+            plug.device_on()
+
+    def _cancel_staggered(self) -> None:
+        with self._stagger_lock:
+            timers, self._stagger_timers = self._stagger_timers, []
+        for timer in timers:
+            timer.cancel()
 
 
 if __name__ == '__main__':
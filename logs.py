@@ -0,0 +1,141 @@
+"""
+Non-blocking logging pipeline.
+
+Records are put in a queue by the logging threads (MQTT network thread, scheduler ticks...) and written to the
+file handlers by a dedicated writer thread. Rotated files are gzipped by another background thread, so neither
+the rollover nor the compression add latency to the threads that log.
+
+The ``decisions`` logger writes one JSON object per line for every controller decision, to its own file.
+"""
+import datetime
+import gzip
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import threading
+import time
+
+
+DECISION_LOGGER = 'decisions'
+
+
+def namer(name):
+    return name + ".gz"
+
+
+class BackgroundCompressor:
+    """
+    Rotator for the file handlers that gzips the rotated files in a background thread
+    """
+
+    def __init__(self):
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+        self._logger = logging.getLogger(__name__)
+
+    def rotator(self, source: str, destination: str) -> None:
+        """
+        Renames ``source`` and queues its compression to ``destination``. Only the rename runs in the thread
+        doing the rollover. The renamed file is unique, so a rollover never overwrites a file not yet compressed
+        """
+        stem = destination[:-3] if destination.endswith('.gz') else destination
+        pending = f'{stem}.{time.time_ns()}-{next(self._counter)}.pending'
+        os.replace(source, pending)
+        self._queue.put((pending, destination))
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='log_compressor', daemon=True)
+                self._thread.start()
+
+    def flush(self, timeout: float = None) -> None:
+        """
+        Waits until the queued files are compressed
+        """
+        self._queue.put(None)
+        with self._lock:
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            pending, destination = item
+            try:
+                with open(pending, 'rb') as f_in:
+                    with gzip.open(destination, 'wb') as f_out:
+                        shutil.copyfileobj(f_in, f_out)
+                os.remove(pending)
+            except OSError as e:
+                # Logging to the queue from here is safe: the writer thread never waits for this one
+                self._logger.error(f'Could not compress rotated log {pending}: {e}')
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    Formats the ``decision`` dict of a record, passed with ``extra={'decision': {...}}``, as a JSON line
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='seconds')}
+        entry.update(getattr(record, 'decision', None) or {'message': record.getMessage()})
+        return json.dumps(entry, separators=(',', ':'), default=str)
+
+
+class LogPipeline:
+    """
+    Routes the root logger and the ``decisions`` logger through a queue to a writer thread
+    """
+
+    def __init__(self, handlers: list, level=logging.INFO, decision_handler: logging.Handler = None):
+        """
+        :param handlers: handlers of the regular log records, with their formatters set
+        :param level: level of the root logger
+        :param decision_handler: [optional] handler of the ``decisions`` logger. Its formatter defaults to
+            ``JsonLinesFormatter``. Decisions are not logged if not provided
+        """
+        self._queue = queue.SimpleQueue()
+        self.compressor = BackgroundCompressor()
+        for handler in handlers:
+            handler.addFilter(lambda record: record.name != DECISION_LOGGER)
+            self._use_compressor(handler)
+        handlers = list(handlers)
+        if decision_handler is not None:
+            if decision_handler.formatter is None:
+                decision_handler.setFormatter(JsonLinesFormatter())
+            decision_handler.addFilter(lambda record: record.name == DECISION_LOGGER)
+            self._use_compressor(decision_handler)
+            handlers.append(decision_handler)
+        self.listener = logging.handlers.QueueListener(self._queue, *handlers)
+
+        root = logging.getLogger()
+        root.setLevel(level)
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(logging.handlers.QueueHandler(self._queue))
+        decisions = logging.getLogger(DECISION_LOGGER)
+        decisions.setLevel(logging.INFO if decision_handler is not None else logging.CRITICAL + 1)
+
+    def _use_compressor(self, handler: logging.Handler):
+        if isinstance(handler, logging.handlers.BaseRotatingHandler):
+            handler.namer = namer
+            handler.rotator = self.compressor.rotator
+
+    def start(self) -> 'LogPipeline':
+        self.listener.start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Writes the queued records and compresses the rotated files
+        """
+        self.listener.stop()
+        self.compressor.flush()
@@ -1,47 +1,144 @@
+import time
+_T_START = time.perf_counter()
+
+import atexit
+import contextlib
 import logging
 import logging.handlers
-import shutil
-import gzip
+import resource
 import os
 import sys
 
-import hot_water_tank as hwt
-
 
-def namer(name):
-    return name + ".gz"
+class StartupProfile:
+    """
+    Records the duration and the peak resident memory of each startup stage
+    """
+    def __init__(self, t_start: float = None):
+        self.stages = []
+        self._t_start = t_start if t_start is not None else time.perf_counter()
 
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        t_stage = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((name, time.perf_counter() - t_stage,
+                                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
 
-def rotator(source, destination):
-    with open(source, 'rb') as f_in:
-        with gzip.open(destination, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-    os.remove(source)
+    def report(self) -> str:
+        lines = [f'{"stage":<16}{"time [ms]":>12}{"max RSS [MB]":>14}']
+        for name, duration, max_rss in self.stages:
+            lines.append(f'{name:<16}{duration * 1000:>12.1f}{max_rss / 1024:>14.1f}')
+        lines.append(f'{"total":<16}{(time.perf_counter() - self._t_start) * 1000:>12.1f}')
+        return '\n'.join(lines)
 
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Hot water tank controller')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='report the time of each startup stage and the first decision, then exit')
+    args = parser.parse_args()
+    profile = StartupProfile(_T_START)
+
     # READ CONFIGURATION FILE
-    import configparser
-    config = configparser.ConfigParser()
-    config.read(os.path.join(os.path.dirname(__file__), 'heater_config.ini'))
-
-    huawei_user = config['HUAWEI']['huawei_user']
-    huawei_password = config['HUAWEI']['huawei_password']
-
-    mqtt_data = {
-        'mqtt_user': config['MQTT']['mqtt_user'],
-        'mqtt_password': config['MQTT']['mqtt_password'],
-        'mqtt_broker': config['MQTT']['mqtt_broker'],
-        'mqtt_device_id': config['MQTT']['mqtt_device_id'],
-        'mqtt_port': config['MQTT'].getint('mqtt_port'),
-        'mqtt_retain': config['MQTT'].getboolean('mqtt_retain'),
-        'mqtt_qos': config['MQTT'].getint('mqtt_qos')
-    }
-
-    energy_buy_price = config['ENERGY'].getfloat('buy_price')
-    energy_sell_price = config['ENERGY'].getfloat('sell_price')
-    exclusion_time = config['ENERGY']['exclusion_time']
-    logging_level = config['DEFAULT']['logging_level']
+    with profile.stage('config'):
+        import configparser
+        config_path = os.path.join(os.path.dirname(__file__), 'heater_config.ini')
+        config = configparser.ConfigParser()
+        config.read(config_path)
+
+        # Sites of the host mode, if any. The host imports the whole controller, so only when sites are configured
+        if not config.has_section('HOST'):
+            config.add_section('HOST')
+        sites = {}
+        if config['HOST'].get('sites_path') or any(section.startswith('site:') for section in config.sections()):
+            import host
+            sites = host.load_sites(config, config['HOST'].get('sites_path') or None)
+        host_options = {'workers': 4, 'account_workers': 4, 'meter_capacity': 720}
+        for option in host_options:
+            if config['HOST'].get(option):
+                host_options[option] = config['HOST'].getint(option)
+        if not config.has_section('HUAWEI'):
+            config.add_section('HUAWEI')
+        session_path = config['HUAWEI'].get('session_path') or \
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), '.fusion_solar_session')
+        http_options = {}
+        for option in ('connect_timeout', 'read_timeout', 'recovery_time'):
+            if config['HUAWEI'].get(option):
+                http_options[option] = config['HUAWEI'].getfloat(option)
+        for option in ('retries', 'failure_threshold'):
+            if config['HUAWEI'].get(option):
+                http_options[option] = config['HUAWEI'].getint(option)
+
+        if not sites:
+            huawei_user = config['HUAWEI']['huawei_user']
+            huawei_password = config['HUAWEI']['huawei_password']
+            plants = [plant_id.strip() for plant_id in config['HUAWEI'].get('plants', '').split(',')
+                      if plant_id.strip()]
+
+            mqtt_data = {
+                'mqtt_user': config['MQTT']['mqtt_user'],
+                'mqtt_password': config['MQTT']['mqtt_password'],
+                'mqtt_broker': config['MQTT']['mqtt_broker'],
+                'mqtt_device_id': config['MQTT']['mqtt_device_id'],
+                'mqtt_port': config['MQTT'].getint('mqtt_port'),
+                'mqtt_retain': config['MQTT'].getboolean('mqtt_retain'),
+                'mqtt_qos': config['MQTT'].getint('mqtt_qos')
+            }
+
+            energy_buy_price = config['ENERGY'].getfloat('buy_price')
+            energy_sell_price = config['ENERGY'].getfloat('sell_price')
+            exclusion_time = config['ENERGY']['exclusion_time']
+            buy_tariff = config['ENERGY'].get('buy_tariff')
+            sell_tariff = config['ENERGY'].get('sell_tariff')
+            holidays = config['ENERGY'].get('holidays')
+        logging_level = config['DEFAULT']['logging_level']
+        decision_log = config['DEFAULT'].getboolean('decision_log') if config['DEFAULT'].get('decision_log') else False
+        reload_interval = config['DEFAULT'].getfloat('reload_interval') if config['DEFAULT'].get('reload_interval') \
+            else 5.0
+
+        if not config.has_section('CACHE'):
+            config.add_section('CACHE')
+        cache_ttl = {}
+        if config['CACHE'].get('day_ttl'):
+            cache_ttl['day'] = config['CACHE'].getfloat('day_ttl')
+        if config['CACHE'].get('month_ttl'):
+            cache_ttl['month'] = config['CACHE'].getfloat('month_ttl')
+        cache_entries = config['CACHE'].getint('max_entries') if config['CACHE'].get('max_entries') else 256
+        cache_path = config['CACHE'].get('cache_path') or None
+        series_path = config['CACHE'].get('series_path') or None
+
+        if not config.has_section('TIMER'):
+            config.add_section('TIMER')
+        event_topics = [topic.strip() for topic in config['TIMER'].get('event_topics', '').split(',') if topic.strip()]
+
+        forecast_options = None
+        if config.has_section('FORECAST') and config['FORECAST'].get('enabled') and \
+                config['FORECAST'].getboolean('enabled'):
+            forecast_options = {'tank_power': 2.0, 'daily_demand': 6.0, 'history_days': 365, 'half_life': 7.0,
+                                'max_price': None}
+            for option in ('tank_power', 'daily_demand', 'half_life', 'max_price'):
+                if config['FORECAST'].get(option):
+                    forecast_options[option] = config['FORECAST'].getfloat(option)
+            if config['FORECAST'].get('history_days'):
+                forecast_options['history_days'] = config['FORECAST'].getint('history_days')
+
+        metrics_port = None
+        if config.has_section('METRICS') and config['METRICS'].get('port'):
+            metrics_port = config['METRICS'].getint('port')
+            metrics_host = config['METRICS'].get('host') or '127.0.0.1'
+
+        if not config.has_section('STATUS'):
+            config.add_section('STATUS')
+        status_port = config['STATUS'].getint('port') if config['STATUS'].get('port') else None
+        status_host = config['STATUS'].get('host') or '127.0.0.1'
+        status_min_interval = config['STATUS'].getfloat('min_interval') if config['STATUS'].get('min_interval') \
+            else 10.0
+        status_max_interval = config['STATUS'].getfloat('max_interval') if config['STATUS'].get('max_interval') \
+            else 600.0
 
     # CONFIGURE LOGGING LEVEL
     if logging_level == 'DEBUG':
@@ -52,35 +149,158 @@ if __name__ == '__main__':
         logging_level = logging.ERROR
 
     # CREATE LOGGER
+    with profile.stage('logging'):
+        import logs
+        venv_bin = os.path.split(sys.executable)[0]
+        venv = os.path.split(venv_bin)[0]
+        project = os.path.split(venv)[0]
+        log_dir = os.path.join(project, 'log')
+        if not os.path.isdir(log_dir):
+            os.mkdir(log_dir)
+
+        rh_1 = logging.handlers.RotatingFileHandler(os.path.join(log_dir, 'HWTC_backup.log'),
+                                                    maxBytes=1024 * 1024,
+                                                    backupCount=50)
+        rh_2 = logging.handlers.TimedRotatingFileHandler(os.path.join(log_dir, 'HWTC_daily.log'),
+                                                         when='D',
+                                                         interval=1,
+                                                         backupCount=50)
+        formatter = logging.Formatter('%(asctime)s | %(name)-10s | %(levelname)-10s | %(message)s',
+                                      datefmt='%Y/%m/%d %H:%M:%S')
+        rh_1.setFormatter(formatter)
+        rh_2.setFormatter(formatter)
+        decision_handler = None
+        if decision_log:
+            decision_handler = logging.handlers.RotatingFileHandler(os.path.join(log_dir, 'HWTC_decisions.jsonl'),
+                                                                    maxBytes=1024 * 1024,
+                                                                    backupCount=50)
 
-    venv_bin = os.path.split(sys.executable)[0]
-    venv = os.path.split(venv_bin)[0]
-    project = os.path.split(venv)[0]
-    log_dir = os.path.join(project, 'log')
-    if not os.path.isdir(log_dir):
-        os.mkdir(log_dir)
-
-    rh_1 = logging.handlers.RotatingFileHandler(os.path.join(log_dir, 'HWTC_backup.log'),
-                                                maxBytes=1024 * 1024,
-                                                backupCount=50)
-    rh_2 = logging.handlers.TimedRotatingFileHandler(os.path.join(log_dir, 'HWTC_daily.log'),
-                                                     when='D',
-                                                     interval=1,
-                                                     backupCount=50)
-    rh_1.rotator = rotator
-    rh_1.namer = namer
-    rh_2.rotator = rotator
-    rh_2.namer = namer
-
-    logging.basicConfig(
-        format='%(asctime)s | %(name)-10s | %(levelname)-10s | %(message)s',
-        level=logging_level,
-        datefmt='%Y/%m/%d %H:%M:%S',
-        handlers=[rh_1, rh_2])
+        # Files are written, rotated and compressed by background threads
+        log_pipeline = logs.LogPipeline([rh_1, rh_2], level=logging_level,
+                                        decision_handler=decision_handler).start()
+        atexit.register(log_pipeline.stop)
 
     # RUN APP
-    controller = hwt.HotWaterTank(huawei_user, huawei_password, **mqtt_data)
-    controller.energy_price_buy = energy_buy_price
-    controller.energy_price_sell = energy_sell_price
-    controller.exclusion_time = exclusion_time
-    controller.start()
+    if sites:
+        with profile.stage('solar login'):
+            controller_host = host.ControllerHost(cache_ttl=cache_ttl, cache_entries=cache_entries,
+                                                  cache_path=cache_path,
+                                                  session_dir=os.path.dirname(os.path.abspath(session_path)),
+                                                  http_options=http_options, **host_options)
+            for site_name, site in sites.items():
+                controller = controller_host.add_site(site_name, site)
+                controller.status_min_interval = status_min_interval
+                controller.status_max_interval = status_max_interval
+        if args.profile_startup:
+            with profile.stage('mqtt connect'):
+                for fleet in controller_host.fleets.values():
+                    fleet.connect()
+                for fleet in controller_host.fleets.values():
+                    t_timeout = time.monotonic() + fleet.mqtt_keepalive
+                    while not fleet.is_connected() and time.monotonic() < t_timeout:
+                        time.sleep(0.01)
+            with profile.stage('first decision'):
+                for controller in controller_host.sites.values():
+                    controller.activate_permission()
+            for fleet in controller_host.fleets.values():
+                fleet.disconnect()
+            print(profile.report())
+        else:
+            if metrics_port is not None:
+                import metrics
+                metrics.MetricsServer(metrics_host, metrics_port).start()
+            controller_host.start()
+            if status_port is not None:
+                import status
+                status.StatusServer({site_name: controller.status for site_name, controller
+                                     in controller_host.sites.items()}, status_host, status_port).start()
+            if reload_interval > 0:
+                import config_watch
+                config_watch.ConfigWatcher(config_path, controller_host=controller_host, interval=reload_interval,
+                                           sites_path=config['HOST'].get('sites_path') or None
+                                           ).start(controller_host.scheduler)
+        sys.exit()
+
+    with profile.stage('imports'):
+        import hot_water_tank as hwt
+        import solar
+
+    with profile.stage('solar login'):
+        stats_cache = solar.StatsCache(ttl=cache_ttl, max_entries=cache_entries, path=cache_path)
+        series_store = None
+        if series_path:
+            # numpy is only imported when the series store is used
+            import timeseries
+            series_store = timeseries.SeriesStore(series_path)
+        session_store = solar.SessionStore(session_path)
+        http_policy = solar.HttpPolicy(**http_options)
+        if config.has_section('FLEET') and config['FLEET'].get('plugs'):
+            import devices
+            fleet_data = {key: value for key, value in mqtt_data.items() if key != 'mqtt_device_id'}
+            fleet = devices.PlugFleet(**fleet_data)
+            for plug_config in config['FLEET']['plugs'].split(','):
+                device_id, priority, rated_power = plug_config.strip().split(':')
+                fleet.add_plug(device_id, int(priority), float(rated_power))
+            controller = hwt.FleetController(huawei_user, huawei_password, fleet,
+                                             stagger_delay=config['FLEET'].getfloat('stagger_delay', 5.0),
+                                             stats_cache=stats_cache, series_store=series_store,
+                                             session_store=session_store, plants=plants,
+                                             http_policy=http_policy)
+        else:
+            controller = hwt.HotWaterTank(huawei_user, huawei_password, stats_cache=stats_cache,
+                                          series_store=series_store, session_store=session_store, plants=plants,
+                                          http_policy=http_policy,
+                                          **mqtt_data)
+        controller.energy_price_buy = energy_buy_price
+        controller.energy_price_sell = energy_sell_price
+        controller.exclusion_time = exclusion_time
+        controller.schedule.update(buy_tariff=buy_tariff, sell_tariff=sell_tariff, holidays=holidays)
+        if config['TIMER'].get('adaptive'):
+            controller.adaptive = config['TIMER'].getboolean('adaptive')
+        if config['TIMER'].get('min_period'):
+            controller.min_period = config['TIMER'].getfloat('min_period')
+        if config['TIMER'].get('max_period'):
+            controller.max_period = config['TIMER'].getfloat('max_period')
+        for topic in event_topics:
+            controller.add_event_topic(topic)
+        if config['STATUS'].get('topic') is not None:
+            controller.status_topic = config['STATUS']['topic'] or None
+        controller.status_min_interval = status_min_interval
+        controller.status_max_interval = status_max_interval
+
+    if forecast_options is not None:
+        with profile.stage('forecast'):
+            if series_store is None:
+                logging.getLogger(__name__).warning('The forecast needs the series store, set `series_path`')
+            else:
+                # numpy is already imported by the series store
+                import forecast
+                forecaster = forecast.Forecaster(series_store, controller.energy_device.plant_ids,
+                                                 history_days=forecast_options['history_days'],
+                                                 half_life=forecast_options['half_life'],
+                                                 meters=[controller.plug.mqtt_device_id])
+                controller.planner = forecast.HeatingPlanner(forecaster, forecast_options['tank_power'],
+                                                             forecast_options['daily_demand'], controller.schedule,
+                                                             max_price=forecast_options['max_price'])
+
+    if args.profile_startup:
+        with profile.stage('mqtt connect'):
+            controller.plug.connect()
+            t_timeout = time.monotonic() + controller.plug.mqtt_keepalive
+            while not controller.plug.is_connected() and time.monotonic() < t_timeout:
+                time.sleep(0.01)
+        with profile.stage('first decision'):
+            controller.activate_permission()
+        controller.plug.disconnect()
+        print(profile.report())
+    else:
+        if metrics_port is not None:
+            import metrics
+            metrics.MetricsServer(metrics_host, metrics_port).start()
+        controller.start()
+        if status_port is not None:
+            import status
+            status.StatusServer({controller.status.name: controller.status}, status_host, status_port).start()
+        if reload_interval > 0:
+            import config_watch
+            config_watch.ConfigWatcher(config_path, controller, interval=reload_interval).start(controller.scheduler)
@@ -0,0 +1,150 @@
+"""
+Energy metering from the power reports of a plug.
+
+``PowerMeter`` keeps the last ``capacity`` power samples in a fixed-size ring buffer and integrates them with the
+trapezoidal rule into 5-minute, hourly and daily energy totals as they arrive. Memory is bounded whatever the
+reporting rate and the uptime: the ring buffer has a fixed size and only the last ``history_days`` of totals are
+kept.
+"""
+import array
+import collections
+import datetime
+import threading
+import time
+
+
+SLOT_SECONDS = 300
+SLOTS_PER_DAY = 24 * 3600 // SLOT_SECONDS
+
+
+class PowerMeter:
+    """
+    Ring buffer of ``(timestamp, watts)`` samples with incremental energy totals.
+
+    Hourly and 5-minute buckets are aligned to the epoch, i.e. to the local hour in time zones with a whole-hour
+    offset, and daily totals are keyed by the local date. A segment between two samples more than ``max_gap``
+    seconds apart is not integrated, since the power during the gap is unknown.
+    """
+
+    def __init__(self, capacity: int = 21600, max_gap: float = 300.0, history_days: int = 62):
+        """
+        :param capacity: number of samples kept, 6 hours at 1 Hz by default
+        :param max_gap: maximum seconds between two samples for the segment to be integrated
+        :param history_days: days of 5-minute (2 days at most), hourly and daily totals kept
+        """
+        self.capacity = capacity
+        self.max_gap = max_gap
+        self.history_days = history_days
+        self.gaps = 0
+        self._tstamps = array.array('d', bytes(8 * capacity))
+        self._watts = array.array('d', bytes(8 * capacity))
+        self._next = 0
+        self._size = 0
+        self._last = None
+        self._slots = collections.OrderedDict()     # slot start [epoch s] -> kWh
+        self._hours = collections.OrderedDict()     # hour start [epoch s] -> kWh
+        self._days = collections.OrderedDict()      # local date -> kWh
+        self._slot_keys = (None, None, None)        # slot start, hour start and date of the current slot
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def add(self, watts: float, tstamp: float = None) -> None:
+        """
+        Adds a power sample
+        :param watts: power in W
+        :param tstamp: POSIX time of the sample, now by default
+        """
+        if tstamp is None:
+            tstamp = time.time()
+        with self._lock:
+            self._tstamps[self._next] = tstamp
+            self._watts[self._next] = watts
+            self._next = (self._next + 1) % self.capacity
+            self._size = min(self._size + 1, self.capacity)
+            last = self._last
+            self._last = (tstamp, watts)
+            if last is None or tstamp <= last[0]:
+                return
+            if tstamp - last[0] > self.max_gap:
+                self.gaps += 1
+                return
+            self._integrate(last[0], last[1], tstamp, watts)
+
+    def _integrate(self, t_0: float, w_0: float, t_1: float, w_1: float) -> None:
+        # Splits the segment at the slot boundaries and adds each piece to its slot, hour and day
+        slope = (w_1 - w_0) / (t_1 - t_0)
+        start, w_start = t_0, w_0
+        while start < t_1:
+            end = min(t_1, (start // SLOT_SECONDS + 1) * SLOT_SECONDS)
+            w_end = w_0 + slope * (end - t_0)
+            self._add_energy(start, (w_start + w_end) / 2 * (end - start) / 3.6e6)
+            start, w_start = end, w_end
+
+    def _add_energy(self, tstamp: float, kwh: float) -> None:
+        slot = tstamp // SLOT_SECONDS * SLOT_SECONDS
+        if slot != self._slot_keys[0]:
+            hour = tstamp // 3600 * 3600
+            self._slot_keys = (slot, hour, datetime.date.fromtimestamp(slot))
+            self._prune()
+        slot, hour, day = self._slot_keys
+        self._slots[slot] = self._slots.get(slot, 0.0) + kwh
+        self._hours[hour] = self._hours.get(hour, 0.0) + kwh
+        self._days[day] = self._days.get(day, 0.0) + kwh
+
+    def _prune(self) -> None:
+        for totals, length in ((self._slots, 2 * SLOTS_PER_DAY), (self._hours, 24 * self.history_days),
+                               (self._days, self.history_days)):
+            while len(totals) > length:
+                totals.popitem(last=False)
+
+    def samples(self) -> tuple:
+        """
+        Returns the samples of the ring buffer, oldest first
+        :return: ``(timestamps, watts)`` arrays
+        """
+        with self._lock:
+            if self._size < self.capacity:
+                return self._tstamps[:self._size], self._watts[:self._size]
+            return (self._tstamps[self._next:] + self._tstamps[:self._next],
+                    self._watts[self._next:] + self._watts[:self._next])
+
+    def energy(self, start: float, end: float) -> float:
+        """
+        Integrates the samples of the ring buffer between two POSIX times
+        :return: energy in kWh
+        """
+        tstamps, watts = self.samples()
+        kwh = 0.0
+        for idx in range(1, len(tstamps)):
+            t_0, t_1 = tstamps[idx - 1], tstamps[idx]
+            if t_1 <= start or t_0 >= end or t_1 - t_0 > self.max_gap or t_1 <= t_0:
+                continue
+            slope = (watts[idx] - watts[idx - 1]) / (t_1 - t_0)
+            a, b = max(t_0, start), min(t_1, end)
+            kwh += (2 * watts[idx - 1] + slope * (a - t_0 + b - t_0)) / 2 * (b - a) / 3.6e6
+        return kwh
+
+    def hour_energy(self, hour_start: float) -> float:
+        """
+        Returns the energy of the hour starting at ``hour_start`` (POSIX time), in kWh
+        """
+        return self._hours.get(hour_start // 3600 * 3600, 0.0)
+
+    def day_energy(self, day: datetime.date = None) -> float:
+        """
+        Returns the energy of a day, today by default, in kWh
+        """
+        return self._days.get(day or datetime.date.today(), 0.0)
+
+    def slot_energy(self, day: datetime.date = None) -> list:
+        """
+        Returns the energy of each 5-minute slot of a day, today by default, in kWh. Only the last two days are
+        available
+        :return: list of 288 values, 0.0 for slots without data
+        """
+        day = day or datetime.date.today()
+        first = time.mktime(day.timetuple()) // SLOT_SECONDS * SLOT_SECONDS
+        with self._lock:
+            return [self._slots.get(first + idx * SLOT_SECONDS, 0.0) for idx in range(SLOTS_PER_DAY)]
@@ -0,0 +1,380 @@
+"""
+In-process metrics: counters, gauges and latency histograms shared by the controller modules.
+
+Metrics are registered in the module-level ``REGISTRY`` and can be read in-process with ``REGISTRY.snapshot()``
+or scraped in the Prometheus text format from a ``MetricsServer``::
+
+    server = metrics.MetricsServer(port=9108).start()
+    # curl http://127.0.0.1:9108/metrics
+"""
+import abc
+import bisect
+import http.server
+import json
+import logging
+import math
+import threading
+import time
+
+
+# Upper bounds of the latency histogram buckets [s]
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    return repr(float(value))
+
+
+def _json_value(value):
+    # NaN and infinite values are not valid JSON, they are given as null
+    if isinstance(value, dict):
+        return {key: _json_value(item) for key, item in value.items()}
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+class _Metric(abc.ABC):
+    """
+    Base of the metric types. A metric without label names has a single value, a metric with label names has
+    one child per combination of label values, created by ``labels``
+    """
+    type_name = None
+
+    def __init__(self, name: str, documentation: str, labelnames=(), **kwargs):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._kwargs = kwargs
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    @abc.abstractmethod
+    def _new_child(self):
+        """
+        Returns a new value holder for one combination of label values
+        """
+
+    def labels(self, **labels):
+        """
+        Returns the child metric for a combination of label values. Keep the child to avoid the lookup in
+        hot paths
+        """
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def remove(self, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._children.pop(key, None)
+
+    def children(self) -> list:
+        with self._lock:
+            return [(dict(zip(self.labelnames, key)), child) for key, child in self._children.items()]
+
+    def __getattr__(self, item):
+        # Metrics without labels forward inc/set/observe to their only child
+        if item.startswith('_') or self.labelnames:
+            raise AttributeError(item)
+        return getattr(self._children[()], item)
+
+
+class _CounterValue:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value += amount
+
+    def get(self) -> float:
+        return self.value
+
+
+class _GaugeValue(_CounterValue):
+    def __init__(self):
+        super().__init__()
+        self._function = None
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.inc(-amount)
+
+    def set_function(self, function) -> None:
+        """
+        Reads the value from ``function`` when the gauge is collected
+        """
+        self._function = function
+
+    def get(self) -> float:
+        if self._function is not None:
+            value = self._function()
+            return value if value is not None else math.nan
+        return self.value if self.value is not None else math.nan
+
+
+class _HistogramValue:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[idx] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+    def cumulative(self) -> list:
+        """
+        Returns ``(upper bound, observations <= upper bound)`` pairs, ending with the ``+Inf`` bucket
+        """
+        with self._lock:
+            counts = list(self.counts)
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimates a quantile by linear interpolation inside its bucket, as Prometheus ``histogram_quantile``
+        """
+        buckets = self.cumulative()
+        total = buckets[-1][1]
+        if total == 0:
+            return math.nan
+        rank = q * total
+        lower_bound, lower_count = 0.0, 0
+        for bound, count in buckets:
+            if count >= rank:
+                if bound == math.inf:
+                    return lower_bound
+                return lower_bound + (bound - lower_bound) * (rank - lower_count) / max(count - lower_count, 1)
+            lower_bound, lower_count = bound, count
+        return lower_bound
+
+
+class _Timer:
+    """
+    Context manager observing the duration of its block in a histogram
+    """
+    def __init__(self, histogram: _HistogramValue):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def _new_child(self):
+        return _CounterValue()
+
+
+class Gauge(_Metric):
+    type_name = 'gauge'
+
+    def _new_child(self):
+        return _GaugeValue()
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def _new_child(self):
+        return _HistogramValue(tuple(self._kwargs.get('buckets') or DEFAULT_BUCKETS))
+
+
+class Registry:
+    """
+    Collection of metrics, rendered together
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric_class, name: str, documentation: str, labelnames=(), **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_class(name, documentation, labelnames, **kwargs)
+            elif not isinstance(metric, metric_class) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f'Metric `{name}` is already registered with another type or labels')
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        """
+        Returns the counter ``name``, registering it if needed
+        """
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames=()) -> Gauge:
+        """
+        Returns the gauge ``name``, registering it if needed
+        """
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames=(), buckets: tuple = None) -> Histogram:
+        """
+        Returns the histogram ``name``, registering it if needed
+        :param buckets: upper bounds of the buckets, ``DEFAULT_BUCKETS`` if not provided
+        """
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def metrics(self) -> list:
+        with self._lock:
+            return list(self._metrics.values())
+
+    def snapshot(self) -> dict:
+        """
+        Returns the current value of all the metrics.
+        Counters and gauges are given as ``{labels: value}``, histograms as ``{labels: {'count', 'sum', 'p50',
+        'p95', 'p99'}}``, where ``labels`` is a tuple of ``(name, value)`` pairs, empty for unlabelled metrics
+        """
+        result = {}
+        for metric in self.metrics():
+            values = {}
+            for labels, child in metric.children():
+                key = tuple(labels.items())
+                if isinstance(metric, Histogram):
+                    values[key] = {'count': child.count, 'sum': child.sum, 'p50': child.quantile(0.5),
+                                   'p95': child.quantile(0.95), 'p99': child.quantile(0.99)}
+                else:
+                    values[key] = child.get()
+            result[metric.name] = values
+        return result
+
+    def render(self) -> str:
+        """
+        Renders all the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in self.metrics():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type_name}')
+            for labels, child in metric.children():
+                if isinstance(metric, Histogram):
+                    for bound, count in child.cumulative():
+                        bucket_labels = dict(labels, le=_format_value(bound))
+                        lines.append(f'{metric.name}_bucket{_format_labels(bucket_labels)} {count}')
+                    lines.append(f'{metric.name}_sum{_format_labels(labels)} {_format_value(child.sum)}')
+                    lines.append(f'{metric.name}_count{_format_labels(labels)} {child.count}')
+                else:
+                    name = f'{metric.name}_total' if isinstance(metric, Counter) and \
+                        not metric.name.endswith('_total') else metric.name
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(child.get())}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, labelnames=()) -> Counter:
+    return REGISTRY.counter(name, documentation, labelnames)
+
+
+def gauge(name: str, documentation: str, labelnames=()) -> Gauge:
+    return REGISTRY.gauge(name, documentation, labelnames)
+
+
+def histogram(name: str, documentation: str, labelnames=(), buckets: tuple = None) -> Histogram:
+    return REGISTRY.histogram(name, documentation, labelnames, buckets)
+
+
+class MetricsServer:
+    """
+    HTTP server, running in a background thread, exposing a registry at ``/metrics`` in the Prometheus text
+    format and at ``/snapshot`` as JSON
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 9108, registry: Registry = REGISTRY):
+        """
+        :param host: listening address. Keep the default to only serve the local host
+        :param port: listening port, 0 for any free port
+        :param registry: metrics to expose
+        """
+        self.registry = registry
+        self._server = http.server.ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'MetricsServer':
+        self._thread = threading.Thread(target=self._server.serve_forever, name='metrics_server', daemon=True)
+        self._thread.start()
+        self._logger.info(f'Serving metrics on {self.url}/metrics')
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                if path == '/metrics':
+                    body = server.registry.render().encode()
+                    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+                elif path == '/snapshot':
+                    snapshot = {name: {','.join(f'{label}={value}' for label, value in key): _json_value(value)
+                                       for key, value in values.items()}
+                                for name, values in server.registry.snapshot().items()}
+                    body = json.dumps(snapshot, default=str, allow_nan=False).encode()
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                server._logger.debug(format % args)
+
+        return Handler
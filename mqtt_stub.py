@@ -0,0 +1,470 @@
+"""
+Local stand-in for the Mosquitto broker and a swarm of simulated Shelly Plug S, for tests and benchmarks that must
+not use real devices.
+
+``MqttBrokerStub`` is a minimal MQTT 3.1.1 broker: it accepts connections, with or without credentials, subscriptions
+with ``+`` and ``#`` wildcards, QoS 0 and 1 publications (delivered at QoS 0) and retained messages. It can drop all
+its connections to exercise the reconnection of the clients.
+
+``ShellySwarm`` runs simulated plugs inside the broker, without connections of their own: every plug honors the
+``on``, ``off`` and ``toggle`` commands of ``shellies/<device_id>/relay/0/command`` after a response delay, and
+reports ``relay/0/power``, ``temperature`` and ``relay/0`` at configurable intervals, as a Shelly Plug S does.
+Usage::
+
+    python -m mqtt_stub --port 1883 --plugs 100 --power-interval 1
+"""
+import functools
+import heapq
+import itertools
+import logging
+import random
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+CONNACK_ACCEPTED = 0
+CONNACK_NOT_AUTHORIZED = 5
+
+
+@functools.lru_cache(maxsize=65536)
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    """
+    Returns True if ``topic`` matches a subscription filter with ``+`` and ``#`` wildcards
+    """
+    if topic_filter == topic:
+        return True
+    filter_levels = topic_filter.split('/')
+    levels = topic.split('/')
+    for idx, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if idx >= len(levels) or (level != '+' and level != levels[idx]):
+            return False
+    return len(filter_levels) == len(levels)
+
+
+def _encode_length(length: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        length, digit = divmod(length, 128)
+        encoded.append(digit | 0x80 if length else digit)
+        if not length:
+            return bytes(encoded)
+
+
+def _packet(packet_type: int, body: bytes, flags: int = 0) -> bytes:
+    return bytes([packet_type << 4 | flags]) + _encode_length(len(body)) + body
+
+
+def _string(value: bytes) -> bytes:
+    return struct.pack('!H', len(value)) + value
+
+
+def _read_string(body: bytes, offset: int) -> tuple:
+    length = struct.unpack_from('!H', body, offset)[0]
+    return body[offset + 2:offset + 2 + length], offset + 2 + length
+
+
+def publish_packet(topic: str, payload: bytes, retain: bool = False) -> bytes:
+    return _packet(PUBLISH, _string(topic.encode()) + payload, flags=int(retain))
+
+
+class _Session:
+    """
+    Connection of a client to the broker
+    """
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.client_id = None
+        self.filters = {}           # topic filter -> granted QoS
+        self._send_lock = threading.Lock()
+
+    def send(self, data: bytes) -> None:
+        with self._send_lock:
+            self.sock.sendall(data)
+
+    def matches(self, topic: str) -> bool:
+        return any(topic_matches(topic_filter, topic) for topic_filter in self.filters)
+
+
+class MqttBrokerStub:
+    """
+    MQTT broker stand-in running in background threads, one per connection
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, users: dict = None):
+        """
+        :param host: listening address
+        :param port: listening port, 0 for any free port
+        :param users: [optional] dict mapping user names to passwords. Any client is accepted if not provided
+        """
+        self.users = users
+        self.received = 0           # Publications received from the clients and the internal publishers
+        self.delivered = 0          # Publications sent to the clients
+        self.connections = 0        # Connections accepted, including reconnections
+        self._sessions = []
+        self._handlers = {}         # topic -> callable receiving the payload, e.g. a simulated plug
+        self._retained = {}         # topic -> payload
+        self._lock = threading.Lock()
+        self._server = socketserver.ThreadingTCPServer((host, port), self._handler_class(), bind_and_activate=False)
+        self._server.daemon_threads = True
+        self._server.allow_reuse_address = True
+        self._server.server_bind()
+        self._server.server_activate()
+        self._thread = None
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def address(self) -> tuple:
+        return self._server.server_address[:2]
+
+    def start(self) -> 'MqttBrokerStub':
+        self._thread = threading.Thread(target=self._server.serve_forever, name='mqtt_stub', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self.drop_connections()
+        self._server.server_close()
+
+    def session_count(self) -> int:
+        with self._lock:
+            return len(self._sessions)
+
+    def drop_connections(self) -> int:
+        """
+        Closes the connections of all the clients, as a broker restart would
+        :return: connections closed
+        """
+        with self._lock:
+            sessions, self._sessions = self._sessions, []
+        for session in sessions:
+            try:
+                session.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        return len(sessions)
+
+    def add_handler(self, topic: str, handler) -> None:
+        """
+        Calls ``handler`` with the payload of every publication on ``topic``, in the thread of the publisher
+        """
+        self._handlers[topic] = handler
+
+    def publish(self, topic: str, payload, retain: bool = False) -> int:
+        """
+        Delivers a publication to the subscribed clients
+        :return: clients the publication was sent to
+        """
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self.received += 1
+        if retain:
+            with self._lock:
+                if payload:
+                    self._retained[topic] = payload
+                else:
+                    self._retained.pop(topic, None)
+        handler = self._handlers.get(topic)
+        if handler is not None:
+            handler(payload)
+        with self._lock:
+            sessions = [session for session in self._sessions if session.matches(topic)]
+        if not sessions:
+            return 0
+        packet = publish_packet(topic, payload)
+        for session in sessions:
+            try:
+                session.send(packet)
+            except OSError:
+                continue
+            self.delivered += 1
+        return len(sessions)
+
+    def _connect(self, session: _Session, body: bytes) -> bool:
+        _, offset = _read_string(body, 0)           # Protocol name
+        flags = body[offset + 1]
+        offset += 4                                 # Level, flags and keep alive
+        client_id, offset = _read_string(body, offset)
+        if flags & 0x04:                            # Will topic and message
+            _, offset = _read_string(body, offset)
+            _, offset = _read_string(body, offset)
+        user = password = None
+        if flags & 0x80:
+            user, offset = _read_string(body, offset)
+        if flags & 0x40:
+            password, offset = _read_string(body, offset)
+        session.client_id = client_id.decode()
+        accepted = self.users is None or \
+            (user is not None and self.users.get(user.decode()) == (password or b'').decode())
+        session.send(_packet(CONNACK, bytes([0, CONNACK_ACCEPTED if accepted else CONNACK_NOT_AUTHORIZED])))
+        if accepted:
+            with self._lock:
+                self._sessions.append(session)
+                self.connections += 1
+        return accepted
+
+    def _subscribe(self, session: _Session, body: bytes) -> None:
+        packet_id = body[:2]
+        offset = 2
+        granted = bytearray()
+        topic_filters = []
+        while offset < len(body):
+            topic_filter, offset = _read_string(body, offset)
+            offset += 1
+            topic_filters.append(topic_filter.decode())
+            # Publications are delivered at QoS 0
+            granted.append(0)
+        with self._lock:
+            for topic_filter in topic_filters:
+                session.filters[topic_filter] = 0
+            retained = [(topic, payload) for topic, payload in self._retained.items()
+                        if any(topic_matches(topic_filter, topic) for topic_filter in topic_filters)]
+        session.send(_packet(SUBACK, packet_id + bytes(granted)))
+        for topic, payload in retained:
+            session.send(publish_packet(topic, payload, retain=True))
+
+    def _unsubscribe(self, session: _Session, body: bytes) -> None:
+        offset = 2
+        with self._lock:
+            while offset < len(body):
+                topic_filter, offset = _read_string(body, offset)
+                session.filters.pop(topic_filter.decode(), None)
+        session.send(_packet(UNSUBACK, body[:2]))
+
+    def _on_publish(self, session: _Session, flags: int, body: bytes) -> None:
+        topic, offset = _read_string(body, 0)
+        qos = (flags >> 1) & 0x03
+        if qos:
+            packet_id = body[offset:offset + 2]
+            offset += 2
+            session.send(_packet(PUBACK, packet_id))
+        self.publish(topic.decode(), body[offset:], retain=bool(flags & 0x01))
+
+    def _serve(self, sock: socket.socket) -> None:
+        session = _Session(sock)
+        reader = sock.makefile('rb')
+        try:
+            while True:
+                header = reader.read(1)
+                if not header:
+                    return
+                length, multiplier = 0, 1
+                while True:
+                    digit = reader.read(1)[0]
+                    length += (digit & 0x7F) * multiplier
+                    multiplier *= 128
+                    if not digit & 0x80:
+                        break
+                body = reader.read(length) if length else b''
+                packet_type, flags = header[0] >> 4, header[0] & 0x0F
+                if packet_type == CONNECT:
+                    if not self._connect(session, body):
+                        return
+                elif packet_type == PUBLISH:
+                    self._on_publish(session, flags, body)
+                elif packet_type == SUBSCRIBE:
+                    self._subscribe(session, body)
+                elif packet_type == UNSUBSCRIBE:
+                    self._unsubscribe(session, body)
+                elif packet_type == PINGREQ:
+                    session.send(_packet(PINGRESP, b''))
+                elif packet_type == DISCONNECT:
+                    return
+        except (OSError, IndexError):
+            return
+        finally:
+            with self._lock:
+                if session in self._sessions:
+                    self._sessions.remove(session)
+            reader.close()
+
+    def _handler_class(self):
+        broker = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                broker._serve(self.request)
+
+        return Handler
+
+
+class SimulatedPlug:
+    """
+    Shelly Plug S simulated by a ``ShellySwarm``
+    """
+
+    def __init__(self, mqtt_device_id: str, rated_power: float = 2000.0, state: str = 'off',
+                 temperature: float = 35.0):
+        """
+        :param mqtt_device_id: Shelly Plug Id
+        :param rated_power: power of the load when the relay is on [W]
+        :param state: initial relay state
+        :param temperature: initial internal temperature [ºC]
+        """
+        self.mqtt_device_id = mqtt_device_id
+        self.rated_power = rated_power
+        self.state = state
+        self.temperature = temperature
+        self.commands = 0
+        self._topic = f'shellies/{mqtt_device_id}/'
+
+    def power(self, rng: random.Random) -> float:
+        return self.rated_power * rng.uniform(0.98, 1.02) if self.state == 'on' else 0.0
+
+    def apply(self, command: str) -> bool:
+        """
+        Applies a relay command
+        :return: False if the command is not valid
+        """
+        self.commands += 1
+        if command == 'toggle':
+            command = 'off' if self.state == 'on' else 'on'
+        if command not in ('on', 'off'):
+            return False
+        self.state = command
+        return True
+
+
+class ShellySwarm:
+    """
+    Simulated Shelly plugs publishing through a ``MqttBrokerStub``, driven by a single background thread
+    """
+
+    def __init__(self, broker: MqttBrokerStub, power_interval: float = 30.0, temperature_interval: float = 60.0,
+                 state_interval: float = 30.0, response_delay: float = 0.05, seed: int = 0):
+        """
+        :param broker: broker the plugs publish through
+        :param power_interval: seconds between two ``relay/0/power`` reports of a plug
+        :param temperature_interval: seconds between two ``temperature`` reports of a plug, 0 to disable them
+        :param state_interval: seconds between two ``relay/0`` reports of a plug, 0 to disable them
+        :param response_delay: seconds between a command and the report of the new state
+        :param seed: seed of the power noise and of the report phases
+        """
+        self.broker = broker
+        self.power_interval = power_interval
+        self.temperature_interval = temperature_interval
+        self.state_interval = state_interval
+        self.response_delay = response_delay
+        self.plugs = {}
+        self.published = 0
+        self._random = random.Random(seed)
+        self._events = []           # heap of (due time.monotonic(), sequence, callable)
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._run = False
+        self._thread = None
+
+    def add_plug(self, mqtt_device_id: str, rated_power: float = 2000.0, state: str = 'off') -> SimulatedPlug:
+        plug = SimulatedPlug(mqtt_device_id, rated_power, state)
+        self.plugs[mqtt_device_id] = plug
+        self.broker.add_handler(f'shellies/{mqtt_device_id}/relay/0/command',
+                                functools.partial(self._on_command, plug))
+        now = time.monotonic()
+        # Reports of the plugs are spread over their intervals
+        for interval, report in ((self.power_interval, self._report_power),
+                                 (self.temperature_interval, self._report_temperature),
+                                 (self.state_interval, self._report_state)):
+            if interval > 0:
+                self._schedule(now + self._random.uniform(0, interval), self._periodic(plug, interval, report))
+        return plug
+
+    def add_plugs(self, count: int, prefix: str = 'shellyplug-s-', rated_power: float = 2000.0) -> list:
+        start = len(self.plugs)
+        return [self.add_plug(f'{prefix}{idx:06X}', rated_power) for idx in range(start, start + count)]
+
+    def start(self) -> 'ShellySwarm':
+        self._run = True
+        self._thread = threading.Thread(target=self._loop, name='shelly_swarm', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        with self._condition:
+            self._run = False
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _schedule(self, due: float, action) -> None:
+        with self._condition:
+            heapq.heappush(self._events, (due, next(self._sequence), action))
+            self._condition.notify()
+
+    def _periodic(self, plug: SimulatedPlug, interval: float, report):
+        def action(due: float):
+            report(plug)
+            self._schedule(due + interval, action)
+        return action
+
+    def _loop(self) -> None:
+        while True:
+            with self._condition:
+                while self._run and (not self._events or self._events[0][0] > time.monotonic()):
+                    timeout = self._events[0][0] - time.monotonic() if self._events else None
+                    self._condition.wait(timeout)
+                if not self._run:
+                    return
+                due, _, action = heapq.heappop(self._events)
+            action(due)
+
+    def _publish(self, plug: SimulatedPlug, subtopic: str, payload: str) -> None:
+        self.published += 1
+        self.broker.publish(plug._topic + subtopic, payload)
+
+    def _report_power(self, plug: SimulatedPlug) -> None:
+        self._publish(plug, 'relay/0/power', f'{plug.power(self._random):.2f}')
+
+    def _report_temperature(self, plug: SimulatedPlug) -> None:
+        plug.temperature += self._random.uniform(-0.2, 0.2)
+        self._publish(plug, 'temperature', f'{plug.temperature:.1f}')
+
+    def _report_state(self, plug: SimulatedPlug) -> None:
+        self._publish(plug, 'relay/0', plug.state)
+
+    def _on_command(self, plug: SimulatedPlug, payload: bytes) -> None:
+        # Runs in the connection thread of the client sending the command
+        if not plug.apply(payload.decode()):
+            return
+
+        def respond(due: float):
+            self._report_state(plug)
+            self._report_power(plug)
+
+        if self.response_delay > 0:
+            self._schedule(time.monotonic() + self.response_delay, respond)
+        else:
+            respond(time.monotonic())
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Local MQTT broker stand-in with simulated Shelly plugs')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--plugs', type=int, default=10)
+    parser.add_argument('--power-interval', type=float, default=30.0)
+    parser.add_argument('--response-delay', type=float, default=0.05)
+    args = parser.parse_args()
+
+    stub = MqttBrokerStub(args.host, args.port).start()
+    swarm = ShellySwarm(stub, power_interval=args.power_interval, response_delay=args.response_delay)
+    swarm.add_plugs(args.plugs)
+    swarm.start()
+    print(f'MQTT stand-in listening on {stub.address[0]}:{stub.address[1]} with {args.plugs} plugs')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        swarm.stop()
+        stub.stop()
@@ -0,0 +1,188 @@
+import asyncio
+import concurrent.futures
+import logging
+import math
+import threading
+
+
+class Job:
+    """
+    Periodic task run by a ``ControllerScheduler``
+    """
+
+    def __init__(self, name: str, tick, period: float, timeout: float = None, min_interval: float = 0.0):
+        """
+        :param name: unique name of the job
+        :param tick: blocking callable without arguments, run in the executor of the scheduler
+        :param period: seconds between the start of two consecutive ticks. It can be changed while the job runs
+        :param timeout: seconds to wait for a tick before reporting it as overrun. Defaults to ``period``
+        :param min_interval: minimum seconds between the start of two ticks when the job is triggered
+        """
+        self.name = name
+        self.tick = tick
+        self.period = period
+        self.timeout = timeout if timeout is not None else period
+        self.min_interval = min_interval
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.triggers = 0
+        self._task = None
+        self._running = None
+        self._wakeup = None
+        self._last_start = None
+
+
+class ControllerScheduler:
+    """
+    asyncio event loop, running in its own thread, that executes the ticks of any number of controllers.
+
+    Ticks are scheduled at fixed absolute times (``start + n * period``) so they do not drift with the
+    duration of the tick, and the blocking tick functions run in a thread pool so a slow FusionSolar
+    request never blocks the event loop or the ticks of other jobs.
+    A tick that is still running when the next one is due is not started twice: the next one is skipped.
+
+    The period of a job can be changed between ticks with ``set_period``, and ``trigger`` runs a tick
+    immediately (or as soon as ``min_interval`` allows), after which the job continues with its period.
+    """
+
+    def __init__(self, max_workers: int = 4):
+        """
+        :param max_workers: number of threads running ticks concurrently
+        """
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                               thread_name_prefix='controller_tick')
+        self._loop = None
+        self._thread = None
+        self._jobs = {}
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        return self._loop
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        """
+        Starts the event loop thread. It is a non-daemon thread, so it keeps the process alive until ``stop``
+        """
+        if self.is_running():
+            return
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='controller_scheduler')
+        self._thread.start()
+
+    def stop(self, wait: bool = True) -> None:
+        """
+        Cancels all jobs and stops the event loop. Ticks already running in the executor are allowed to finish
+        """
+        if not self.is_running():
+            return
+        jobs = list(self._jobs.values())
+        self._jobs.clear()
+        asyncio.run_coroutine_threadsafe(self._shutdown(jobs), self._loop)
+        if wait and threading.current_thread() is not self._thread:
+            self._thread.join()
+            self._loop.close()
+        self._executor.shutdown(wait=False)
+
+    def add_job(self, name: str, tick, period: float, timeout: float = None, delay: float = 0.0,
+                min_interval: float = 0.0) -> Job:
+        """
+        Schedules a periodic tick. The first tick runs after ``delay`` seconds
+        :return: the scheduled job
+        """
+        if name in self._jobs:
+            raise ValueError(f'Job `{name}` is already scheduled')
+        self.start()
+        job = Job(name, tick, period, timeout, min_interval)
+        self._jobs[name] = job
+        asyncio.run_coroutine_threadsafe(self._start_job(job, delay), self._loop).result()
+        return job
+
+    def remove_job(self, name: str) -> None:
+        """
+        Cancels a job. Its tick, if running, is allowed to finish
+        """
+        job = self._jobs.pop(name, None)
+        if job is not None and job._task is not None:
+            self._loop.call_soon_threadsafe(job._task.cancel)
+
+    def set_period(self, name: str, period: float) -> None:
+        """
+        Changes the period of a job. It applies from the next tick, counted from the start of the last one
+        """
+        job = self._jobs.get(name)
+        if job is not None:
+            job.period = period
+
+    def trigger(self, name: str) -> None:
+        """
+        Runs a tick of a job as soon as its ``min_interval`` allows, without waiting for its period.
+        It can be called from any thread
+        """
+        job = self._jobs.get(name)
+        if job is not None and job._wakeup is not None:
+            self._loop.call_soon_threadsafe(job._wakeup.set)
+
+    def jobs(self) -> list:
+        return list(self._jobs.values())
+
+    async def _shutdown(self, jobs: list) -> None:
+        tasks = [job._task for job in jobs if job._task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._loop.stop()
+
+    async def _start_job(self, job: Job, delay: float) -> None:
+        job._wakeup = asyncio.Event()
+        job._task = asyncio.create_task(self._run_job(job, delay), name=job.name)
+
+    async def _run_job(self, job: Job, delay: float) -> None:
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time() + delay
+        # Removed jobs also stop here, in case their cancellation was lost in wait_for
+        while self._jobs.get(job.name) is job:
+            try:
+                wait = next_tick - loop.time()
+                if wait <= 0.0 and not job._wakeup.is_set():
+                    # wait_for turns a cancellation into a timeout when called with no time left
+                    raise asyncio.TimeoutError
+                await asyncio.wait_for(job._wakeup.wait(), max(0.0, wait))
+                job._wakeup.clear()
+                job.triggers += 1
+                # Triggers closer than min_interval to the last tick are coalesced in a single tick
+                earliest = job._last_start + job.min_interval if job._last_start is not None else loop.time()
+                if earliest > loop.time():
+                    next_tick = min(next_tick, earliest)
+                    continue
+                next_tick = loop.time()
+            except asyncio.TimeoutError:
+                pass
+
+            if job._running is None or job._running.done():
+                if job._running is not None and job._running.exception() is not None:
+                    self._logger.error(f'Overrun tick of `{job.name}` failed: {job._running.exception()}')
+                job._last_start = loop.time()
+                job._running = loop.run_in_executor(self._executor, job.tick)
+                job.ticks += 1
+                try:
+                    await asyncio.wait_for(asyncio.shield(job._running), job.timeout)
+                except asyncio.TimeoutError:
+                    job.overruns += 1
+                    self._logger.warning(f'Tick of `{job.name}` did not finish in {job.timeout} s')
+                except Exception as e:
+                    self._logger.exception(f'Tick of `{job.name}` failed: {e}')
+            else:
+                job.skipped += 1
+                self._logger.warning(f'Tick of `{job.name}` skipped, previous tick still running')
+
+            # The period is read after the tick, so a tick can change it for the next one
+            next_tick += job.period
+            late = loop.time() - next_tick
+            if late > 0:
+                # Skip the ticks that were missed, keeping the original phase
+                next_tick += math.ceil(late / job.period) * job.period
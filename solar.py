@@ -1,9 +1,420 @@
 import time
 import datetime
 import logging
+import collections
+import concurrent.futures
+import json
+import math
+import os
+import random
+import threading
 import fusion_solar_py.client as fsc
 import fusion_solar_py.exceptions as fsc_exceptions
 import requests
+import requests.adapters
+
+import balance
+import metrics
+
+
+STAT_DIMS = {'day': 2, 'month': 4, 'year': 5, 'lifetime': 6}
+
+CAPTCHA_MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'captcha_huawei.onnx')
+
+# Seconds an entry for a period that is still running is considered fresh
+DEFAULT_CACHE_TTL = {'day': 240, 'month': 900, 'year': 3600, 'lifetime': 3600}
+# Seconds after the end of a period before its stats are considered final. The last slots are published late
+SETTLE_TIME = 900
+
+REQUEST_SECONDS = metrics.histogram('fusionsolar_request_seconds', 'Duration of the FusionSolar plant stats requests',
+                                    ['stat_type'])
+REQUEST_ERRORS = metrics.counter('fusionsolar_request_errors_total', 'Failed FusionSolar plant stats requests',
+                                 ['stat_type'])
+LOGINS = metrics.counter('fusionsolar_logins_total', 'Logins to FusionSolar')
+CACHE_HITS = metrics.counter('stats_cache_hits_total', 'Plant stats served from the cache')
+CACHE_MISSES = metrics.counter('stats_cache_misses_total', 'Plant stats not found in the cache')
+CACHE_HIT_RATIO = metrics.gauge('stats_cache_hit_ratio', 'Hits over lookups of the plant stats cache')
+REQUEST_RETRIES = metrics.counter('fusionsolar_request_retries_total', 'Retried FusionSolar plant stats requests',
+                                  ['stat_type'])
+STALE_RESPONSES = metrics.counter('fusionsolar_stale_responses_total',
+                                  'Plant stats served from expired cache entries while the portal is degraded')
+CIRCUIT_STATE = metrics.gauge('fusionsolar_circuit_state',
+                              'State of the FusionSolar circuit breaker: 0 closed, 1 half-open, 2 open')
+
+
+def period_bounds(date: datetime.datetime, stat_type: str = 'day') -> tuple:
+    """
+    Normalizes a datetime to the start of the period it belongs to
+    :param date: any datetime inside the period
+    :param stat_type: '``day``', '``month``', '``year``' or '``lifetime``'. Unknown values are treated as '``day``'
+    :return: tuple ``(stat_type, period_start, period_end)``. ``period_end`` is None for lifetime periods
+    """
+    stat_type = stat_type.lower()
+    if stat_type not in STAT_DIMS:
+        stat_type = 'day'
+    if stat_type == 'lifetime':
+        return stat_type, date, None
+    start = date.replace(hour=0, minute=0, second=0, microsecond=0)
+    if stat_type == 'day':
+        return stat_type, start, start + datetime.timedelta(days=1)
+    start = start.replace(day=1)
+    if stat_type == 'month':
+        if start.month == 12:
+            return stat_type, start, start.replace(year=start.year + 1, month=1)
+        return stat_type, start, start.replace(month=start.month + 1)
+    start = start.replace(month=1)
+    return stat_type, start, start.replace(year=start.year + 1)
+
+
+class StatsCache:
+    """
+    LRU cache for FusionSolar plant stats, parsed as ``EnergyBalance`` records, keyed by
+    ``(plant, timeDim, period start)``.
+
+    Entries for a period that is still running expire after the TTL of its aggregate type, or when the period ends
+    if they were retrieved before. Expired entries are kept until they are replaced or evicted, so they can still be
+    served as stale data while the portal is down. A period is closed ``settle_time`` seconds after its end: its
+    entries never change upstream, so they never expire and, if a ``path`` is given, they are also stored on disk and
+    survive restarts.
+    """
+
+    def __init__(self, ttl=None, max_entries: int = 256, path: str = None, settle_time: float = SETTLE_TIME):
+        """
+        Creates a plant stats cache
+        :param ttl: seconds a running period is considered fresh. Either a number applied to all
+            aggregate types or a dict ``{stat_type: seconds}`` updating ``DEFAULT_CACHE_TTL``
+        :param max_entries: maximum number of entries kept in memory
+        :param path: [optional] file name of the on-disk store for closed periods
+        :param settle_time: seconds after the end of a period before its stats are final
+        """
+        self.ttl = dict(DEFAULT_CACHE_TTL)
+        if isinstance(ttl, dict):
+            self.ttl.update(ttl)
+        elif ttl is not None:
+            self.ttl = {stat_type: ttl for stat_type in STAT_DIMS}
+        self.max_entries = max_entries
+        self.settle_time = settle_time
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = None
+        if path:
+            import shelve
+            self._disk = shelve.open(path)
+        self._logger = logging.getLogger(__name__)
+
+    @staticmethod
+    def key(plant_id: str, date: datetime.datetime, stat_type: str = 'day') -> tuple:
+        stat_type, start, _ = period_bounds(date, stat_type)
+        period = 0 if stat_type == 'lifetime' else round(start.timestamp())
+        return plant_id, STAT_DIMS[stat_type], period
+
+    def is_closed(self, date: datetime.datetime, stat_type: str = 'day') -> bool:
+        """
+        Returns True if the period of ``date`` ended more than ``settle_time`` seconds ago
+        """
+        _, _, end = period_bounds(date, stat_type)
+        return end is not None and end + datetime.timedelta(seconds=self.settle_time) <= datetime.datetime.now()
+
+    def get(self, plant_id: str, date: datetime.datetime, stat_type: str = 'day', stale: bool = False):
+        """
+        Returns the cached stats, or None if missing or expired. Records are shared, they must not be modified
+        :param stale: return expired entries too. Stale lookups are not counted as hits or misses
+        :return: ``EnergyBalance`` or None
+        """
+        key = self.key(plant_id, date, stat_type)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self._disk is not None:
+                data = self._disk.get(self._disk_key(key))
+                if isinstance(data, dict):
+                    # Stored as a payload dict by previous versions
+                    stat_type, start, _ = period_bounds(date, stat_type)
+                    data = balance.EnergyBalance.from_payload(data, stat_type, start)
+                if data is not None:
+                    entry = (None, data, None)
+                    self._store(key, entry)
+            if entry is not None and not stale and entry[0] is not None and \
+                    (entry[0] < time.monotonic() or (entry[2] is not None and entry[2] <= datetime.datetime.now())):
+                entry = None
+            if entry is None:
+                if not stale:
+                    self.misses += 1
+                    CACHE_MISSES.inc()
+                return None
+            self._entries.move_to_end(key)
+            if not stale:
+                self.hits += 1
+                CACHE_HITS.inc()
+            return entry[1]
+
+    def hit_ratio(self):
+        """
+        Returns the hits over the lookups of the cache, or None before the first lookup
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else None
+
+    def put(self, plant_id: str, date: datetime.datetime, stat_type: str, data: 'balance.EnergyBalance') -> None:
+        """
+        Stores plant stats. Missing results (None) are not cached
+        """
+        if data is None:
+            return
+        stat_type, _, end = period_bounds(date, stat_type)
+        key = self.key(plant_id, date, stat_type)
+        closed = self.is_closed(date, stat_type)
+        expiry = None if closed else time.monotonic() + self.ttl[stat_type]
+        # Retrieved while the period is running, it is not fresh after the end of the period
+        running_until = end if end is not None and end > datetime.datetime.now() else None
+        with self._lock:
+            self._store(key, (expiry, data, running_until))
+            if closed and self._disk is not None:
+                self._disk[self._disk_key(key)] = data
+                self._disk.sync()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def close(self) -> None:
+        if self._disk is not None:
+            with self._lock:
+                self._disk.close()
+                self._disk = None
+
+    def _store(self, key: tuple, entry: tuple) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    @staticmethod
+    def _disk_key(key: tuple) -> str:
+        return '|'.join(str(field) for field in key)
+
+
+def iter_periods(start: datetime.datetime, end: datetime.datetime, stat_type: str = 'day'):
+    """
+    Yields the start of every period of the aggregate type between ``start`` and ``end``, both included
+    """
+    stat_type, period, period_end = period_bounds(start, stat_type)
+    while period <= end:
+        yield period
+        if period_end is None:
+            return
+        _, period, period_end = period_bounds(period_end, stat_type)
+
+
+class RateLimiter:
+    """
+    Thread safe token bucket limiting the rate of requests
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        """
+        :param rate: requests per second
+        :param burst: maximum number of requests allowed at once
+        """
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """
+        Blocks until a request is allowed
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class SessionStore:
+    """
+    File keeping the cookies of an authenticated FusionSolar session, and the plant ids of the account,
+    so that a restart does not need to log in again. The file is only readable by its owner.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: file name of the session store
+        """
+        self.path = path
+        self._logger = logging.getLogger(__name__)
+
+    def load(self, user: str, huawei_subdomain: str):
+        """
+        Returns the stored session of the user, or None if there is no stored session for the user and subdomain
+        """
+        try:
+            with open(self.path) as session_file:
+                session = json.load(session_file)
+        except (OSError, ValueError):
+            return None
+        if session.get('user') != user or session.get('huawei_subdomain') != huawei_subdomain:
+            return None
+        return session
+
+    def save(self, user: str, huawei_subdomain: str, **session) -> None:
+        """
+        Stores the session of the user. Keyword arguments are merged into the stored session of the same user
+        """
+        stored = self.load(user, huawei_subdomain) or {}
+        stored.update(session, user=user, huawei_subdomain=huawei_subdomain, saved_at=time.time())
+        tmp_path = f'{self.path}.tmp'
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as session_file:
+                json.dump(stored, session_file)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            self._logger.warning(f'Could not save FusionSolar session: {e}')
+
+    def clear(self) -> None:
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """
+    Raised instead of sending a request while the circuit breaker is open
+    """
+
+
+class CircuitBreaker:
+    """
+    Thread safe circuit breaker for the requests to the FusionSolar portal.
+
+    The circuit opens after ``failure_threshold`` consecutive failures and no request is sent for
+    ``recovery_time`` seconds. Then a single trial request is let through (half-open): the circuit closes if it
+    succeeds and opens again if it fails.
+    """
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    def __init__(self, failure_threshold: int = 5, recovery_time: float = 120.0):
+        """
+        :param failure_threshold: consecutive failures opening the circuit
+        :param recovery_time: seconds the circuit stays open before a trial request
+        """
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(__name__)
+        CIRCUIT_STATE.set(self.state)
+
+    def available(self) -> bool:
+        """
+        Checks, without taking the trial request, if a request would be allowed
+        """
+        return self.state != self.OPEN or time.monotonic() - self._opened_at >= self.recovery_time
+
+    def allow(self) -> bool:
+        """
+        Checks if a request can be sent. The first call after ``recovery_time`` takes the trial request
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.recovery_time:
+                self._set_state(self.HALF_OPEN)
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            if self.state != self.CLOSED:
+                self._logger.info('FusionSolar portal answering again, circuit closed')
+                self._set_state(self.CLOSED)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and
+                                                self.failures >= self.failure_threshold):
+                self._logger.warning(f'FusionSolar portal degraded after {self.failures} failures, no requests '
+                                     f'for {self.recovery_time} s')
+                self._opened_at = time.monotonic()
+                self._set_state(self.OPEN)
+
+    def _set_state(self, state: int) -> None:
+        self.state = state
+        CIRCUIT_STATE.set(state)
+
+
+class PortalAdapter(requests.adapters.HTTPAdapter):
+    """
+    Transport adapter applying default timeouts to every request of the session, including the login requests
+    sent by fusion-solar-py, and keeping up to ``pool_maxsize`` keep-alive connections per host
+    """
+
+    def __init__(self, timeout: tuple = (5.0, 20.0), pool_maxsize: int = 10, **kwargs):
+        """
+        :param timeout: ``(connect, read)`` timeouts in seconds of the requests sent without an explicit timeout
+        :param pool_maxsize: connections kept open per host. Concurrent requests beyond it open short-lived
+            connections
+        """
+        self.timeout = timeout
+        kwargs.setdefault('pool_connections', 4)
+        super().__init__(pool_maxsize=pool_maxsize, **kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=timeout if timeout is not None else self.timeout, **kwargs)
+
+
+class HttpPolicy:
+    """
+    Timeouts, connection pool, retries and circuit breaker of the requests to the FusionSolar portal
+    """
+
+    def __init__(self, connect_timeout: float = 5.0, read_timeout: float = 20.0, retries: int = 2,
+                 backoff: float = 1.0, max_backoff: float = 10.0, pool_maxsize: int = 10,
+                 failure_threshold: int = 5, recovery_time: float = 120.0):
+        """
+        :param connect_timeout: seconds to establish a connection
+        :param read_timeout: seconds to wait for the response once connected
+        :param retries: attempts after the first failure of a plant stats request. Only connection errors, timeouts
+            and HTTP 429 and 5xx responses are retried
+        :param backoff: base of the exponential backoff between attempts [s]
+        :param max_backoff: maximum backoff between attempts [s]
+        :param pool_maxsize: keep-alive connections kept per host
+        :param failure_threshold: consecutive failures opening the circuit breaker
+        :param recovery_time: seconds the circuit breaker stays open
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pool_maxsize = pool_maxsize
+        self.breaker = CircuitBreaker(failure_threshold, recovery_time)
+
+    def adapter(self) -> PortalAdapter:
+        return PortalAdapter(timeout=self.timeout, pool_maxsize=self.pool_maxsize)
+
+    def backoff_delay(self, attempt: int) -> float:
+        """
+        Returns the seconds to wait before retrying, with full jitter so that the retries of concurrent requests
+        are spread
+        :param attempt: number of the failed attempt, 0 for the first one
+        """
+        return random.uniform(0.0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    @staticmethod
+    def is_retryable(response: requests.Response) -> bool:
+        return response.status_code == 429 or response.status_code >= 500
 
 
 class FusionSolarClientExtended(fsc.FusionSolarClient):
@@ -12,48 +423,184 @@ class FusionSolarClientExtended(fsc.FusionSolarClient):
     to allow querying aggregate data for day, month, year or complete lifetime
     """
 
-    def __init__(self, username: str, password: str, huawei_subdomain: str = "uni001eu5"):
-
-        super().__init__(username, password, huawei_subdomain, captcha_model_path='captcha_huawei.onnx')
+    def __init__(self, username: str, password: str, huawei_subdomain: str = "uni001eu5",
+                 stats_cache: StatsCache = None, session_store: SessionStore = None,
+                 captcha_model_path: str = CAPTCHA_MODEL_PATH, http_policy: HttpPolicy = None):
+        """
+        :param captcha_model_path: path of the ONNX captcha solver model. The model, and onnxruntime, are
+            only loaded when a login actually requires solving a captcha
+        :param stats_cache: [optional] cache for plant stats
+        :param session_store: [optional] store of the session. If it holds a session of the user, its cookies
+            are reused without logging in. The session is validated on the first request and the client only
+            logs in again if it is no longer active
+        :param http_policy: [optional] timeouts, retries and circuit breaker of the requests. Default
+            ``HttpPolicy`` if not provided
+        """
         self._logger = logging.getLogger(__name__)
+        self.stats_cache = stats_cache
+        self.session_store = session_store
+        self.http_policy = http_policy if http_policy is not None else HttpPolicy()
+        self._adapters = {'https://': self.http_policy.adapter()}
+        if stats_cache is not None:
+            CACHE_HIT_RATIO.set_function(stats_cache.hit_ratio)
+        self.stored_session = session_store.load(username, huawei_subdomain) if session_store else None
+        cookies = self.stored_session.get('cookies') if self.stored_session else None
+        super().__init__(username, password, huawei_subdomain, cookies=cookies,
+                         captcha_model_path=captcha_model_path)
+        for prefix, adapter in self._adapters.items():
+            self._session.mount(prefix, adapter)
+        if cookies:
+            self._company_id = self.stored_session.get('company_id')
+            self._logger.info('Reusing stored FusionSolar session')
+
+    def _init_solver(self):
+        # Called by fusion-solar-py when a login finds a captcha challenge
+        if self._captcha_solver is not None:
+            return
+        start = time.perf_counter()
+        super()._init_solver()
+        self._logger.info(f'Captcha solver loaded in {time.perf_counter() - start:.2f} s')
+
+    def mount(self, prefix: str, adapter) -> None:
+        """
+        Mounts a ``requests`` transport adapter on the session. Adapters are mounted again on the new
+        session created when the client has to log in again
+        """
+        self._adapters[prefix] = adapter
+        self._session.mount(prefix, adapter)
+
+    def _configure_session(self):
+        for prefix, adapter in self._adapters.items():
+            self._session.mount(prefix, adapter)
+        LOGINS.inc()
+        try:
+            super()._configure_session()
+        except requests.exceptions.RequestException:
+            self.http_policy.breaker.record_failure()
+            raise
+        if self.session_store is not None:
+            self.session_store.save(self._user, self._huawei_subdomain, cookies=self.get_cookies(),
+                                    company_id=self._company_id)
+
+    def is_session_active(self) -> bool:
+        # First request of every query, so it takes the trial request of a half-open circuit breaker
+        breaker = self.http_policy.breaker
+        if not breaker.allow():
+            raise CircuitOpenError('FusionSolar circuit breaker open')
+        try:
+            active = super().is_session_active()
+        except requests.exceptions.HTTPError as e:
+            if e.response is None or not self.http_policy.is_retryable(e.response):
+                breaker.record_success()
+                return False
+            breaker.record_failure()
+            raise
+        except ValueError:
+            # An expired session may be answered with the html login page instead of json
+            active = False
+        except requests.exceptions.RequestException:
+            breaker.record_failure()
+            raise
+        breaker.record_success()
+        return active
+
+    def stored_plant_ids(self) -> list:
+        """
+        Returns the plant ids of the account, from the session store if available
+        """
+        if self.stored_session and self.stored_session.get('plant_ids'):
+            return self.stored_session['plant_ids']
+        plant_ids = self.get_plant_ids()
+        if self.session_store is not None:
+            self.session_store.save(self._user, self._huawei_subdomain, plant_ids=plant_ids)
+        return plant_ids
+
+    def cached_balance(self, plant_id: str, query_time: int = None, stat_type: str = 'day'):
+        """
+        Returns the cached plant stats without any request to the FusionSolar API
+        :return: ``EnergyBalance`` or None if there is no fresh entry in the cache
+        """
+        if self.stats_cache is None:
+            return None
+        if query_time is None:
+            query_time = round(time.time()) * 1000
+        return self.stats_cache.get(plant_id, datetime.datetime.fromtimestamp(query_time / 1000), stat_type)
+
+    def stale_balance(self, plant_id: str, query_time: int = None, stat_type: str = 'day'):
+        """
+        Returns the last known good plant stats of the period, even if expired, marked as ``stale``.
+        Intended as a fallback while the FusionSolar portal is degraded
+        :return: ``EnergyBalance`` or None if the period is not in the cache
+        """
+        if self.stats_cache is None:
+            return None
+        if query_time is None:
+            query_time = round(time.time()) * 1000
+        data = self.stats_cache.get(plant_id, datetime.datetime.fromtimestamp(query_time / 1000), stat_type,
+                                    stale=True)
+        if data is None:
+            return None
+        STALE_RESPONSES.inc()
+        return data.replace(stale=True)
 
-    @fsc.logged_in
     def get_plant_stats(self, plant_id: str,
-                        query_time: int = round(datetime.datetime.utcnow().timestamp()) * 1000,
+                        query_time: int = None,
                         stat_type: str = 'day') -> dict:
         """
         Queries data for day, month, year or complete lifetime of the plant
         :param plant_id:
         :param query_time: ``unix timestamp * 1000`` of the day. If stat_type = 'day' it can be any timestamp in the day.
-            If stat_type = 'month', it can be any timestamp of the month and so on
+            If stat_type = 'month', it can be any timestamp of the month and so on. Current time if not provided
         :param stat_type: str with the aggregate type for data:
         '``day``' for daily data,
         '``month``' for monthly data,
         '``year``' for yearly data,
         '``lifetime``' for lifetime data,
 
-        :return:
-        """
-        date = datetime.datetime.fromtimestamp(query_time / 1000)
-        if stat_type.lower() == 'day':
-            stat_dim = 2  # Day
-            date = date - datetime.timedelta(hours=date.hour, minutes=date.minute,
-                                             seconds=date.second, microseconds=date.microsecond)
-        elif stat_type.lower() == 'month':
-            stat_dim = 4  # Month
-            date = date - datetime.timedelta(days=date.day - 1, hours=date.hour, minutes=date.minute,
-                                             seconds=date.second, microseconds=date.microsecond)
-        elif stat_type.lower() == 'year':
-            stat_dim = 5  # Year
-            date.replace(month=1)
-            date = date - datetime.timedelta(days=date.day - 1, hours=date.hour, minutes=date.minute,
-                                             seconds=date.second, microseconds=date.microsecond)
-        elif stat_type.lower() == 'lifetime':
-            stat_dim = 6  # Lifetime
-        else:
-            stat_dim = 2
-            date = date - datetime.timedelta(hours=date.hour, minutes=date.minute,
-                                             seconds=date.second, microseconds=date.microsecond)
+        :return: data in the format of the FusionSolar API. Use ``get_balance`` to get the parsed data
+        :raise CircuitOpenError if the portal is degraded and the stats are not in the cache
+        """
+        plant_balance = self.get_balance(plant_id, query_time, stat_type)
+        return plant_balance.to_dict() if plant_balance is not None else {}
+
+    def get_balance(self, plant_id: str, query_time: int = None, stat_type: str = 'day') -> balance.EnergyBalance:
+        """
+        Same as ``get_plant_stats``, returning the parsed data
+        """
+        if query_time is None:
+            query_time = round(time.time()) * 1000
+        cached = self.cached_balance(plant_id, query_time, stat_type)
+        if cached is not None:
+            return cached
+        if not self.http_policy.breaker.available():
+            # Not even the session is checked while the circuit is open
+            raise CircuitOpenError('FusionSolar circuit breaker open')
+        return self._logged_in_balance(plant_id, query_time, stat_type)
+
+    @fsc.logged_in
+    def _logged_in_balance(self, plant_id: str, query_time: int, stat_type: str) -> balance.EnergyBalance:
+        return self.request_balance(plant_id, query_time, stat_type)
+
+    def request_plant_stats(self, plant_id: str, query_time: int, stat_type: str = 'day') -> dict:
+        """
+        Same as ``request_balance``, returning the data in the format of the FusionSolar API
+        """
+        plant_balance = self.request_balance(plant_id, query_time, stat_type)
+        return plant_balance.to_dict() if plant_balance is not None else {}
+
+    def request_balance(self, plant_id: str, query_time: int, stat_type: str = 'day') -> balance.EnergyBalance:
+        """
+        Queries plant stats from the FusionSolar API without checking the session first and stores the result
+        in the cache. Parameters are the same as in ``get_plant_stats``.
+        Intended for bulk queries once the session has been checked.
+        Connection errors, timeouts and HTTP 429 and 5xx responses are retried with jittered exponential backoff, as
+        set by the ``http_policy``, unless the circuit breaker opens.
+        :return: the data parsed once into an ``EnergyBalance``, None if the response has no data
+        :raise requests.exceptions.RequestException if all the attempts fail, ``CircuitOpenError`` if the circuit
+            breaker is open
+        """
+        stat_type, date, _ = period_bounds(datetime.datetime.fromtimestamp(query_time / 1000), stat_type)
+        stat_dim = STAT_DIMS[stat_type]
 
         url = f'https://{self._huawei_subdomain}.fusionsolar.huawei.com/rest/pvms/web/station/v1/overview/energy-balance'
         params = {
@@ -65,90 +612,478 @@ class FusionSolarClientExtended(fsc.FusionSolarClient):
             'dateStr': date.strftime('%Y-%m-%d %H:%M:%S'),
             "_": round(time.time() * 1000)
         }
+        policy = self.http_policy
+        attempt = 0
+        while True:
+            if not policy.breaker.allow():
+                raise CircuitOpenError(f'FusionSolar circuit breaker open, {plant_id} {stat_type} not requested')
+            start = time.perf_counter()
+            error = None
+            try:
+                r = self._session.get(url=url,
+                                      params=params)
+                if policy.is_retryable(r):
+                    r.raise_for_status()
+            except requests.exceptions.RequestException as e:
+                error = e
+            REQUEST_SECONDS.labels(stat_type=stat_type).observe(time.perf_counter() - start)
+            if error is None:
+                # The portal answered, even if with a client error
+                policy.breaker.record_success()
+                break
+            policy.breaker.record_failure()
+            REQUEST_ERRORS.labels(stat_type=stat_type).inc()
+            if attempt >= policy.retries or not policy.breaker.available():
+                raise error
+            delay = policy.backoff_delay(attempt)
+            self._logger.info(f'Plant {plant_id} {stat_type} request failed ({error}), retrying in {delay:.1f} s')
+            REQUEST_RETRIES.labels(stat_type=stat_type).inc()
+            time.sleep(delay)
+            attempt += 1
+
         try:
-            r = self._session.get(url=url,
-                                  params=params)
             r.raise_for_status()
             plant_data = r.json()
-        except requests.exceptions.ConnectionError as e:
-            self._logger.error(e.response)
-            return {}
+        except Exception:
+            REQUEST_ERRORS.labels(stat_type=stat_type).inc()
+            raise
 
         if not plant_data["success"] or "data" not in plant_data:
             raise fsc_exceptions.FusionSolarException(
                 f"Failed to retrieve plant status for {plant_id}"
             )
 
-        # return the plant data
-        return plant_data["data"]
+        if not plant_data["data"]:
+            return None
+        plant_balance = balance.EnergyBalance.from_payload(plant_data["data"], stat_type, date)
+        if self.stats_cache is not None:
+            self.stats_cache.put(plant_id, date, stat_type, plant_balance)
+        return plant_balance
 
 
 class PowerDevice:
     """
-    Class representing data from a FusionSolar station
+    Class representing data from a FusionSolar station, or the aggregate of several stations of the account.
+
+    With several plants, the stats of all of them are requested concurrently over the shared session and
+    summed. A plant that fails or does not answer within ``plant_timeout`` seconds does not stall the others:
+    its last data for the same period is used if available, otherwise the aggregate only covers the plants that
+    answered (data of closed periods is only returned when complete).
+
+    While the portal is degraded (the circuit breaker of the ``http_policy`` is open, or the requests fail) the last
+    known good data of the period is returned, marked as ``stale``.
+
+    Data is returned as ``balance.EnergyBalance`` records by the ``*_balance`` methods, and in the format of the
+    FusionSolar API by the ``*_overview`` ones.
     """
 
-    def __init__(self, user: str, password: str):
+    def __init__(self, user: str, password: str, stats_cache: StatsCache = None, reconcile_interval: float = 3600,
+                 series_store: 'timeseries.SeriesStore' = None, session_store: SessionStore = None,
+                 plants: list = None, plant_timeout: float = 20.0, http_policy: HttpPolicy = None,
+                 client: 'FusionSolarClientExtended' = None, executor: concurrent.futures.Executor = None):
         """
         Creates a power / energy data device
         :param user:
         :param password:
+        :param stats_cache: [optional] cache for plant stats. An in-memory cache is created if not provided
+        :param reconcile_interval: seconds between queries of the month aggregate to reconcile the month
+            totals computed from daily data
+        :param series_store: [optional] local store where the 5-minute power series are saved as they are retrieved
+        :param session_store: [optional] store of the FusionSolar session and plant ids, reused on restart
+        :param plants: [optional] ids of the plants to aggregate. All the plants of the account if not provided
+        :param plant_timeout: seconds to wait for the stats of each plant when aggregating several plants
+        :param http_policy: [optional] timeouts, retries and circuit breaker of the FusionSolar requests
+        :param client: [optional] client of the account shared with other devices. ``stats_cache``,
+            ``session_store`` and ``http_policy`` are those of the client, and the credentials are not used
+        :param executor: [optional] pool shared with other devices for the concurrent requests of several plants
         :raise AuthenticationException if credentials are incorrect
         """
         self._logger = logging.getLogger(__name__)
+        self.series_store = series_store
+        self.reconcile_interval = reconcile_interval
+        self._closed_days = {}      # date -> (totalOnGridPower, totalBuyPower) of finalized days
+        self._last_reconcile = {}   # first day of month -> time.monotonic() of the last month query
+        self._month_offset = {}     # first day of month -> month aggregate minus incremental totals when reconciled
+        self._month_lock = threading.Lock()     # Month totals state, the device may be shared by several sites
+        if stats_cache is None:
+            stats_cache = StatsCache()
         try:
-            self.client = FusionSolarClientExtended(user, password, huawei_subdomain="uni001eu5")
+            self.client = client or FusionSolarClientExtended(user, password, huawei_subdomain="uni001eu5",
+                                                              stats_cache=stats_cache, session_store=session_store,
+                                                              http_policy=http_policy)
         except fsc_exceptions.AuthenticationException as except1:
             self._logger.error(f'Logging error with user: {user} and password: {password}. {except1.args}')
             raise except1
-        self.plant_ids = self.client.get_plant_ids()
+        account_plants = self.client.stored_plant_ids()
+        if plants:
+            unknown = [plant_id for plant_id in plants if plant_id not in account_plants]
+            if unknown:
+                raise ValueError(f'Plants {unknown} not found in the account. Available plants: {account_plants}')
+            self.plant_ids = list(plants)
+        else:
+            self.plant_ids = account_plants
         self._plant_id = self.plant_ids[0]
+        self.plant_timeout = plant_timeout
+        self._last_plant_data = {}  # (plant id, stat type) -> (period start, plant data)
+        self._executor = executor
+        self._own_executor = len(self.plant_ids) > 1 and executor is None
+        if self._own_executor:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(len(self.plant_ids), 8),
+                                                                   thread_name_prefix='plant_stats')
 
-    def get_inst_pwr(self, tstamp: time.struct_time = time.localtime()) -> dict:
+    def close(self) -> None:
+        """
+        Releases the pool created by the device for the requests of several plants. A shared ``executor`` is kept.
+        The requests already running complete in the background
+        """
+        if self._own_executor:
+            self._executor.shutdown(wait=False)
+
+    def get_inst_pwr(self, tstamp: time.struct_time = None) -> dict:
         """
         Returns a dictionary with requested timestamp string, produced power and used power.
-        If no timestamp is provided, data for the current day is returned.
+        If no timestamp is provided, data for the current time is returned.
+        Finalized slots are read from the series store, if any, without querying the API.
         :param tstamp: time tuple of the requested timestamp
-        :return:
+        :return: dict with power values, or an empty dict if there is no data for the day
         """
-        plant_data = self.get_overview(datetime.datetime.fromtimestamp(time.mktime(tstamp)))
+        if tstamp is None:
+            tstamp = time.localtime()
+        date = datetime.datetime.fromtimestamp(time.mktime(tstamp))
+        if self.series_store is not None:
+            slots = [self.series_store.read_slot(plant_id, date) for plant_id in self.plant_ids]
+            if all(slot is not None for slot in slots):
+                return {'timestamp': slots[0]['timestamp'],
+                        'productPower': round(sum(slot['productPower'] for slot in slots), 3),
+                        'usePower': round(sum(slot['usePower'] for slot in slots), 3)}
+        day_balance = self.get_balance(date)
         data_idx = tstamp.tm_hour * 60 // 5 + tstamp.tm_min // 5
-        if plant_data['productPower'][data_idx] != '--':
-            product_pwr = float(plant_data['productPower'][data_idx])
-        else:
-            product_pwr = 0.0
+        if day_balance is None or data_idx >= len(day_balance.product_power):
+            return {}
+        return self._slot_power(day_balance, data_idx)
 
-        if plant_data['usePower'][data_idx] != '--':
-            use_power = float(plant_data['usePower'][data_idx])
-        else:
-            use_power = 0.0
-        return {'timestamp': plant_data['xAxis'][data_idx],
-                'productPower': product_pwr,
-                'usePower': use_power}
+    def get_latest_pwr(self) -> dict:
+        """
+        Returns the most recent slot of the current day with data, in the same format as ``get_inst_pwr``.
+        FusionSolar publishes each 5-minute slot with some delay, so the current slot is usually empty.
+        :return: dict with power values, or an empty dict if there is no data for the day yet
+        """
+        now = datetime.datetime.now()
+        day_balance = self.get_balance(now)
+        if day_balance is None:
+            return {}
+        data_idx = day_balance.last_valid(now.hour * 60 // 5 + now.minute // 5)
+        if data_idx is None:
+            return {}
+        return self._slot_power(day_balance, data_idx)
+
+    @staticmethod
+    def _slot_power(day_balance: balance.EnergyBalance, data_idx: int) -> dict:
+        product_pwr, use_power = day_balance.slot(data_idx)
+        return {'timestamp': day_balance.slot_label(data_idx),
+                'productPower': 0.0 if math.isnan(product_pwr) else product_pwr,
+                'usePower': 0.0 if math.isnan(use_power) else use_power}
 
     def get_overview(self,
                      date: datetime.datetime = None,
                      stat_type: str = 'day') -> dict:
         """
-        Returns all the information for a specific aggregate type
+        Returns all the information for a specific aggregate type, in the format of the FusionSolar API
         :param date: any datetime inside the desired time range
         :param stat_type: str with the aggregate type for data:
         '``day``' for daily data,
         '``month``' for monthly data,
         '``year``' for yearly data,
         '``lifetime``' for lifetime data,
-        :return:
+        :return: data dict, empty if not available. Use ``get_balance`` to get the parsed data
+        """
+        plant_balance = self.get_balance(date, stat_type)
+        return plant_balance.to_dict() if plant_balance is not None else {}
+
+    def get_balance(self, date: datetime.datetime = None, stat_type: str = 'day'):
+        """
+        Returns the energy balance of the plants for a specific aggregate type. Parameters are the same as in
+        ``get_overview``
+        :return: ``EnergyBalance`` or None if not available
         """
+        if date is None:
+            date = datetime.datetime.now()
+        if len(self.plant_ids) == 1:
+            return self.get_plant_balance(self._plant_id, date, stat_type)
+        return self._aggregate_balance(date, stat_type)
+
+    def get_plant_overview(self, plant_id: str, date: datetime.datetime = None, stat_type: str = 'day') -> dict:
+        """
+        Returns all the information of a single plant for a specific aggregate type. Parameters are the same as
+        in ``get_overview``
+        """
+        plant_balance = self.get_plant_balance(plant_id, date, stat_type)
+        return plant_balance.to_dict() if plant_balance is not None else {}
+
+    def get_plant_balance(self, plant_id: str, date: datetime.datetime = None, stat_type: str = 'day'):
+        """
+        Returns the energy balance of a single plant. Parameters are the same as in ``get_overview``
+        :return: ``EnergyBalance`` or None if not available
+        """
+        if date is None:
+            date = datetime.datetime.now()
+        query_time = round(date.timestamp()) * 1000
+        cached = self.client.cached_balance(plant_id, query_time, stat_type)
+        if cached is not None:
+            return cached
+
         try:
+            # The session is checked by get_balance, logging in again only if it is no longer active
+            plant_balance = self.client.get_balance(plant_id, query_time=query_time, stat_type=stat_type)
+        except (requests.exceptions.RequestException, ValueError, fsc_exceptions.FusionSolarException) as e:
+            self._logger.warning(f'Plant {plant_id} {stat_type} query failed: {e}')
+            return self.client.stale_balance(plant_id, query_time, stat_type)
+        self._store_series(plant_id, date, stat_type, plant_balance)
+        return plant_balance
+
+    def _aggregate_balance(self, date: datetime.datetime, stat_type: str):
+        query_time = round(date.timestamp()) * 1000
+        _, period_start, period_end = period_bounds(date, stat_type)
+        results = {}
+        missing = []
+        for plant_id in self.plant_ids:
+            cached = self.client.cached_balance(plant_id, query_time, stat_type)
+            if cached is not None:
+                results[plant_id] = cached
+            else:
+                missing.append(plant_id)
+
+        if missing and not self.client.http_policy.breaker.available():
+            self._logger.warning(f'FusionSolar circuit breaker open, plants {missing} not requested')
+            missing = []
+        if missing:
+            try:
+                # A single session check for all the plants
+                if not self.client.is_session_active():
+                    self.client._configure_session()
+            except (requests.exceptions.RequestException, fsc_exceptions.FusionSolarException) as e:
+                self._logger.warning(f'Session check failed: {e}')
+                missing = []
+            futures = {self._executor.submit(self._request_plant, plant_id, date, query_time, stat_type): plant_id
+                       for plant_id in missing}
+            done, not_done = concurrent.futures.wait(futures, timeout=self.plant_timeout)
+            for future in done:
+                try:
+                    plant_balance = future.result()
+                except (requests.exceptions.RequestException, ValueError, fsc_exceptions.FusionSolarException) as e:
+                    self._logger.warning(f'Plant {futures[future]} {stat_type} query failed: {e}')
+                    continue
+                if plant_balance is not None:
+                    results[futures[future]] = plant_balance
+            for future in not_done:
+                # The request keeps running and its result goes to the cache for the next decision
+                self._logger.warning(f'Plant {futures[future]} did not answer in {self.plant_timeout} s')
+
+        for plant_id in self.plant_ids:
+            if plant_id in results:
+                self._last_plant_data[(plant_id, stat_type)] = (period_start, results[plant_id])
+                continue
+            stale = self.client.stale_balance(plant_id, query_time, stat_type)
+            last_start, last_data = self._last_plant_data.get((plant_id, stat_type), (None, None))
+            if stale is None and last_start == period_start:
+                stale = last_data.replace(stale=True)
+            if stale is not None:
+                self._logger.info(f'Using previous {stat_type} data of plant {plant_id}')
+                results[plant_id] = stale
+
+        if len(results) < len(self.plant_ids):
+            missing = [plant_id for plant_id in self.plant_ids if plant_id not in results]
+            closed = period_end is not None and period_end <= datetime.datetime.now()
+            if closed or not results:
+                self._logger.warning(f'No {stat_type} data for plants {missing}')
+                return None
+            self._logger.warning(f'{stat_type.capitalize()} data aggregated without plants {missing}')
+        return balance.EnergyBalance.aggregate([results[plant_id] for plant_id in self.plant_ids
+                                                if plant_id in results])
+
+    def _request_plant(self, plant_id: str, date: datetime.datetime, query_time: int, stat_type: str):
+        plant_balance = self.client.request_balance(plant_id, query_time, stat_type)
+        self._store_series(plant_id, date, stat_type, plant_balance)
+        return plant_balance
+
+    def _store_series(self, plant_id: str, date: datetime.datetime, stat_type: str, plant_balance) -> None:
+        if self.series_store is not None and plant_balance is not None and stat_type.lower() == 'day':
+            self.series_store.write_series(plant_id, date.date(), plant_balance.product_power,
+                                           plant_balance.use_power)
+
+    def fetch_range(self, start: datetime.datetime, end: datetime.datetime, stat_type: str = 'day',
+                    max_workers: int = 4, rate: float = 5.0, retries: int = 3, progress_path: str = None,
+                    plant_id: str = None):
+        """
+        Fetches the plant stats of every period between ``start`` and ``end`` concurrently and yields
+        ``(period_start, EnergyBalance)`` tuples as they complete, not in chronological order.
+
+        Requests are sent from a bounded thread pool sharing the authenticated session, limited to ``rate``
+        requests per second. Failed periods are retried up to ``retries`` times with exponential backoff and
+        then skipped with an error log. Results go through the stats cache and, for days, the series store.
+        :param start: any datetime inside the first period
+        :param end: any datetime inside the last period
+        :param stat_type: '``day``', '``month``' or '``year``'
+        :param max_workers: number of concurrent requests. Keep it below the ``pool_maxsize`` of the ``http_policy``
+        :param rate: maximum requests per second
+        :param retries: attempts per period after the first failure
+        :param progress_path: [optional] file recording the completed periods. Periods found in it are skipped,
+            so an interrupted backfill resumes where it stopped
+        :param plant_id: [optional] plant to fetch, the first plant by default. Use one progress file per plant
+        """
+        plant_id = plant_id or self._plant_id
+        completed = set()
+        if progress_path is not None and os.path.isfile(progress_path):
+            with open(progress_path) as progress_file:
+                completed = set(line.strip() for line in progress_file)
+
+        pending = collections.deque()
+        for period in iter_periods(start, end, stat_type):
+            period_key = f'{stat_type}|{period:%Y-%m-%d}'
+            if period_key in completed:
+                continue
+            query_time = round(period.timestamp()) * 1000
+            cached = self.client.cached_balance(plant_id, query_time, stat_type)
+            if cached is not None:
+                yield period, cached
+                continue
+            pending.append((period, 0))
+        if not pending:
+            return
+
+        if not self.client.is_session_active():
             self.client._configure_session()
-        except requests.exceptions.ConnectionError as e:
-            self._logger.warning(f'Connection error: {e.response}')
-            return {}
+        limiter = RateLimiter(rate, burst=max_workers)
+        failed = []
+        progress_file = open(progress_path, 'a') if progress_path is not None else None
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                running = {}
+                while pending or running:
+                    while pending and len(running) < 2 * max_workers:
+                        period, attempt = pending.popleft()
+                        future = executor.submit(self._fetch_period, limiter, plant_id, period, stat_type, attempt)
+                        running[future] = (period, attempt)
+                    done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        period, attempt = running.pop(future)
+                        try:
+                            plant_balance = future.result()
+                        except (requests.exceptions.RequestException, ValueError,
+                                fsc_exceptions.FusionSolarException) as e:
+                            plant_balance = None
+                            self._logger.debug(f'Fetching {stat_type} {period:%Y-%m-%d} failed: {e}')
+                        if plant_balance is None:
+                            if attempt < retries:
+                                pending.append((period, attempt + 1))
+                            else:
+                                failed.append(period)
+                            continue
+                        if progress_file is not None:
+                            progress_file.write(f'{stat_type}|{period:%Y-%m-%d}\n')
+                            progress_file.flush()
+                        yield period, plant_balance
+        finally:
+            if progress_file is not None:
+                progress_file.close()
+        if failed:
+            self._logger.error(f'Could not fetch {stat_type} data for: {[f"{p:%Y-%m-%d}" for p in sorted(failed)]}')
+
+    def _fetch_period(self, limiter: RateLimiter, plant_id: str, period: datetime.datetime, stat_type: str,
+                      attempt: int):
+        if attempt:
+            time.sleep(min(2 ** attempt, 30))
+        limiter.acquire()
+        return self._request_plant(plant_id, period, round(period.timestamp()) * 1000, stat_type)
+
+    def get_month_totals(self, daily_data: balance.EnergyBalance = None, date: datetime.datetime = None) -> dict:
+        """
+        Returns ``totalOnGridPower`` and ``totalBuyPower`` for the month of ``date``.
 
+        Totals are computed incrementally as the sum of the finalized past days of the month, each one
+        fetched only once, plus the live data of the current day. The month aggregate is only queried
+        every ``reconcile_interval`` seconds, or when the incremental totals are not available, and its difference
+        with the incremental totals is applied to them until the next query.
+        :param daily_data: [optional] balance already retrieved with ``get_balance`` for the day of ``date``
+        :param date: any datetime of the current day. Current time if not provided
+        :return: dict with float values, or an empty dict if totals cannot be calculated
+        """
         if date is None:
             date = datetime.datetime.now()
-        return self.client.get_plant_stats(self._plant_id,
-                                           query_time=round(date.timestamp()) * 1000, stat_type=stat_type)
+        if daily_data is None:
+            daily_data = self.get_balance(date)
+        _, month_start, _ = period_bounds(date, 'month')
+        with self._month_lock:
+            self._closed_days = {day: totals for day, totals in self._closed_days.items()
+                                 if day >= month_start.date()}
+
+        totals = self._balance_totals(daily_data)
+        day = month_start
+        while totals is not None and day.date() < date.date():
+            day_totals = self._closed_day_totals(day)
+            if day_totals is None:
+                totals = None
+            else:
+                totals = (totals[0] + day_totals[0], totals[1] + day_totals[1])
+            day += datetime.timedelta(days=1)
+
+        with self._month_lock:
+            last_reconcile = self._last_reconcile.get(month_start)
+            reconcile = totals is None or last_reconcile is None or \
+                time.monotonic() - last_reconcile > self.reconcile_interval
+            if reconcile:
+                self._last_reconcile = {month_start: time.monotonic()}
+        if reconcile:
+            try:
+                monthly_totals = self._balance_totals(self.get_balance(date, stat_type='month'))
+            except fsc_exceptions.FusionSolarException as e:
+                self._logger.warning(f'Month aggregate query failed: {e.args}')
+                monthly_totals = None
+            if monthly_totals is not None:
+                if totals is not None:
+                    self._logger.debug(f'Month totals reconciled. Incremental: {totals}, monthly: {monthly_totals}')
+                    with self._month_lock:
+                        self._month_offset = {month_start: (monthly_totals[0] - totals[0],
+                                                            monthly_totals[1] - totals[1])}
+                return {'totalOnGridPower': monthly_totals[0], 'totalBuyPower': monthly_totals[1]}
+            self._logger.warning('Month aggregate not available, using incremental totals')
+
+        # The difference with the month aggregate is kept until the next reconciliation
+        with self._month_lock:
+            offset = self._month_offset.get(month_start)
+        if totals is not None and offset is not None:
+            totals = (totals[0] + offset[0], totals[1] + offset[1])
+
+        if totals is None:
+            return {}
+        return {'totalOnGridPower': totals[0], 'totalBuyPower': totals[1]}
+
+    def _closed_day_totals(self, day: datetime.datetime):
+        with self._month_lock:
+            totals = self._closed_days.get(day.date())
+        if totals is not None:
+            return totals
+        # Requested without the lock, the decisions of other sites are not blocked by the request
+        day_data = self.get_balance(day)
+        if day_data is None:
+            return None
+        # Days without any data are reported as '--'
+        totals = self._balance_totals(day_data) or (0.0, 0.0)
+        stats_cache = self.client.stats_cache
+        closed = stats_cache.is_closed(day) if stats_cache is not None else \
+            period_bounds(day)[2] + datetime.timedelta(seconds=SETTLE_TIME) <= datetime.datetime.now()
+        if day_data.stale or not closed:
+            # The last slots of the day may still change
+            return totals
+        with self._month_lock:
+            self._closed_days[day.date()] = totals
+        return totals
+
+    @staticmethod
+    def _balance_totals(plant_balance: balance.EnergyBalance):
+        if plant_balance is None or math.isnan(plant_balance.on_grid) or math.isnan(plant_balance.buy):
+            return None
+        return plant_balance.on_grid, plant_balance.buy
 
 
 if __name__ == '__main__':
@@ -0,0 +1,273 @@
+"""
+Status snapshot of a controller.
+
+``StatusSnapshot`` keeps the state of the plugs (relay, power, temperature) and the last decision of a controller
+(ratios, threshold, permission, staleness of the FusionSolar data), updated field by field as the MQTT messages and
+the decisions come. Its JSON is serialized once per change and reused until the next one.
+
+``StatusPublisher`` publishes the JSON on a retained MQTT topic when the snapshot changes meaningfully: the relay
+state or the decision change, or a value moves by more than its tolerance, e.g. 25 W of power. Publications are at
+least ``min_interval`` seconds apart, the changes in between being published together, and one is made every
+``max_interval`` seconds without changes so consumers can tell a stale status. ``StatusServer`` serves the same
+JSON over HTTP, without querying FusionSolar nor the plugs::
+
+    server = status.StatusServer({'tank': controller.status}, port=9109).start()
+    # curl http://127.0.0.1:9109/status
+"""
+import datetime
+import http.server
+import json
+import logging
+import threading
+import time
+
+import metrics
+
+
+STATUS_PUBLISHES = metrics.counter('status_publishes_total', 'Status snapshots published by reason',
+                                   ['controller', 'reason'])
+
+# Changes smaller than these are not published. Fields not listed are published on any change
+TOLERANCES = {'power': 25.0,            # [W]
+              'temperature': 0.5,       # [ºC]
+              'ratio_daily': 0.02,      # relative
+              'ratio_monthly': 0.02}    # relative
+RELATIVE = ('ratio_daily', 'ratio_monthly')
+# Fields updated with every decision, only published along with other changes
+UNTRACKED = ('decision_time',)
+
+
+def _timestamp(when: float) -> str:
+    return datetime.datetime.fromtimestamp(when).isoformat(timespec='seconds')
+
+
+class StatusSnapshot:
+    """
+    Status of a controller and its plugs, updated incrementally
+    """
+
+    def __init__(self, name: str, tolerances: dict = None):
+        """
+        :param name: controller name
+        :param tolerances: [optional] changes not published by field, ``TOLERANCES`` by default
+        """
+        self.name = name
+        self.tolerances = TOLERANCES if tolerances is None else tolerances
+        self.version = 0            # Incremented by every meaningful change
+        self.updated_at = None      # time.time() of the last update
+        self.on_change = None       # Called with (snapshot, meaningful) after every update that changes a value
+        self._plugs = {}            # device id -> {field: value}
+        self._fields = {}           # field -> value of the controller
+        self._reference = {}        # (device id or None, field) -> value at the last meaningful change
+        self._json = None           # Cached JSON, None after a change
+        self._serial = 0            # Incremented by every change
+        self._lock = threading.Lock()
+
+    def update(self, **fields) -> bool:
+        """
+        Updates fields of the controller, e.g. ``ratio_daily``
+        :return: True if the change is meaningful
+        """
+        return self._update(None, self._fields, fields)
+
+    def update_plug(self, mqtt_device_id: str, **fields) -> bool:
+        """
+        Updates fields of a plug: ``state``, ``power`` or ``temperature``
+        :return: True if the change is meaningful
+        """
+        with self._lock:
+            values = self._plugs.setdefault(mqtt_device_id, {})
+        return self._update(mqtt_device_id, values, fields)
+
+    def _update(self, key, values: dict, fields: dict) -> bool:
+        changed = meaningful = False
+        with self._lock:
+            for field, value in fields.items():
+                if field in values and values[field] == value:
+                    continue
+                values[field] = value
+                changed = True
+                if field not in UNTRACKED and self._is_meaningful(field, self._reference.get((key, field)), value):
+                    self._reference[key, field] = value
+                    meaningful = True
+            if not changed:
+                return False
+            self.updated_at = time.time()
+            self._json = None
+            self._serial += 1
+            if meaningful:
+                self.version += 1
+        if self.on_change is not None:
+            self.on_change(self, meaningful)
+        return meaningful
+
+    def _is_meaningful(self, field: str, reference, value) -> bool:
+        tolerance = self.tolerances.get(field)
+        if tolerance is None or not isinstance(reference, (int, float)) or not isinstance(value, (int, float)):
+            return reference != value
+        if field in RELATIVE:
+            tolerance *= max(abs(reference), abs(value))
+        return abs(value - reference) >= tolerance
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return self._to_dict()
+
+    def _to_dict(self) -> dict:
+        return {'controller': self.name,
+                'time': _timestamp(self.updated_at) if self.updated_at is not None else None,
+                'version': self.version,
+                **self._fields,
+                'plugs': {device: dict(values) for device, values in self._plugs.items()}}
+
+    def json(self) -> bytes:
+        """
+        Returns the snapshot as JSON. It is serialized again only after a change
+        """
+        data = self._json
+        if data is None:
+            with self._lock:
+                serial = self._serial
+                values = self._to_dict()
+            data = json.dumps(values, default=str).encode()
+            with self._lock:
+                if self._serial == serial:
+                    self._json = data
+        return data
+
+
+class StatusPublisher:
+    """
+    Publishes the meaningful changes of a snapshot, rate-limited
+    """
+
+    def __init__(self, snapshot: StatusSnapshot, publish, min_interval: float = 10.0, max_interval: float = 600.0):
+        """
+        :param snapshot: status to publish. Its ``on_change`` is set to the publisher
+        :param publish: callable receiving the JSON payload, e.g. publishing it on a retained MQTT topic
+        :param min_interval: minimum time between two publications [s]
+        :param max_interval: time after which any update is published, even if not meaningful [s]
+        """
+        self.snapshot = snapshot
+        self.publish = publish
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.published = 0
+        self._last_publish = None   # time.monotonic() of the last publication
+        self._timer = None          # Deferred publication of the changes within min_interval
+        self._lock = threading.Lock()
+        self._metrics = {reason: STATUS_PUBLISHES.labels(controller=snapshot.name, reason=reason)
+                         for reason in ('change', 'heartbeat', 'request')}
+        snapshot.on_change = self.on_change
+
+    def on_change(self, snapshot: StatusSnapshot, meaningful: bool) -> None:
+        if meaningful:
+            self._schedule('change')
+        elif self._last_publish is None or time.monotonic() - self._last_publish >= self.max_interval:
+            self._schedule('heartbeat')
+
+    def request(self) -> None:
+        """
+        Publishes the snapshot on request, within the rate limit
+        """
+        self._schedule('request')
+
+    def _schedule(self, reason: str) -> None:
+        with self._lock:
+            if self._timer is not None:
+                # Already scheduled, it will publish the latest values
+                return
+            wait = 0.0 if self._last_publish is None else \
+                self._last_publish + self.min_interval - time.monotonic()
+            if wait > 0:
+                self._timer = threading.Timer(wait, self._publish, (reason,))
+                self._timer.daemon = True
+                self._timer.start()
+                return
+            self._last_publish = time.monotonic()
+        self._send(reason)
+
+    def _publish(self, reason: str) -> None:
+        with self._lock:
+            self._timer = None
+            self._last_publish = time.monotonic()
+        self._send(reason)
+
+    def _send(self, reason: str) -> None:
+        self.published += 1
+        self._metrics[reason].inc()
+        self.publish(self.snapshot.json())
+
+    def stop(self) -> None:
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        self.snapshot.on_change = None
+
+
+class StatusServer:
+    """
+    HTTP server, running in a background thread, exposing status snapshots as JSON at ``/status`` (all of them, by
+    name) and ``/status/<name>``
+    """
+
+    def __init__(self, snapshots: dict, host: str = '127.0.0.1', port: int = 9109):
+        """
+        :param snapshots: dict mapping names to ``StatusSnapshot``
+        :param host: listening address. Keep the default to only serve the local host
+        :param port: listening port, 0 for any free port
+        """
+        self.snapshots = snapshots
+        self._server = http.server.ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'StatusServer':
+        self._thread = threading.Thread(target=self._server.serve_forever, name='status_server', daemon=True)
+        self._thread.start()
+        self._logger.info(f'Serving status on {self.url}/status')
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def body(self, path: str):
+        """
+        Returns the JSON of a path, or None if not found
+        """
+        if path in ('/status', '/status/'):
+            # Built from the cached JSON of each snapshot
+            return b'{' + b','.join(json.dumps(name).encode() + b':' + snapshot.json()
+                                    for name, snapshot in self.snapshots.items()) + b'}'
+        if path.startswith('/status/'):
+            snapshot = self.snapshots.get(path[len('/status/'):])
+            return snapshot.json() if snapshot is not None else None
+        return None
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = server.body(self.path.split('?')[0])
+                if body is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                server._logger.debug(format % args)
+
+        return Handler
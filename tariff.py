@@ -0,0 +1,286 @@
+"""
+Weekly schedule of exclusion windows and time-of-use energy prices.
+
+The rules are compiled into minute-resolution lookup tables covering a week, so checking the schedule at a given
+time is a single index. Rules have the format ``[days] start-end [value]``::
+
+    20-23                   every day from 20:00 to 23:00
+    mon-fri 06:30-08:00     Monday to Friday
+    sat,sun 22-6            crossing midnight, from 22:00 to 06:00 of the next day
+    mon-fri 10-14 0.25      price rule: 0.25 from 10:00 to 14:00 on weekdays
+
+Holidays are scheduled as the ``holiday_weekday`` (Sunday by default).
+"""
+import array
+import bisect
+import datetime
+import functools
+import threading
+
+
+WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+
+def parse_time(text: str) -> int:
+    """
+    Parses ``HH`` or ``HH:MM``
+    :return: minutes since midnight, 1440 for ``24``
+    """
+    hours, _, minutes = text.strip().partition(':')
+    value = int(hours) * 60 + (int(minutes) if minutes else 0)
+    if not 0 <= value <= MINUTES_PER_DAY:
+        raise ValueError(f'Invalid time `{text}`')
+    return value
+
+
+def parse_days(text: str) -> tuple:
+    """
+    Parses a list of weekdays such as ``mon-fri``, ``sat,sun`` or ``mon,wed-fri``. ``*`` means every day
+    :return: sorted tuple of weekday indices, Monday being 0
+    """
+    if text.strip() == '*':
+        return tuple(range(7))
+    days = set()
+    for part in text.lower().split(','):
+        first, _, last = part.strip().partition('-')
+        start = WEEKDAYS.index(first[:3])
+        end = WEEKDAYS.index(last[:3]) if last else start
+        days.update(day % 7 for day in range(start, end + 1 if end >= start else end + 8))
+    return tuple(sorted(days))
+
+
+def parse_rule(rule) -> dict:
+    """
+    Parses a rule ``[days] start-end [value]``
+    :param rule: rule string, or a dict as returned by this function
+    :return: dict with ``days`` (tuple of weekday indices), ``start`` and ``end`` (minutes since midnight) and
+        ``value`` (float or None)
+    """
+    if isinstance(rule, dict):
+        return rule
+    tokens = rule.split()
+    if not tokens:
+        raise ValueError('Empty schedule rule')
+    days = tuple(range(7))
+    if tokens[0][0].isalpha() or tokens[0] == '*':
+        days = parse_days(tokens.pop(0))
+    if not tokens or '-' not in tokens[0]:
+        raise ValueError(f'Schedule rule `{rule}` has no time window')
+    start, end = (parse_time(value) for value in tokens.pop(0).split('-'))
+    value = float(tokens.pop(0)) if tokens else None
+    if tokens:
+        raise ValueError(f'Unexpected `{" ".join(tokens)}` in schedule rule `{rule}`')
+    return {'days': days, 'start': start, 'end': end, 'value': value}
+
+
+def parse_rules(rules) -> list:
+    """
+    Parses a ``;`` separated string of rules or a list of rules
+    """
+    if rules is None:
+        return []
+    if isinstance(rules, str):
+        rules = rules.split(';')
+    return [parse_rule(rule) for rule in rules if not isinstance(rule, str) or rule.strip()]
+
+
+def rule_minutes(rule: dict):
+    """
+    Yields the ``(start, end)`` ranges of minutes of the week covered by a rule
+    """
+    for day in rule['days']:
+        start = day * MINUTES_PER_DAY + rule['start']
+        end = day * MINUTES_PER_DAY + rule['end']
+        if rule['end'] <= rule['start']:
+            # Crosses midnight
+            end += MINUTES_PER_DAY
+        if end <= MINUTES_PER_WEEK:
+            yield start, end
+        else:
+            yield start, MINUTES_PER_WEEK
+            yield 0, end - MINUTES_PER_WEEK
+
+
+def _rules_key(rules: list) -> tuple:
+    return tuple((rule['days'], rule['start'], rule['end'], rule['value']) for rule in rules)
+
+
+@functools.lru_cache(maxsize=64)
+def _compiled_tables(buy_price: float, sell_price: float, exclusion_time: tuple, buy_tariff: tuple,
+                     sell_tariff: tuple) -> tuple:
+    # Rules are passed as the tuples of _rules_key, so the tables of the same schedule are only built once
+    excluded = bytearray(MINUTES_PER_WEEK)
+    for days, start, end, _ in exclusion_time:
+        for first, last in rule_minutes({'days': days, 'start': start, 'end': end}):
+            excluded[first:last] = b'\x01' * (last - first)
+    buy = _price_table(buy_price, buy_tariff)
+    sell = _price_table(sell_price, sell_tariff)
+    if min(sell) <= 0.0:
+        raise ZeroDivisionError('Sell energy price cannot be 0.0')
+    return bytes(excluded), buy, sell
+
+
+@functools.lru_cache(maxsize=64)
+def _compiled_changes(buy_price: float, sell_price: float, exclusion_time: tuple, buy_tariff: tuple,
+                      sell_tariff: tuple) -> tuple:
+    # Minutes of the week where the exclusion or a price differs from the previous minute
+    excluded, buy, sell = _compiled_tables(buy_price, sell_price, exclusion_time, buy_tariff, sell_tariff)
+    return tuple(minute for minute in range(1, MINUTES_PER_WEEK)
+                 if excluded[minute] != excluded[minute - 1] or buy[minute] != buy[minute - 1]
+                 or sell[minute] != sell[minute - 1])
+
+
+def _price_table(base: float, tariff: tuple) -> array.array:
+    table = array.array('d', [base]) * MINUTES_PER_WEEK
+    for days, start, end, value in tariff:
+        rule = {'days': days, 'start': start, 'end': end, 'value': value}
+        if value is None:
+            raise ValueError(f'Price rule {rule} has no price')
+        for first, last in rule_minutes(rule):
+            table[first:last] = array.array('d', [value]) * (last - first)
+    return table
+
+
+class WeeklySchedule:
+    """
+    Exclusion windows and buy/sell prices for every minute of the week.
+
+    Price rules are applied in order over the base prices, so a later rule overrides an earlier one. The tables
+    are rebuilt by ``update`` and replaced at once, so readers in other threads never see a partial schedule.
+    """
+
+    def __init__(self, buy_price: float = 1.0, sell_price: float = 1.0, exclusion_time=None, buy_tariff=None,
+                 sell_tariff=None, holidays=None, holiday_weekday: int = 6):
+        """
+        :param buy_price: base price of bought energy
+        :param sell_price: base price of sold energy
+        :param exclusion_time: windows where the power source must not be switched on, as a list of rules or a
+            ``;`` separated string
+        :param buy_tariff: rules with the price of bought energy in their windows
+        :param sell_tariff: rules with the price of sold energy in their windows
+        :param holidays: dates, or ISO date strings, scheduled as ``holiday_weekday``
+        :param holiday_weekday: weekday index used for holidays, Sunday by default
+        """
+        self.buy_price = buy_price
+        self.sell_price = sell_price
+        self.exclusion_time = parse_rules(exclusion_time)
+        self.buy_tariff = parse_rules(buy_tariff)
+        self.sell_tariff = parse_rules(sell_tariff)
+        self.holidays = self._parse_holidays(holidays)
+        self.holiday_weekday = holiday_weekday
+        self._lock = threading.Lock()
+        self._tables = None
+        self._changes = ()
+        self.compile()
+
+    @staticmethod
+    def _parse_holidays(holidays) -> frozenset:
+        if holidays is None:
+            return frozenset()
+        if isinstance(holidays, str):
+            holidays = holidays.split(',')
+        return frozenset(day if isinstance(day, datetime.date) else datetime.date.fromisoformat(day.strip())
+                         for day in holidays if not isinstance(day, str) or day.strip())
+
+    def update(self, **kwargs) -> None:
+        """
+        Changes any of the constructor parameters and compiles the tables again. The new values are only set if
+        the tables can be compiled, otherwise the schedule is left unchanged
+        """
+        with self._lock:
+            values = {}
+            for name, value in kwargs.items():
+                if name in ('exclusion_time', 'buy_tariff', 'sell_tariff'):
+                    value = parse_rules(value)
+                elif name == 'holidays':
+                    value = self._parse_holidays(value)
+                elif not hasattr(self, name):
+                    raise AttributeError(f'Unknown schedule parameter `{name}`')
+                values[name] = value
+            tables, changes = self._compile(**{name: values.get(name, getattr(self, name))
+                                               for name in ('buy_price', 'sell_price', 'exclusion_time',
+                                                            'buy_tariff', 'sell_tariff')})
+            for name, value in values.items():
+                setattr(self, name, value)
+            self._tables, self._changes = tables, changes
+
+    def compile(self) -> None:
+        """
+        Builds the minute-resolution lookup tables of the week. Schedules with the same prices and rules, e.g. the
+        sites of a host, share the same tables
+        """
+        self._tables, self._changes = self._compile(self.buy_price, self.sell_price, self.exclusion_time,
+                                                    self.buy_tariff, self.sell_tariff)
+
+    @staticmethod
+    def _compile(buy_price: float, sell_price: float, exclusion_time: list, buy_tariff: list,
+                 sell_tariff: list) -> tuple:
+        key = (buy_price, sell_price, _rules_key(exclusion_time), _rules_key(buy_tariff), _rules_key(sell_tariff))
+        return _compiled_tables(*key), _compiled_changes(*key)
+
+    def tables(self) -> tuple:
+        """
+        Returns the ``(excluded, buy, sell)`` tables, indexed by minute of the week. ``excluded`` is bytes and the
+        prices are ``array('d')``, so they can be wrapped without copies with ``numpy.frombuffer``. Tables are
+        shared and must not be modified
+        """
+        return self._tables
+
+    def weekday(self, day: datetime.date) -> int:
+        return self.holiday_weekday if day in self.holidays else day.weekday()
+
+    def minute_of_week(self, when: datetime.datetime = None) -> int:
+        if when is None:
+            when = datetime.datetime.now()
+        return self.weekday(when.date()) * MINUTES_PER_DAY + when.hour * 60 + when.minute
+
+    def is_excluded(self, when: datetime.datetime = None) -> bool:
+        """
+        Checks if ``when`` (now by default) is inside an exclusion window
+        """
+        return bool(self._tables[0][self.minute_of_week(when)])
+
+    def prices(self, when: datetime.datetime = None) -> tuple:
+        """
+        Returns the ``(buy, sell)`` prices at ``when`` (now by default)
+        """
+        excluded, buy, sell = self._tables
+        minute = self.minute_of_week(when)
+        return buy[minute], sell[minute]
+
+    def next_change(self, when: datetime.datetime = None, horizon: int = MINUTES_PER_DAY):
+        """
+        Returns the seconds from ``when`` (now by default) until the exclusion or the prices change
+        :param horizon: minutes searched
+        :return: seconds, or None if nothing changes within ``horizon`` minutes
+        """
+        if when is None:
+            when = datetime.datetime.now()
+        excluded, buy, sell = self._tables
+        changes = self._changes
+        day = when.date()
+        offset = when.hour * 60 + when.minute
+        minute = self.weekday(day) * MINUTES_PER_DAY + offset
+        state = (excluded[minute], buy[minute], sell[minute])
+        midnight = datetime.datetime.combine(day, datetime.time(), when.tzinfo)
+        while (midnight - when).total_seconds() < horizon * 60:
+            base = self.weekday(midnight.date()) * MINUTES_PER_DAY
+            if midnight.date() != day:
+                # The weekday of the next day may not follow, e.g. before a holiday
+                if (excluded[base], buy[base], sell[base]) != state:
+                    break
+                offset = 0
+            idx = bisect.bisect_right(changes, base + offset)
+            if idx < len(changes) and changes[idx] < base + MINUTES_PER_DAY:
+                change = (midnight + datetime.timedelta(minutes=changes[idx] - base) - when).total_seconds()
+                return change if change <= horizon * 60 else None
+            midnight += datetime.timedelta(days=1)
+        else:
+            return None
+        return (midnight - when).total_seconds()
+
+    def ratio_threshold(self, when: datetime.datetime = None) -> float:
+        buy, sell = self.prices(when)
+        return buy / sell
@@ -0,0 +1,218 @@
+import datetime
+import logging
+import os
+import threading
+
+import numpy as np
+
+
+SLOT_MINUTES = 5
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+FIELDS = ('productPower', 'usePower')
+_OBSERVED = len(FIELDS)   # row of the day file flagging finalized slots
+
+
+def slot_index(when: datetime.datetime) -> int:
+    """
+    Returns the index of the 5-minute slot of the day containing ``when``
+    """
+    return when.hour * 60 // SLOT_MINUTES + when.minute // SLOT_MINUTES
+
+
+def slot_label(day: datetime.date, idx: int) -> str:
+    return f'{day:%Y-%m-%d} {idx * SLOT_MINUTES // 60:02d}:{idx * SLOT_MINUTES % 60:02d}'
+
+
+def parse_series(values: list) -> np.ndarray:
+    """
+    Converts a FusionSolar series of strings into a float32 array, with NaN for '``--``' gaps
+    """
+    series = np.full(SLOTS_PER_DAY, np.nan, dtype=np.float32)
+    for i, value in enumerate(values[:SLOTS_PER_DAY]):
+        if value != '--':
+            series[i] = float(value)
+    return series
+
+
+class SeriesStore:
+    """
+    On-disk store of the 5-minute ``productPower`` and ``usePower`` series of FusionSolar plants.
+
+    Each plant and day is kept in a fixed-size float32 file of shape ``(3, 288)`` that can be memory
+    mapped: one row per field, with NaN for gaps, plus a row flagging the slots already finalized.
+    Slots are only written until they are finalized, so stored history is append-only.
+    """
+
+    def __init__(self, path: str, settle_time: float = 900):
+        """
+        Creates a series store
+        :param path: root directory of the store. It is created if it does not exist
+        :param settle_time: seconds after the end of a slot before its value is considered final
+        """
+        self.path = path
+        self.settle_time = settle_time
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(__name__)
+        os.makedirs(path, exist_ok=True)
+
+    def day_file(self, plant_id: str, day: datetime.date) -> str:
+        plant_dir = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in plant_id)
+        return os.path.join(self.path, plant_dir, f'{day:%Y%m%d}.f32')
+
+    def open_day(self, plant_id: str, day: datetime.date, mode: str = 'r'):
+        """
+        Memory maps the file of a day
+        :param mode: ``numpy.memmap`` mode. Files opened with ``'r+'`` are created if missing
+        :return: array of shape ``(3, 288)`` or None if the day is not stored and ``mode`` is ``'r'``
+        """
+        file_name = self.day_file(plant_id, day)
+        if not os.path.isfile(file_name):
+            if mode == 'r':
+                return None
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)
+            day_data = np.full((len(FIELDS) + 1, SLOTS_PER_DAY), np.nan, dtype=np.float32)
+            day_data[_OBSERVED] = 0.0
+            day_data.tofile(file_name)
+        return np.memmap(file_name, dtype=np.float32, mode=mode, shape=(len(FIELDS) + 1, SLOTS_PER_DAY))
+
+    def write_day(self, plant_id: str, day: datetime.date, plant_data: dict,
+                  fetched_at: datetime.datetime = None) -> int:
+        """
+        Stores the 5-minute series of a day overview as returned by ``get_plant_stats``
+        :param plant_id:
+        :param day: day of the data
+        :param plant_data: day overview with the ``productPower`` and ``usePower`` series
+        :param fetched_at: time when the data was retrieved. Current time if not provided
+        :return: number of finalized slots of the day
+        """
+        if not all(field in plant_data for field in FIELDS):
+            return 0
+        return self.write_series(plant_id, day, *(parse_series(plant_data[field]) for field in FIELDS),
+                                 fetched_at=fetched_at)
+
+    def write_series(self, plant_id: str, day: datetime.date, product_power, use_power,
+                     fetched_at: datetime.datetime = None) -> int:
+        """
+        Stores the 5-minute series of a day already parsed to floats, such as the arrays of an ``EnergyBalance``
+        :param plant_id:
+        :param day: day of the data
+        :param product_power: produced power series, NaN for gaps
+        :param use_power: used power series, NaN for gaps
+        :param fetched_at: time when the data was retrieved. Current time if not provided
+        :return: number of finalized slots of the day
+        """
+        if not len(product_power) or not len(use_power):
+            return 0
+        if isinstance(day, datetime.datetime):
+            day = day.date()
+        if fetched_at is None:
+            fetched_at = datetime.datetime.now()
+        settled = fetched_at - datetime.timedelta(seconds=self.settle_time)
+        if settled.date() > day:
+            n_final = SLOTS_PER_DAY
+        elif settled.date() < day:
+            n_final = 0
+        else:
+            n_final = slot_index(settled)
+
+        with self._lock:
+            day_data = self.open_day(plant_id, day, mode='r+')
+            pending = day_data[_OBSERVED] == 0.0
+            if not pending.any():
+                return SLOTS_PER_DAY
+            for row, values in enumerate((product_power, use_power)):
+                series = np.full(SLOTS_PER_DAY, np.nan, dtype=np.float32)
+                values = np.asarray(values, dtype=np.float64)[:SLOTS_PER_DAY]
+                series[:len(values)] = values
+                day_data[row, pending] = series[pending]
+            day_data[_OBSERVED, :n_final] = 1.0
+            day_data.flush()
+            return int(np.count_nonzero(day_data[_OBSERVED]))
+
+    def read_slot(self, plant_id: str, when: datetime.datetime):
+        """
+        Reads a single finalized slot
+        :return: dict like ``PowerDevice.get_inst_pwr`` or None if the slot is not finalized in the store
+        """
+        day_data = self.open_day(plant_id, when.date())
+        idx = slot_index(when)
+        if day_data is None or day_data[_OBSERVED, idx] == 0.0:
+            return None
+        # FusionSolar reports kW with 3 decimals at most, round off the float32 representation error
+        product_pwr, use_pwr = (round(float(day_data[row, idx]), 3) for row in range(len(FIELDS)))
+        return {'timestamp': slot_label(when.date(), idx),
+                'productPower': 0.0 if np.isnan(product_pwr) else product_pwr,
+                'usePower': 0.0 if np.isnan(use_pwr) else use_pwr}
+
+    def iter_range(self, plant_id: str, start: datetime.date, end: datetime.date):
+        """
+        Yields ``(day, day_data)`` for every stored day in ``[start, end]``. ``day_data`` is a read-only
+        memory map of shape ``(3, 288)``, so only the days actually accessed are loaded
+        """
+        day = start
+        while day <= end:
+            day_data = self.open_day(plant_id, day)
+            if day_data is not None:
+                yield day, day_data
+            day += datetime.timedelta(days=1)
+
+    def read_range(self, plant_id: str, start: datetime.date, end: datetime.date, field: str) -> np.ndarray:
+        """
+        Reads one field for all days in ``[start, end]``
+        :return: float32 array of shape ``(days, 288)``, NaN for missing days and gaps
+        """
+        row = FIELDS.index(field)
+        series = np.full(((end - start).days + 1, SLOTS_PER_DAY), np.nan, dtype=np.float32)
+        for day, day_data in self.iter_range(plant_id, start, end):
+            series[(day - start).days] = day_data[row]
+        return series
+
+    def energy_file(self, meter: str, day: datetime.date) -> str:
+        meter_dir = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in meter)
+        return os.path.join(self.path, 'energy', meter_dir, f'{day:%Y%m%d}.f32')
+
+    def write_energy(self, meter: str, day: datetime.date, slots) -> None:
+        """
+        Stores the energy metered in each 5-minute slot of a day, e.g. ``PlugState.slot_energy``. The stored value
+        of a slot only grows, so the slots lost by a restart of the meter are kept
+        :param meter: name of the meter, e.g. the device id of a plug
+        :param slots: energy of each slot of the day [kWh]
+        """
+        file_name = self.energy_file(meter, day)
+        values = np.zeros(SLOTS_PER_DAY, dtype=np.float32)
+        values[:len(slots)] = np.asarray(slots, dtype=np.float64)[:SLOTS_PER_DAY]
+        with self._lock:
+            if not os.path.isfile(file_name):
+                os.makedirs(os.path.dirname(file_name), exist_ok=True)
+                values.tofile(file_name)
+                return
+            stored = np.memmap(file_name, dtype=np.float32, mode='r+', shape=(SLOTS_PER_DAY,))
+            np.maximum(stored, values, out=stored)
+            stored.flush()
+
+    def read_energy(self, meter: str, day: datetime.date):
+        """
+        Reads the energy metered in each 5-minute slot of a day
+        :return: float32 array of shape ``(288,)`` in kWh, or None if the day is not stored
+        """
+        file_name = self.energy_file(meter, day)
+        if not os.path.isfile(file_name):
+            return None
+        return np.fromfile(file_name, dtype=np.float32, count=SLOTS_PER_DAY)
+
+    def read_day(self, plant_ids: list, day: datetime.date):
+        """
+        Reads the series of a day summed over several plants
+        :return: ``(product_power, use_power)`` float32 arrays of shape ``(288,)``, NaN for gaps and missing plants
+        """
+        return tuple(sum(self.read_range(plant_id, day, day, field)[0] for plant_id in plant_ids) for field in FIELDS)
+
+    def days(self, plant_id: str) -> list:
+        """
+        Returns the sorted list of stored days of a plant
+        """
+        plant_dir = os.path.dirname(self.day_file(plant_id, datetime.date.today()))
+        if not os.path.isdir(plant_dir):
+            return []
+        return sorted(datetime.datetime.strptime(name[:8], '%Y%m%d').date()
+                      for name in os.listdir(plant_dir) if name.endswith('.f32'))